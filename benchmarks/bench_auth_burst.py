@@ -0,0 +1,161 @@
+# benchmarks/bench_auth_burst.py
+# Edit latency on a running server before, during and after a burst of logins.
+#
+# Start the server first (python server.py [--async]), then from the repository root:
+#   python -m benchmarks.bench_auth_burst --logins 500
+#
+# One editor sends an EDIT_OP every --edit-interval seconds and times its EDIT_ACK.
+# Meanwhile --logins connections all send HELLO + LOGIN at once. With bcrypt on the
+# bounded auth pool the editor's latency should stay flat; logins beyond the pool's
+# queue are answered "server busy" immediately.
+import argparse
+import socket
+import threading
+import time
+
+from utils.protocol_helpers import recv_message, send_message
+
+
+def connect(host, port):
+    sock = socket.create_connection((host, port))
+    send_message(sock, {"type": "HELLO"})
+    state = None
+    while state is None:
+        message = recv_message(sock)
+        if message is None:
+            raise ConnectionError("server closed the connection during HELLO")
+        if message.get("type") == "DOC_STATE":
+            state = message
+    return sock, state
+
+
+def login(sock, user, password):
+    send_message(sock, {"type": "LOGIN", "user": user, "password": password})
+    while True:
+        message = recv_message(sock)
+        if message is None or message.get("type") in ("AUTH_SUCCESS", "AUTH_FAIL"):
+            return message
+
+
+class Editor(threading.Thread):
+    """Edits at a fixed rate and records (sent_at, ack latency) per edit."""
+
+    def __init__(self, args):
+        super().__init__(daemon=True)
+        self.args = args
+        self.samples = []
+        self.stop = threading.Event()
+        self.sock, state = connect(args.host, args.port)
+        self.version = state["version"]
+        reply = login(self.sock, args.user, args.password)
+        if not reply or reply.get("type") != "AUTH_SUCCESS":
+            raise SystemExit(f"editor login failed: {reply}")
+        self.session_id = reply["session_id"]
+
+    def run(self):
+        while not self.stop.is_set():
+            sent_at = time.perf_counter()
+            send_message(self.sock, {"type": "EDIT_OP", "ops": [{"op": "insert", "pos": 0, "text": "x"}],
+                                     "version": self.version, "session_id": self.session_id})
+            while True:
+                message = recv_message(self.sock)
+                if message is None:
+                    return
+                if message.get("type") == "EDIT_ACK":
+                    self.version = message["version"]
+                    break
+                if message.get("type") == "DOC_STATE":  # Rejected: resync and carry on
+                    self.version = message["version"]
+                    break
+            self.samples.append((sent_at, time.perf_counter() - sent_at))
+            time.sleep(max(0.0, self.args.edit_interval - (time.perf_counter() - sent_at)))
+
+
+def burst(args, results):
+    """Opens --logins connections and logs them all in at once."""
+    barrier = threading.Barrier(args.logins)
+
+    def one_login():
+        try:
+            sock, _ = connect(args.host, args.port)
+        except OSError:
+            barrier.abort()
+            results.append(("connect error", 0.0))
+            return
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        started = time.perf_counter()
+        reply = login(sock, args.user, args.password)
+        elapsed = time.perf_counter() - started
+        if reply is None:
+            outcome = "disconnected"
+        elif reply["type"] == "AUTH_SUCCESS":
+            outcome = "success"
+            send_message(sock, {"type": "LOGOUT", "session_id": reply["session_id"]})
+        else:
+            outcome = "busy" if reply.get("busy") else "failed"
+        results.append((outcome, elapsed))
+        sock.close()
+
+    threads = [threading.Thread(target=one_login, daemon=True) for _ in range(args.logins)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else float("nan")
+
+
+def report_latency(label, latencies):
+    ms = [v * 1000 for v in latencies]
+    print(f"{label:>8} {len(ms):>7} {percentile(ms, 0.5):>8.1f} {percentile(ms, 0.95):>8.1f} "
+          f"{percentile(ms, 0.99):>8.1f} {max(ms, default=float('nan')):>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Edit latency during a login burst")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="adminpass")
+    parser.add_argument("--logins", type=int, default=500)
+    parser.add_argument("--edit-interval", type=float, default=0.02, help="seconds between edits")
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds measured before and after the burst")
+    args = parser.parse_args()
+
+    editor = Editor(args)
+    editor.start()
+    time.sleep(args.settle)
+
+    results = []
+    burst_start = time.perf_counter()
+    burst(args, results)
+    burst_end = time.perf_counter()
+
+    time.sleep(args.settle)
+    editor.stop.set()
+    editor.join(5)
+
+    phases = {"before": [], "during": [], "after": []}
+    for sent_at, latency in editor.samples:
+        phase = "before" if sent_at < burst_start else "during" if sent_at < burst_end else "after"
+        phases[phase].append(latency)
+
+    print(f"Login burst: {args.logins} logins in {burst_end - burst_start:.1f}s")
+    for outcome in ("success", "busy", "failed", "disconnected", "connect error"):
+        times = [elapsed for o, elapsed in results if o == outcome]
+        if times:
+            print(f"  {outcome:>13}: {len(times):>5}  median reply {percentile(times, 0.5) * 1000:.0f} ms")
+    print()
+    print(f"{'phase':>8} {'edits':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for label, latencies in phases.items():
+        report_latency(label, latencies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# benchmarks/bench_codec.py
+# Encode/decode throughput of the wire codecs in utils.protocol_helpers by payload size.
+#
+# Run from the repository root:  python -m benchmarks.bench_codec
+#
+# "decode" goes through FrameReader over a socketpair, so it includes framing
+# and recv_into buffering, not just the codec.
+import argparse
+import socket
+import threading
+import time
+
+from utils.protocol_helpers import CODECS, FrameReader, encode_frame
+
+
+def make_message(size):
+    # Looks like an EDIT_UPDATE / DOC_STATE: mostly text, compresses like prose.
+    words = "the quick brown fox jumps over the lazy dog\n"
+    return {"type": "DOC_STATE", "version": 42, "content": (words * (size // len(words) + 1))[:size]}
+
+
+def bench_encode(message, codec, compress, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        header, body = encode_frame(message, codec, compress)
+    return time.perf_counter() - start, len(header) + len(body)
+
+
+def bench_decode(message, codec, compress, rounds):
+    frame = b"".join(encode_frame(message, codec, compress))
+    writer_sock, reader_sock = socket.socketpair()
+    sender = threading.Thread(target=lambda: [writer_sock.sendall(frame) for _ in range(rounds)])
+    reader = FrameReader(reader_sock)
+
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(rounds):
+        reader.read_message()
+    elapsed = time.perf_counter() - start
+    sender.join()
+    writer_sock.close()
+    reader_sock.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wire codec throughput benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--bytes-per-run", type=int, default=20_000_000,
+                        help="payload bytes processed per measurement (sets the round count)")
+    args = parser.parse_args()
+
+    print(f"{'codec':>14} {'size':>10} {'wire':>10} {'enc msg/s':>12} {'enc MB/s':>9} {'dec msg/s':>12} {'dec MB/s':>9}")
+    for size in args.sizes:
+        message = make_message(size)
+        rounds = max(10, args.bytes_per_run // size)
+        for name, codec in CODECS.items():
+            for compress in (False, True):
+                enc_time, wire_size = bench_encode(message, codec, compress, rounds)
+                dec_time = bench_decode(message, codec, compress, rounds)
+                label = name + ("+zlib" if compress else "")
+                print(f"{label:>14} {size:>10} {wire_size:>10} "
+                      f"{rounds / enc_time:>12,.0f} {size * rounds / enc_time / 1e6:>9.1f} "
+                      f"{rounds / dec_time:>12,.0f} {size * rounds / dec_time / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
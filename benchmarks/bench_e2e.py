@@ -0,0 +1,315 @@
+# benchmarks/bench_e2e.py
+# End-to-end load test: starts a server, drives it with simulated users, reports latency and load.
+#
+# From the repository root:
+#   python -m benchmarks.bench_e2e --users 20 --duration 30
+#   python -m benchmarks.bench_e2e --async --users 200 --type-rate 5 --output results/async-200.json
+#
+# The server runs as a subprocess in a scratch directory with its own SQLite
+# database (no PostgreSQL needed) and cheap bcrypt rounds. Each user signs up, logs
+# in, then types, chats and saves at random (Poisson) intervals at the given rates.
+# Edit latency is measured from the moment a user sends an EDIT_OP to the moment
+# each other user receives the resulting broadcast. Server CPU and RSS are read
+# from /proc (Linux only). Results are printed and written as JSON.
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from utils.headless_client import HeadlessClient
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_START_TIMEOUT = 30.0
+SAMPLE_INTERVAL = 0.5  # seconds between server CPU/RSS samples
+ADMIN_USER, ADMIN_PASSWORD = "admin", "adminpass"  # created by the server on first start
+
+
+# --- Server process ---
+def start_server(workdir, port, use_async=False, bcrypt_rounds=4, extra_env=None, log_name="server.log"):
+    """Starts server.py in workdir on its own SQLite database and waits until it accepts connections."""
+    env = dict(os.environ, NOTEPAD_DB_BACKEND="sqlite", NOTEPAD_SQLITE_PATH=os.path.join(workdir, "bench.db"),
+               NOTEPAD_BCRYPT_ROUNDS=str(bcrypt_rounds), NOTEPAD_PORT=str(port),
+               PYTHONPATH=REPO_ROOT, PYTHONUNBUFFERED="1", **(extra_env or {}))
+    command = [sys.executable, os.path.join(REPO_ROOT, "server.py")] + (["--async"] if use_async else [])
+    log = open(os.path.join(workdir, log_name), "w")
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_for_port(process, port, log.name)
+    return process
+
+
+def wait_for_port(process, port, log_name):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"server exited with {process.returncode}; see {log_name}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit("server did not start listening in time")
+
+
+def stop_server(process):
+    """Interrupts the server so it flushes its documents, then waits for it."""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class ProcessSampler(threading.Thread):
+    """Samples a process's CPU time and resident memory from /proc."""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.stop = threading.Event()
+        self.peak_rss_kb = None
+        self.last_rss_kb = None
+
+    def cpu_seconds(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime are fields 14 and 15; fields[0] here is field 3 (state).
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def rss_kb(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def run(self):
+        while not self.stop.is_set():
+            rss = self.rss_kb()
+            if rss is not None:
+                self.last_rss_kb = rss
+                self.peak_rss_kb = max(self.peak_rss_kb or 0, rss)
+            self.stop.wait(SAMPLE_INTERVAL)
+
+
+# --- Simulated users ---
+class SimulatedUser(threading.Thread):
+    """Types, chats and saves at random intervals until stopped."""
+
+    def __init__(self, client, args, seed):
+        super().__init__(daemon=True)
+        self.client = client
+        self.args = args
+        self.random = random.Random(seed)
+        self.stop = threading.Event()
+        self.counts = {"keystrokes": 0, "chats": 0, "saves": 0}
+        self.errors = 0
+
+    def _next(self, rate):
+        return time.perf_counter() + self.random.expovariate(rate) if rate > 0 else float("inf")
+
+    def run(self):
+        client = self.client
+        next_key = self._next(self.args.type_rate)
+        next_chat = self._next(self.args.chat_rate)
+        next_save = self._next(self.args.save_rate)
+        try:
+            while not self.stop.is_set() and client.connected:
+                now = time.perf_counter()
+                if now >= next_key:
+                    length = len(client.text)
+                    if length > self.args.max_doc_size and self.random.random() < 0.5:
+                        client.delete(self.random.randrange(length), 1)
+                    else:
+                        client.insert(self.random.randint(0, length), self.random.choice(string.ascii_lowercase))
+                    if self.args.presence:
+                        client.send_presence(self.random.randint(0, len(client.text)))
+                    self.counts["keystrokes"] += 1
+                    next_key = self._next(self.args.type_rate)
+                if now >= next_chat:
+                    client.chat(f"hello from {client.user}")
+                    self.counts["chats"] += 1
+                    next_chat = self._next(self.args.chat_rate)
+                if now >= next_save:
+                    client.save()
+                    self.counts["saves"] += 1
+                    next_save = self._next(self.args.save_rate)
+                self.stop.wait(max(0.0, min(next_key, next_chat, next_save) - time.perf_counter()))
+        except OSError:
+            self.errors += 1
+
+
+def log_in_users(args):
+    clients = []
+    for i in range(args.users):
+        client = HeadlessClient("127.0.0.1", args.port)
+        client.connect()
+        name, password = f"loaduser{i}", "loadpass"
+        client.signup(name, password)
+        reply = client.login(name, password)
+        if not reply or reply.get("type") != "AUTH_SUCCESS":
+            raise SystemExit(f"login failed for {name}: {reply}")
+        clients.append(client)
+    return clients
+
+
+def fetch_server_metrics(args):
+    """Logs in as the built-in admin and returns the server's STATS snapshot, or None."""
+    admin = HeadlessClient("127.0.0.1", args.port)
+    admin.connect()
+    try:
+        reply = admin.login(ADMIN_USER, ADMIN_PASSWORD)
+        return admin.stats() if reply and reply.get("type") == "AUTH_SUCCESS" else None
+    finally:
+        admin.close()
+
+
+# --- Report ---
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+
+def edit_latencies(clients):
+    """Send-to-receive times in ms for every (revision, receiving user) pair."""
+    sent_at = {}
+    for client in clients:
+        sent_at.update(client.sent_at)
+    latencies = []
+    for client in clients:
+        for revision, arrived in client.received_at.items():
+            if revision in sent_at:
+                latencies.append((arrived - sent_at[revision]) * 1000)
+    return latencies
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fmt(value, spec=".1f"):
+    return "n/a" if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test against a local server")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load after all users logged in")
+    parser.add_argument("--type-rate", type=float, default=5.0, help="keystrokes per second per user")
+    parser.add_argument("--chat-rate", type=float, default=0.2, help="chat messages per second per user")
+    parser.add_argument("--save-rate", type=float, default=0.05, help="saves per second per user")
+    parser.add_argument("--max-doc-size", type=int, default=5000, help="users start deleting above this length")
+    parser.add_argument("--presence", action="store_true", help="send the caret after every keystroke, like client.py")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the asyncio server")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="JSON results file (default: e2e-<mode>-<users>u-<time>.json)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="notepad-e2e-") as workdir:
+        server = start_server(workdir, args.port, args.use_async, args.bcrypt_rounds)
+        sampler = ProcessSampler(server.pid)
+        sampler.start()
+        try:
+            login_started = time.perf_counter()
+            clients = log_in_users(args)
+            login_seconds = time.perf_counter() - login_started
+
+            users = [SimulatedUser(client, args, args.seed + i) for i, client in enumerate(clients)]
+            sent_before = sum(c.messages_sent for c in clients)
+            received_before = sum(c.messages_received for c in clients)
+            cpu_before = sampler.cpu_seconds()
+            started = time.perf_counter()
+            for user in users:
+                user.start()
+            time.sleep(args.duration)
+            for user in users:
+                user.stop.set()
+            for user in users:
+                user.join(5)
+            time.sleep(1.0)  # Let the last broadcasts arrive
+            elapsed = time.perf_counter() - started
+            cpu_after = sampler.cpu_seconds()
+            sent = sum(c.messages_sent for c in clients) - sent_before
+            received = sum(c.messages_received for c in clients) - received_before
+            disconnected = sum(not c.connected for c in clients)
+            converged = len({c.text for c in clients if c.connected}) <= 1
+            server_metrics = fetch_server_metrics(args)
+            for client in clients:
+                client.close()
+        finally:
+            sampler.stop.set()
+            stop_server(server)
+
+    latencies = edit_latencies(clients)
+    cpu_percent = (cpu_after - cpu_before) / elapsed * 100 if cpu_before is not None and cpu_after is not None else None
+    results = {
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "login_seconds": login_seconds,
+        "elapsed_seconds": elapsed,
+        "keystrokes": sum(u.counts["keystrokes"] for u in users),
+        "chats": sum(u.counts["chats"] for u in users),
+        "saves": sum(u.counts["saves"] for u in users),
+        "edits_acked": sum(len(c.sent_at) for c in clients),
+        "resyncs": sum(c.resyncs for c in clients),
+        "disconnected_users": disconnected,
+        "converged": converged,
+        "messages_sent_per_s": sent / elapsed,
+        "messages_received_per_s": received / elapsed,
+        "edit_latency_ms": {"samples": len(latencies), "p50": percentile(latencies, 0.5),
+                            "p99": percentile(latencies, 0.99), "max": max(latencies, default=None)},
+        "server_cpu_percent": cpu_percent,
+        "server_rss_kb": {"peak": sampler.peak_rss_kb, "final": sampler.last_rss_kb},
+        "server_metrics": server_metrics,
+    }
+
+    mode = "async" if args.use_async else "threaded"
+    print(f"{mode} server, {args.users} users, {elapsed:.1f}s (logins took {login_seconds:.1f}s)")
+    print(f"  keystrokes {results['keystrokes']:>8}   EDIT_OPs acked {results['edits_acked']:>7}   "
+          f"chats {results['chats']:>6}   saves {results['saves']:>5}")
+    print(f"  msgs/s sent {results['messages_sent_per_s']:>8.0f}   received {results['messages_received_per_s']:>8.0f}")
+    latency = results["edit_latency_ms"]
+    print(f"  edit -> broadcast ms   p50 {fmt(latency['p50'])}   p99 {fmt(latency['p99'])}   "
+          f"max {fmt(latency['max'])}   ({latency['samples']} samples)")
+    print(f"  server CPU {fmt(cpu_percent)}%   RSS peak {fmt(sampler.peak_rss_kb, 'd')} kB")
+    if server_metrics:
+        for key in ("handle_seconds{type=EDIT_OP}", "doc_lock_wait_seconds", "doc_lock_hold_seconds",
+                    "fanout_seconds{scope=document}"):
+            summary = server_metrics.get(key)
+            if summary:
+                print(f"  server {key:<32} p50 {summary['p50'] * 1000:.3f} ms   p99 {summary['p99'] * 1000:.3f} ms")
+    if results["resyncs"] or disconnected or not converged:
+        print(f"  resyncs {results['resyncs']}   disconnected users {disconnected}   converged {converged}")
+
+    output = args.output or f"e2e-{mode}-{args.users}u-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
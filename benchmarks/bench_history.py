@@ -0,0 +1,137 @@
+# benchmarks/bench_history.py
+# Revision history (utils.history): disk used for a long editing session, and how
+# long rebuilding a random past revision takes.
+#
+# Run from the repository root:  python -m benchmarks.bench_history
+#   python -m benchmarks.bench_history --revisions 100000 --doc-sizes 5000 200000 --reads 1000
+#
+# Each run types --revisions edits into a document of the given starting size
+# (mostly single characters at a moving cursor, some deletes and pastes), then
+# reads --reads random revisions back and checks a sample of them.
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from utils.history import RevisionStore
+from utils.operations import delete_op, insert_op
+from utils.oplog import GroupCommitter
+from utils.rope import Rope
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def random_edit(rng, length, cursor, target_size):
+    """One edit near the cursor: a keystroke, a deletion or a paste. Returns (ops, new cursor)."""
+    cursor = max(0, min(length, cursor + rng.choice((0, 0, 0, 1, -1, rng.randint(-500, 500)))))
+    roll = rng.random()
+    if length > target_size * 1.1 or (roll < 0.15 and length > 0):
+        count = min(rng.randint(1, 20), length - min(cursor, length - 1))
+        start = min(cursor, length - count)
+        return [delete_op(start, count)], start
+    text = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz     \n") for _ in range(rng.randint(20, 200) if roll > 0.97 else 1))
+    return [insert_op(cursor, text)], cursor + len(text)
+
+
+def run(directory, committer, args, doc_size):
+    rng = random.Random(args.seed)
+    store = RevisionStore(directory, committer)
+    text = Rope("".join(rng.choice("abcdefghijklmnopqrstuvwxyz     \n") for _ in range(doc_size)))
+    checked = set(rng.sample(range(args.revisions + 1), min(args.checks, args.revisions + 1)))
+    expected = {}
+    full_copy_bytes = ops_bytes = 0
+    cursor = 0
+
+    started = time.perf_counter()
+    store.append(0, text)
+    for revision in range(1, args.revisions + 1):
+        ops, cursor = random_edit(rng, len(text), cursor, doc_size)
+        text = text.apply(ops)
+        store.append(revision, text, ops)
+        full_copy_bytes += len(text)  # ASCII: one byte per char
+        ops_bytes += len(json.dumps(ops))
+        if revision in checked:
+            expected[revision] = text
+    queued = time.perf_counter() - started
+    store.flush()
+    written = time.perf_counter() - started
+    data_bytes, index_bytes = store.sizes()
+
+    reads = []
+    for revision in (rng.randint(0, args.revisions) for _ in range(args.reads)):
+        read_started = time.perf_counter()
+        store.read(revision)
+        reads.append(time.perf_counter() - read_started)
+    correct = all(str(store.read(revision)["content"]) == str(text) for revision, text in expected.items())
+    read_started = time.perf_counter()
+    store.read(at=time.time())
+    at_ms = (time.perf_counter() - read_started) * 1000
+    store.close()
+    return {
+        "doc_size": doc_size,
+        "revisions": args.revisions,
+        "appends_per_s": args.revisions / queued,
+        "written_per_s": args.revisions / written,
+        "data_bytes": data_bytes,
+        "index_bytes": index_bytes,
+        "full_copy_bytes": full_copy_bytes,
+        "ops_json_bytes": ops_bytes,
+        "read_ms": {"p50": percentile(reads, 0.5) * 1000, "p99": percentile(reads, 0.99) * 1000,
+                    "max": max(reads) * 1000},
+        "read_at_ms": at_ms,
+        "correct": correct,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Revision history benchmark")
+    parser.add_argument("--revisions", type=int, default=100_000)
+    parser.add_argument("--doc-sizes", type=int, nargs="+", default=[5_000, 100_000],
+                        help="starting document sizes (chars); edits keep it near this size")
+    parser.add_argument("--reads", type=int, default=500, help="random revisions rebuilt per run")
+    parser.add_argument("--checks", type=int, default=50, help="revisions compared against the real text")
+    parser.add_argument("--interval", type=float, default=0.005, help="group commit interval (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", default=None, help="scratch directory (default: system temp)")
+    parser.add_argument("--output", help="JSON results file (not written by default)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_history_", dir=args.dir)
+    committer = GroupCommitter(args.interval)
+    results = []
+    try:
+        print(f"{'doc size':>9} {'revisions':>10} {'appends/s':>10} {'written/s':>10} {'on disk':>10} "
+              f"{'full copies':>12} {'ops JSON':>10} {'read p50':>9} {'p99':>8} {'max':>8} {'at':>7}  correct")
+        for doc_size in args.doc_sizes:
+            result = run(os.path.join(root, f"doc{doc_size}"), committer, args, doc_size)
+            results.append(result)
+            read = result["read_ms"]
+            print(f"{doc_size:>9} {result['revisions']:>10} {result['appends_per_s']:>10,.0f} "
+                  f"{result['written_per_s']:>10,.0f} {fmt_bytes(result['data_bytes'] + result['index_bytes']):>10} "
+                  f"{fmt_bytes(result['full_copy_bytes']):>12} {fmt_bytes(result['ops_json_bytes']):>10} "
+                  f"{read['p50']:>7.2f}ms {read['p99']:>6.2f}ms {read['max']:>6.2f}ms "
+                  f"{result['read_at_ms']:>5.2f}ms  {result['correct']}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "runs": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+def fmt_bytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024 or unit == "GB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+
+
+if __name__ == "__main__":
+    main()
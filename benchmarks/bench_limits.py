@@ -0,0 +1,205 @@
+# benchmarks/bench_limits.py
+# Inbound limits (utils/ratelimit.py, the frame size cap): what they cost per message,
+# and what they buy when a client misbehaves.
+#
+# Run from the repository root:  python -m benchmarks.bench_limits
+#   python -m benchmarks.bench_limits --users 20 --flooders 2 --duration 10 --async
+#
+# Part 1 times RateLimiter.check() in-process, next to decoding a typical EDIT_OP.
+# Part 2 starts a server (as bench_e2e does) with the limits on, then again with
+# NOTEPAD_RATE_LIMITS=0. --users simulated users type on the shared document while
+# --flooders logged-in clients send CHAT as fast as their sockets take it; then one
+# client announces a 2 GB frame. It reports the users' edit latency, how many of them
+# the server had to drop (outbound queue over budget), the server's peak memory and
+# how quickly the oversized frame was refused.
+import argparse
+import json
+import tempfile
+import threading
+import time
+
+from benchmarks.bench_e2e import (
+    ProcessSampler, SimulatedUser, edit_latencies, fetch_server_metrics, fmt, log_in_users, percentile,
+    start_server, stop_server,
+)
+from utils.headless_client import HeadlessClient
+from utils.protocol_helpers import HEADER, LENGTH_MASK, decode_body, encode_frame
+from utils.ratelimit import RateLimiter
+
+EDIT_OP = {"type": "EDIT_OP", "doc_id": "master_doc", "ops": [{"op": "insert", "pos": 1234, "text": "a"}],
+           "version": 5678, "session_id": "0123456789abcdef0123456789abcdef"}
+UNLIMITED = (1e12, 1e12)
+
+
+# --- Part 1: per-message cost ---
+def time_per_call(function, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - started) / calls
+
+
+def measure_check_cost(calls):
+    admitting = RateLimiter({"EDIT_OP": UNLIMITED}, UNLIMITED, UNLIMITED)
+    refusing = RateLimiter({"EDIT_OP": (1e-9, 1)}, UNLIMITED, UNLIMITED)
+    refusing.check("EDIT_OP", 100)
+    _, body = encode_frame(EDIT_OP)
+    return {
+        "check_admitted_ns": time_per_call(lambda: admitting.check("EDIT_OP", 100), calls) * 1e9,
+        "check_refused_ns": time_per_call(lambda: refusing.check("EDIT_OP", 100), calls) * 1e9,
+        "decode_edit_op_ns": time_per_call(lambda: decode_body(body, False), calls) * 1e9,
+    }
+
+
+# --- Part 2: a server under a flood ---
+class Flooder(threading.Thread):
+    """Sends CHAT in a tight loop until stopped or disconnected."""
+
+    def __init__(self, client):
+        super().__init__(daemon=True)
+        self.client = client
+        self.stop = threading.Event()
+        self.sent = 0
+
+    def run(self):
+        message = {"type": "CHAT", "text": "x" * 100, "session_id": self.client.session_id}
+        try:
+            while not self.stop.is_set() and self.client.connected:
+                self.client.send(message)
+                self.sent += 1
+        except OSError:
+            pass
+
+
+def log_in(port, name):
+    client = HeadlessClient("127.0.0.1", port)
+    client.connect()
+    client.signup(name, "floodpass")
+    reply = client.login(name, "floodpass")
+    if not reply or reply.get("type") != "AUTH_SUCCESS":
+        raise SystemExit(f"login failed for {name}: {reply}")
+    return client
+
+
+def refuse_oversized(port, name):
+    """Announces a 2 GB frame after logging in. Returns ms until the server closed the connection."""
+    client = log_in(port, name)
+    started = time.perf_counter()
+    client.sock.sendall(HEADER.pack(LENGTH_MASK) + b"{" * 1024)
+    deadline = time.monotonic() + 10
+    while client.connected and time.monotonic() < deadline:
+        time.sleep(0.001)
+    closed = not client.connected
+    client.close()
+    return (time.perf_counter() - started) * 1000 if closed else None
+
+
+def run(args, limits):
+    env = {"NOTEPAD_RATE_LIMITS": "1" if limits else "0", "NOTEPAD_METRICS_PORT": "0"}
+    with tempfile.TemporaryDirectory(prefix="notepad-limits-", dir=args.dir) as workdir:
+        server = start_server(workdir, args.port, args.use_async, args.bcrypt_rounds, extra_env=env)
+        sampler = ProcessSampler(server.pid)
+        sampler.start()
+        try:
+            clients = log_in_users(args)
+            flooders = [Flooder(log_in(args.port, f"flooder{i}")) for i in range(args.flooders)]
+            users = [SimulatedUser(client, args, args.seed + i) for i, client in enumerate(clients)]
+            received_before = [c.messages_received for c in clients]
+            started = time.perf_counter()
+            for thread in users + flooders:
+                thread.start()
+            time.sleep(args.duration)
+            for thread in users + flooders:
+                thread.stop.set()
+            for thread in users + flooders:
+                thread.join(5)
+            elapsed = time.perf_counter() - started
+            time.sleep(1.0)  # Let the last broadcasts arrive
+            received = [c.messages_received - before for c, before in zip(clients, received_before)]
+            dropped = sum(not c.connected for c in clients)
+            flooders_dropped = sum(not f.client.connected for f in flooders)
+            throttled_notices = sum(f.client.throttled for f in flooders)
+            oversized_ms = refuse_oversized(args.port, "oversized")
+            rss_after_oversized = sampler.rss_kb()
+            server_metrics = fetch_server_metrics(args) or {}
+            for client in clients + [f.client for f in flooders]:
+                client.close()
+        finally:
+            sampler.stop.set()
+            stop_server(server)
+
+    latencies = edit_latencies(clients)
+    return {
+        "limits": limits,
+        "elapsed_seconds": elapsed,
+        "flood_sent_per_s": sum(f.sent for f in flooders) / elapsed,
+        "received_per_user_per_s": sum(received) / len(clients) / elapsed if clients else 0,
+        "throttled": server_metrics.get("messages_throttled"),
+        "throttled_notices": throttled_notices,
+        "users_dropped": dropped,
+        "flooders_dropped": flooders_dropped,
+        "edit_latency_ms": {"samples": len(latencies), "p50": percentile(latencies, 0.5),
+                            "p99": percentile(latencies, 0.99)},
+        "server_rss_kb": {"peak": sampler.peak_rss_kb, "after_oversized_frame": rss_after_oversized},
+        "oversized_frame_closed_ms": oversized_ms,
+        "frames_too_large": server_metrics.get("frames_too_large"),
+        "handle_edit_op_ms_p50": (server_metrics.get("handle_seconds{type=EDIT_OP}") or {}).get("p50", 0) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inbound limits benchmark")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--flooders", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per run")
+    parser.add_argument("--type-rate", type=float, default=5.0, help="keystrokes per second per user")
+    parser.add_argument("--chat-rate", type=float, default=0.2, help="chat messages per second per user")
+    parser.add_argument("--save-rate", type=float, default=0.0, help="saves per second per user")
+    parser.add_argument("--max-doc-size", type=int, default=5000, help="users start deleting above this length")
+    parser.add_argument("--presence", action="store_true", help="users also send their caret")
+    parser.add_argument("--calls", type=int, default=500_000, help="calls per in-process timing")
+    parser.add_argument("--skip-server", action="store_true", help="only run the in-process timings")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the asyncio server")
+    parser.add_argument("--port", type=int, default=8092)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", default=None, help="scratch directory (default: system temp)")
+    parser.add_argument("--output", help="JSON results file (not written by default)")
+    args = parser.parse_args()
+
+    cost = measure_check_cost(args.calls)
+    print(f"RateLimiter.check(): {cost['check_admitted_ns']:.0f} ns admitted, {cost['check_refused_ns']:.0f} ns "
+          f"refused; decoding one EDIT_OP takes {cost['decode_edit_op_ns']:.0f} ns "
+          f"(check = {cost['check_admitted_ns'] / cost['decode_edit_op_ns']:.0%} of it)")
+
+    runs = []
+    if not args.skip_server:
+        mode = "async" if args.use_async else "threaded"
+        print(f"\n{mode} server, {args.users} users typing, {args.flooders} flooding CHAT, {args.duration:.0f}s per run")
+        print(f"{'limits':>6} {'flood/s':>9} {'recv/user/s':>12} {'throttled':>10} {'notices':>8} "
+              f"{'flooders/users dropped':>23} {'edit p50':>9} {'p99':>8} {'RSS peak':>10} {'2 GB frame':>18}")
+        for limits in (True, False):
+            result = run(args, limits)
+            runs.append(result)
+            latency = result["edit_latency_ms"]
+            closed = result["oversized_frame_closed_ms"]
+            print(f"{'on' if limits else 'off':>6} {result['flood_sent_per_s']:>9,.0f} "
+                  f"{result['received_per_user_per_s']:>12,.0f} {fmt(result['throttled'], ',')!s:>10} "
+                  f"{result['throttled_notices']:>8} {result['flooders_dropped']:>12}/{args.flooders} "
+                  f"{result['users_dropped']:>4}/{args.users:<4} "
+                  f"{fmt(latency['p50']):>7}ms {fmt(latency['p99']):>6}ms "
+                  f"{fmt(result['server_rss_kb']['peak'], ',')!s:>7} kB "
+                  f"{'closed in ' + fmt(closed) + ' ms' if closed is not None else 'not closed':>18}")
+        handled_ms = runs[0]["handle_edit_op_ms_p50"]
+        if handled_ms:
+            print(f"check() is {cost['check_admitted_ns'] / 1e6 / handled_ms:.2%} of the server's median "
+                  f"EDIT_OP handling time ({handled_ms:.3f} ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "check_cost": cost, "runs": runs}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# benchmarks/bench_merge.py
+# Merge throughput of utils.merge_engine.MergeEngine with N concurrent editors.
+#
+# Run from the repository root:  python -m benchmarks.bench_merge
+#
+# Every editor keeps one op in flight based on the revision of its previous ack,
+# so each submitted op is transformed against the N-1 ops accepted meanwhile.
+import argparse
+import random
+import time
+
+from utils.merge_engine import MergeEngine
+from utils.operations import delete_op, insert_op
+
+
+def run(editors, total_ops, doc_size):
+    rng = random.Random(editors)
+    engine = MergeEngine("x" * doc_size, history_limit=max(1000, editors * 2))
+    base_revisions = [0] * editors
+
+    start = time.perf_counter()
+    for i in range(total_ops):
+        editor = i % editors
+        # Stay clear of the tail so positions are valid at any revision in flight.
+        pos = rng.randrange(0, len(engine.text) - editors)
+        if rng.random() < 0.8:
+            ops = [insert_op(pos, "a")]
+        else:
+            ops = [delete_op(pos, 1)]
+        revision, _ = engine.submit(base_revisions[editor], ops, origin=editor)
+        base_revisions[editor] = revision
+    elapsed = time.perf_counter() - start
+    return total_ops / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MergeEngine throughput benchmark")
+    parser.add_argument("--editors", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--ops", type=int, default=20000, help="ops submitted per run")
+    parser.add_argument("--doc-size", type=int, default=200_000, help="initial document length")
+    args = parser.parse_args()
+
+    print(f"{'editors':>8} {'ops':>8} {'ops/sec':>12}")
+    for editors in args.editors:
+        ops_per_sec = run(editors, args.ops, args.doc_size)
+        print(f"{editors:>8} {args.ops:>8} {ops_per_sec:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
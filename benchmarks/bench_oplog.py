@@ -0,0 +1,87 @@
+# benchmarks/bench_oplog.py
+# Append throughput of the write-ahead log (utils.oplog) with group commit, and
+# recovery time (snapshot + log tail replay) by tail length.
+#
+# Run from the repository root:  python -m benchmarks.bench_oplog
+#
+# Writes to a temporary directory; point --dir at the disk you care about, since
+# fsync cost is what group commit amortizes.
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+
+from utils.operations import insert_op
+from utils.oplog import DocumentLog, GroupCommitter
+
+
+def bench_append(directory, committer, threads, docs, edits_per_thread):
+    """Each thread appends single-character inserts to docs[i % len(docs)]."""
+    logs = [DocumentLog(f"{directory}/doc{i}", committer) for i in range(docs)]
+    for log in logs:
+        log.wait_durable(log.request_snapshot("", 0))
+
+    def worker(index):
+        log = logs[index % docs]
+        for n in range(edits_per_thread):
+            log.append(n + 1, ops=[insert_op(n, "x")])
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    queued = time.perf_counter() - start
+    for log in logs:
+        log.close()
+    durable = time.perf_counter() - start
+    return queued, durable
+
+
+def bench_recovery(directory, committer, tail):
+    log = DocumentLog(directory, committer)
+    log.request_snapshot("Welcome to the Collaborative Notepad!", 0)
+    for n in range(tail):
+        log.append(n + 1, ops=[insert_op(n, "x")])
+    log.close()
+
+    start = time.perf_counter()
+    _, revision = DocumentLog(directory, committer).recover()
+    elapsed = time.perf_counter() - start
+    assert revision == tail
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write-ahead log benchmark")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--docs", type=int, default=4, help="documents the threads write to")
+    parser.add_argument("--edits", type=int, default=5_000, help="edits appended per thread")
+    parser.add_argument("--interval", type=float, default=0.005, help="group commit interval (s)")
+    parser.add_argument("--tails", type=int, nargs="+", default=[100, 1_000, 10_000, 100_000])
+    parser.add_argument("--dir", default=None, help="scratch directory (default: system temp)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_oplog_", dir=args.dir)
+    committer = GroupCommitter(args.interval)
+    try:
+        print(f"{'threads':>8} {'docs':>5} {'edits':>9} {'queued/s':>12} {'durable/s':>12}")
+        for threads in args.threads:
+            total = threads * args.edits
+            queued, durable = bench_append(f"{root}/append{threads}", committer,
+                                           threads, args.docs, args.edits)
+            print(f"{threads:>8} {args.docs:>5} {total:>9} {total / queued:>12,.0f} {total / durable:>12,.0f}")
+
+        print()
+        print(f"{'tail':>9} {'recover ms':>11}")
+        for tail in args.tails:
+            elapsed = bench_recovery(f"{root}/recover{tail}", committer, tail)
+            print(f"{tail:>9} {elapsed * 1000:>11.1f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# benchmarks/bench_scaleout.py
+# Scale-out test: the same per-node load on 1, 2, 4, ... server processes joined by a backplane.
+#
+# From the repository root:
+#   python -m benchmarks.bench_scaleout --nodes 1,2,4 --users-per-node 20 --duration 20
+#   python -m benchmarks.bench_scaleout --async --nodes 1,2,4,8 --docs 16 --output results/scaleout.json
+#
+# For each node count K a broker (python -m utils.backplane) and K servers are
+# started in one scratch directory, sharing its documents/ folder and SQLite
+# database. --docs documents are created round-robin across the nodes, so each
+# node owns its share. users-per-node x K users then connect, user j to node j % K
+# and document (j // K) % docs, so every document has editors on several nodes and
+# most edits cross the backplane: the worst case for scale-out, not the best.
+# With enough cores, acked edits/s should grow with K while latency stays flat.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_e2e import (
+    ADMIN_PASSWORD, ADMIN_USER, REPO_ROOT, SERVER_START_TIMEOUT, ProcessSampler, SimulatedUser,
+    edit_latencies, fmt, git_revision, percentile, start_server, stop_server,
+)
+from utils.headless_client import HeadlessClient
+
+
+# --- Cluster processes ---
+def start_broker(workdir):
+    address = f"unix:{os.path.join(workdir, 'backplane.sock')}"
+    log = open(os.path.join(workdir, "broker.log"), "w")
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, PYTHONUNBUFFERED="1")
+    process = subprocess.Popen([sys.executable, "-m", "utils.backplane", address], cwd=REPO_ROOT, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while not os.path.exists(address[len("unix:"):]):
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise SystemExit(f"backplane broker did not start; see {log.name}")
+        time.sleep(0.05)
+    return process, address
+
+
+def start_nodes(args, workdir, count, address):
+    servers = []
+    for i in range(count):
+        env = {"NOTEPAD_BACKPLANE": address, "NOTEPAD_NODE_ID": f"node{i}", "NOTEPAD_METRICS_PORT": "0"}
+        servers.append(start_server(workdir, args.port + i, args.use_async, args.bcrypt_rounds,
+                                    extra_env=env, log_name=f"server{i}.log"))
+    return servers
+
+
+def create_documents(args, count):
+    """Creates the benchmark documents, document d through node d % count. Returns their IDs."""
+    doc_ids = [f"scale-{d}" for d in range(args.docs)]
+    for node in range(count):
+        admin = HeadlessClient("127.0.0.1", args.port + node)
+        admin.connect()
+        try:
+            admin.login(ADMIN_USER, ADMIN_PASSWORD)
+            for doc_id in doc_ids[node::count]:
+                if not admin.create(doc_id):
+                    raise SystemExit(f"could not create {doc_id} on node {node}")
+        finally:
+            admin.close()
+    return doc_ids
+
+
+def log_in_users(args, count, doc_ids):
+    """Returns {doc_id: [clients]}, user j on node j % count editing document (j // count) % docs."""
+    groups = {doc_id: [] for doc_id in doc_ids}
+    for j in range(args.users_per_node * count):
+        client = HeadlessClient("127.0.0.1", args.port + j % count)
+        client.connect()
+        name = f"scaleuser{j}"
+        client.signup(name, "loadpass")
+        reply = client.login(name, "loadpass")
+        if not reply or reply.get("type") != "AUTH_SUCCESS":
+            raise SystemExit(f"login failed for {name}: {reply}")
+        doc_id = doc_ids[(j // count) % len(doc_ids)]
+        if not client.open(doc_id):
+            raise SystemExit(f"{name} could not open {doc_id}")
+        groups[doc_id].append(client)
+    return groups
+
+
+# --- One run ---
+def run(args, count):
+    with tempfile.TemporaryDirectory(prefix="notepad-scaleout-") as workdir:
+        broker, address = start_broker(workdir)
+        servers = []
+        try:
+            servers = start_nodes(args, workdir, count, address)
+            samplers = [ProcessSampler(process.pid) for process in servers + [broker]]
+            doc_ids = create_documents(args, count)
+            groups = log_in_users(args, count, doc_ids)
+            clients = [client for group in groups.values() for client in group]
+
+            users = [SimulatedUser(client, args, args.seed + i) for i, client in enumerate(clients)]
+            received_before = sum(c.messages_received for c in clients)
+            cpu_before = [s.cpu_seconds() for s in samplers]
+            started = time.perf_counter()
+            for user in users:
+                user.start()
+            time.sleep(args.duration)
+            for user in users:
+                user.stop.set()
+            for user in users:
+                user.join(5)
+            time.sleep(1.0)  # Let the last broadcasts cross the backplane
+            elapsed = time.perf_counter() - started
+            cpu_after = [s.cpu_seconds() for s in samplers]
+            received = sum(c.messages_received for c in clients) - received_before
+            converged = all(len({c.text for c in group if c.connected}) <= 1 for group in groups.values())
+            disconnected = sum(not c.connected for c in clients)
+            for client in clients:
+                client.close()
+        finally:
+            for process in servers:
+                stop_server(process)
+            stop_server(broker)
+
+    # Revisions are numbered per document, so latencies are matched within each group.
+    latencies = [ms for group in groups.values() for ms in edit_latencies(group)]
+    cpu = [(after - before) / elapsed * 100 if before is not None and after is not None else None
+           for before, after in zip(cpu_before, cpu_after)]
+    edits = sum(len(c.sent_at) for c in clients)
+    return {
+        "nodes": count,
+        "users": len(clients),
+        "elapsed_seconds": elapsed,
+        "edits_acked": edits,
+        "edits_acked_per_s": edits / elapsed,
+        "messages_received_per_s": received / elapsed,
+        "edit_latency_ms": {"samples": len(latencies), "p50": percentile(latencies, 0.5),
+                            "p99": percentile(latencies, 0.99), "max": max(latencies, default=None)},
+        "server_cpu_percent": cpu[:-1],
+        "broker_cpu_percent": cpu[-1],
+        "resyncs": sum(c.resyncs for c in clients),
+        "disconnected_users": disconnected,
+        "converged": converged,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scale-out test across server processes sharing a backplane")
+    parser.add_argument("--nodes", default="1,2,4", help="comma-separated node counts to run")
+    parser.add_argument("--users-per-node", type=int, default=10)
+    parser.add_argument("--docs", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds of load per node count")
+    parser.add_argument("--type-rate", type=float, default=5.0, help="keystrokes per second per user")
+    parser.add_argument("--chat-rate", type=float, default=0.2, help="chat messages per second per user")
+    parser.add_argument("--save-rate", type=float, default=0.02, help="saves per second per user")
+    parser.add_argument("--max-doc-size", type=int, default=5000, help="users start deleting above this length")
+    parser.add_argument("--presence", action="store_true", help="send the caret after every keystroke, like client.py")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the asyncio server")
+    parser.add_argument("--port", type=int, default=8150, help="first node's port; node i listens on port + i")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="JSON results file (not written by default)")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs; {args.users_per_node} users per node, {args.docs} documents, "
+          f"{args.duration:.0f}s per run")
+    print(f"{'nodes':>5} {'users':>6} {'edits/s':>9} {'msgs in/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'server CPU%':>12} {'broker CPU%':>12}  converged")
+    runs = []
+    for count in (int(n) for n in args.nodes.split(",")):
+        result = run(args, count)
+        runs.append(result)
+        latency = result["edit_latency_ms"]
+        server_cpu = sum(c for c in result["server_cpu_percent"] if c is not None)
+        print(f"{count:>5} {result['users']:>6} {result['edits_acked_per_s']:>9.0f} "
+              f"{result['messages_received_per_s']:>10.0f} {fmt(latency['p50']):>8} {fmt(latency['p99']):>8} "
+              f"{server_cpu:>12.1f} {fmt(result['broker_cpu_percent']):>12}  {result['converged']}")
+        if result["resyncs"] or result["disconnected_users"]:
+            print(f"      resyncs {result['resyncs']}   disconnected users {result['disconnected_users']}")
+
+    if args.output:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"params": {k: v for k, v in vars(args).items() if k != "output"},
+                       "git_revision": git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "cpu_count": os.cpu_count(), "runs": runs}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,16 @@
 import tkinter as tk
 from tkinter import scrolledtext, simpledialog
 from tkinter import messagebox as mb
+import queue
+import random
 import socket
 import threading
 import time
-from utils.protocol_helpers import send_message, recv_message
+from collections import deque
+from utils.protocol_helpers import (
+    JSON_CODEC, CODECS, FrameReader, ProtocolError, encode_frame, send_buffers, supported_codecs
+)
+from utils.operations import apply_ops, compute_ops, transform
 
 # --- Configuration and State ---
 HOST = '127.0.0.1'
@@ -13,6 +19,95 @@ PORT = 8080
 GLOBAL_USER_ID = "UNAUTHENTICATED"
 GLOBAL_SESSION_ID = None
 client_socket = None
+socket_writer = None  # SocketWriter for client_socket
+
+# Automatic reconnect after a dropped connection (exponential backoff with jitter).
+RECONNECT_INITIAL_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+CONNECT_TIMEOUT = 5.0
+
+# Inbox draining: at most INBOX_BATCH_SIZE messages per Tk tick, so a burst of
+# updates never freezes the UI; a full batch schedules the next tick right away.
+INBOX_BATCH_SIZE = 200
+INBOX_POLL_MS = 50
+
+FULL_STATE_TYPES = ("DOC_STATE", "EDIT_UPDATE")
+
+# Local edits are batched for an adaptive window before they are sent: half the
+# smoothed EDIT_OP -> EDIT_ACK round trip, kept within these bounds.
+EDIT_WINDOW_MIN_MS = 30
+EDIT_WINDOW_MAX_MS = 100
+RTT_SMOOTHING = 0.2  # weight of the newest sample in the moving average
+TRAFFIC_REFRESH_MS = 1000
+# Our caret goes out at most this often, and only when it moved; other users'
+# carets come back as one PRESENCE frame per server tick.
+PRESENCE_INTERVAL_MS = 100
+# Chat pane: lines arriving in one tick are inserted together. At most
+# CHAT_MAX_LINES stay in the widget while it shows the newest; older messages are
+# dropped and fetched again, CHAT_PAGE_SIZE at a time, when the user scrolls to the top.
+CHAT_MAX_LINES = 500
+CHAT_PAGE_SIZE = 50
+
+# Wire format for outgoing messages, chosen by the server in HELLO_ACK.
+# The server decodes every codec, so switching mid-stream is safe.
+wire_codec = JSON_CODEC
+wire_compress = False
+
+
+class SocketWriter:
+    """
+    Sends messages from a background thread, so the Tk thread never blocks on the
+    socket. Counts what it sends for the status bar.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue = queue.Queue()
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, message_dict):
+        self.queue.put(message_dict)
+
+    def close(self):
+        """Closes the socket once everything queued before this call is sent."""
+        self.queue.put(None)
+
+    def _run(self):
+        while True:
+            message_dict = self.queue.get()
+            if message_dict is None:
+                break
+            buffers = encode_frame(message_dict, wire_codec, wire_compress)
+            try:
+                send_buffers(self.sock, buffers)
+            except OSError:
+                break  # The listener thread notices the closed socket and reports it
+            self.messages_sent += 1
+            self.bytes_sent += len(buffers[0]) + len(buffers[1])
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def send_to_server(message_dict):
+    if socket_writer:
+        socket_writer.send(message_dict)
+
+
+def attach_socket(sock):
+    """Makes sock the server connection, speaking plain JSON until HELLO_ACK."""
+    global client_socket, socket_writer, wire_codec, wire_compress
+    wire_codec, wire_compress = JSON_CODEC, False
+    client_socket = sock
+    socket_writer = SocketWriter(sock)
+
+
+def _changed_chars(ops):
+    return sum(len(op["text"]) if op["op"] == "insert" else op["length"] for op in ops)
 
 
 class NotepadClientApp:
@@ -23,7 +118,39 @@ class NotepadClientApp:
         self.master = master
         master.title("Collaborative Notepad")
 
-        self.message_queue = []
+        self.message_queue = queue.Queue()  # filled by the listener thread, drained on the Tk thread
+
+        # Delta editing state (client half of the server's MergeEngine):
+        # shadow_text is the widget text as of the last diff, doc_version the last server
+        # revision seen and server_text the text at it. One EDIT_OP (outstanding_ops) is in
+        # flight at a time; edits made meanwhile accumulate in buffered_ops and are sent
+        # when the ack arrives.
+        self.doc_id = None  # Document currently open; set by DOC_STATE
+        self.shadow_text = ""
+        self.server_text = ""
+        self.doc_version = 0
+        self.outstanding_ops = None
+        self.buffered_ops = []
+        # A large DOC_STATE arrives in DOC_CHUNKs: {"chunks", "length", "switching", "status"} until the last one.
+        self.loading_state = None
+
+        self.reconnecting = False  # a background thread is trying to resume the session
+        self.resuming = False  # RESUME sent, waiting for RESUMED or AUTH_FAIL
+
+        # Outbound edit batching: on_text_change only schedules a flush edit_window_ms out.
+        self.edit_window_ms = EDIT_WINDOW_MIN_MS
+        self.edit_flush_job = None  # pending Tk `after` id
+        self.edit_retry_job = None  # after THROTTLED: `after` id that sends edits again
+        self.edit_sent_at = None  # when the outstanding EDIT_OP was sent, for the RTT
+        self.ack_rtt = None  # smoothed EDIT_OP -> EDIT_ACK round trip, seconds
+        self.traffic_baseline = (None, 0, 0)  # (writer, messages_sent, bytes_sent) at last refresh
+
+        # Live cursors: other users' carets and selections are Tk tags on the text,
+        # so they move with edits and are redrawn only when a PRESENCE moves them.
+        self.presence_id = None  # our own ID, from the first PRESENCE of a document
+        self.remote_cursors = {}  # {presence ID: user} with tags configured
+        self.presence_job = None  # pending Tk `after` id
+        self.presence_sent = None  # (doc_id, cursor, selection) last sent
 
         # --- Top Button Frame ---
         button_frame = tk.Frame(master)
@@ -33,6 +160,11 @@ class NotepadClientApp:
         self.save_btn.pack(side=tk.LEFT, padx=5)
         self.new_btn = tk.Button(button_frame, text="New File", command=self.send_new_file_command, state=tk.DISABLED)
         self.new_btn.pack(side=tk.LEFT, padx=5)
+        self.open_btn = tk.Button(button_frame, text="Open File", command=self.send_list_command, state=tk.DISABLED)
+        self.open_btn.pack(side=tk.LEFT, padx=5)
+        self.history_btn = tk.Button(button_frame, text="History", command=self.send_history_command, state=tk.DISABLED)
+        self.history_btn.pack(side=tk.LEFT, padx=5)
+        self.history_window = None  # Toplevel listing revisions, with its listbox and paging state
 
         self.signup_btn = tk.Button(button_frame, text="Sign Up", command=self.open_signup_dialog, state=tk.DISABLED)
         self.signup_btn.pack(side=tk.RIGHT, padx=5)
@@ -43,12 +175,22 @@ class NotepadClientApp:
         self.text_area = scrolledtext.ScrolledText(master, wrap=tk.WORD, undo=True, state=tk.DISABLED)
         self.text_area.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
         self.text_area.bind('<KeyRelease>', self.on_text_change)
+        self.text_area.bind('<ButtonRelease-1>', self.schedule_presence)
 
         # --- Chat Section ---
         chat_frame = tk.LabelFrame(master, text="Real-Time Chat & Notifications")
         chat_frame.pack(padx=10, pady=5, fill='x')
         self.chat_area = scrolledtext.ScrolledText(chat_frame, wrap=tk.WORD, height=6, state=tk.DISABLED, bg='#f0f0f0')
         self.chat_area.pack(padx=5, pady=5, fill=tk.X)
+        self.chat_area.configure(yscrollcommand=self._on_chat_scroll)
+        self.chat_pending = []  # (ts, user, text, from server) not yet in the widget
+        self.chat_flush_job = None  # pending Tk `after_idle` id
+        self.chat_tags = set()  # user tags already configured
+        self.chat_shown = deque()  # (server ts or None, lines) per message in the widget, oldest first
+        self.chat_lines = 0
+        self.chat_doc_id = None  # document whose chat history is shown
+        self.chat_has_more = False  # the server has older messages than the widget
+        self.chat_loading = False  # CHAT_HISTORY for older messages in flight
 
         chat_input_frame = tk.Frame(chat_frame)
         chat_input_frame.pack(fill='x', padx=5, pady=5)
@@ -64,11 +206,14 @@ class NotepadClientApp:
         status_frame.pack(fill='x', padx=10)
         self.status_label = tk.Label(status_frame, text="Status: Disconnected", fg="red")
         self.status_label.pack(side=tk.LEFT)
+        self.traffic_label = tk.Label(status_frame, text="", fg="gray")
+        self.traffic_label.pack(side=tk.LEFT, padx=10)
 
         self.connect_button = tk.Button(status_frame, text="Connect to Server", command=self.start_socket_connection)
         self.connect_button.pack(side=tk.RIGHT)
 
-        self.master.after(100, self.process_incoming_messages)
+        self.master.after(INBOX_POLL_MS, self.process_incoming_messages)
+        self.master.after(TRAFFIC_REFRESH_MS, self.refresh_traffic)
 
     # --- UI State Management ---
     def set_app_state(self, is_authenticated):
@@ -78,6 +223,8 @@ class NotepadClientApp:
         self.send_btn.config(state=state)
         self.save_btn.config(state=state)
         self.new_btn.config(state=state)
+        self.open_btn.config(state=state)
+        self.history_btn.config(state=state)
 
     def set_connection_state(self, is_connected):
         state = tk.NORMAL if is_connected else tk.DISABLED
@@ -91,27 +238,192 @@ class NotepadClientApp:
             self.set_app_state(False)
 
     # --- Chat UI Helpers ---
-    def append_to_chat(self, text, user="SYSTEM", color="black"):
-        self.chat_area.config(state=tk.NORMAL)
-        user_tag = f"user_{user}"
+    def append_to_chat(self, text, user="SYSTEM", color="black", when=None):
+        """Queues a line; everything queued in one Tk tick goes into the widget together."""
+        self.chat_pending.append((time.time() if when is None else when, user, text, when is not None))
+        if self.chat_flush_job is None:
+            self.chat_flush_job = self.master.after_idle(self._flush_chat)
 
-        if user == "SYSTEM" or user == "NOTIFICATION":
-            display_color = "red" if user == "SYSTEM" else "darkorange"
-        elif user not in self.user_color_map:
-            color_index = hash(user) % len(self.USER_COLORS)
-            self.user_color_map[user] = self.USER_COLORS[color_index]
-            display_color = self.user_color_map[user]
-        else:
-            display_color = self.user_color_map[user]
-
-        self.chat_area.tag_config(user_tag, foreground=display_color)
+    def _chat_tag(self, user):
+        user_tag = f"user_{user}"
+        if user_tag not in self.chat_tags:
+            if user == "SYSTEM" or user == "NOTIFICATION":
+                display_color = "red" if user == "SYSTEM" else "darkorange"
+            else:
+                display_color = self._user_color(user)
+            self.chat_area.tag_config(user_tag, foreground=display_color)
+            self.chat_tags.add(user_tag)
+        return user_tag
+
+    def _chat_chunks(self, entries):
+        """Text and tag arguments for a single insert() of several messages."""
+        chunks = []
+        for ts, user, text, _ in entries:
+            chunks += [f"[{time.strftime('%H:%M:%S', time.localtime(ts))}] ", "time",
+                       f"<{user}>: ", self._chat_tag(user), f"{text}\n", ()]
+        return chunks
+
+    def _chat_line_counts(self, entries):
+        return [(ts if from_server else None, f"{text}".count("\n") + 1) for ts, _, text, from_server in entries]
+
+    def _flush_chat(self):
+        self.chat_flush_job = None
+        entries, self.chat_pending = self.chat_pending, []
+        at_bottom = self.chat_area.yview()[1] >= 1.0
+        self.chat_area.config(state=tk.NORMAL)
+        if entries:
+            self.chat_area.insert(tk.END, *self._chat_chunks(entries))
+        for shown in self._chat_line_counts(entries):
+            self.chat_shown.append(shown)
+            self.chat_lines += shown[1]
+        if at_bottom:
+            # Only while following the newest: someone reading older lines keeps them.
+            self._trim_chat()
+            self.chat_area.yview(tk.END)
+        self.chat_area.config(state=tk.DISABLED)
 
-        self.chat_area.insert(tk.END, f"[{time.strftime('%H:%M:%S')}] ", "time")
-        self.chat_area.insert(tk.END, f"<{user}>: ", user_tag)
-        self.chat_area.insert(tk.END, f"{text}\n")
+    def _trim_chat(self):
+        """Deletes the oldest messages beyond CHAT_MAX_LINES (call with the widget editable)."""
+        excess = 0
+        while self.chat_lines - excess > CHAT_MAX_LINES and len(self.chat_shown) > 1:
+            ts, lines = self.chat_shown.popleft()
+            excess += lines
+            self.chat_has_more = self.chat_has_more or ts is not None
+        if excess:
+            self.chat_area.delete('1.0', f'{excess + 1}.0')
+            self.chat_lines -= excess
+
+    def _on_chat_scroll(self, first, last):
+        self.chat_area.vbar.set(first, last)
+        if float(first) <= 0.0 and self.chat_has_more and not self.chat_loading:
+            self._request_older_chat()
+        elif float(last) >= 1.0 and self.chat_lines > CHAT_MAX_LINES and self.chat_flush_job is None:
+            self.chat_flush_job = self.master.after_idle(self._flush_chat)  # Back at the bottom: trims
+
+    def _request_older_chat(self):
+        oldest = next((ts for ts, _ in self.chat_shown if ts is not None), None)
+        if oldest is None or not (client_socket and GLOBAL_SESSION_ID):
+            return
+        self.chat_loading = True
+        send_to_server({"type": "CHAT_HISTORY", "before": oldest, "limit": CHAT_PAGE_SIZE,
+                        "session_id": GLOBAL_SESSION_ID})
+
+    def _receive_chat_history(self, message):
+        entries = [(m.get("ts"), m.get("user"), m.get("text"), True) for m in message.get("messages", [])]
+        if message.get("before") is None:
+            # Sent after login and OPEN: the document's recent chat, oldest first.
+            if self.chat_doc_id is not None and message.get("doc_id") != self.chat_doc_id:
+                self._clear_chat()
+            self.chat_doc_id = message.get("doc_id")
+            self.chat_has_more = message.get("has_more", False)
+            for ts, user, text, _ in entries:
+                self.append_to_chat(text, user=user, when=ts)
+            return
+        if message.get("doc_id") == self.chat_doc_id:
+            self.chat_has_more = message.get("has_more", False)
+            if entries:
+                self._prepend_chat(entries)
+        self.chat_loading = False  # After the view moved off the top, so this page does not ask for the next
+
+    def _prepend_chat(self, entries):
+        """Inserts older messages above the oldest shown, keeping the same lines in view."""
+        top_line = int(self.chat_area.index('@0,0').split('.')[0])
+        counts = self._chat_line_counts(entries)
+        added = sum(lines for _, lines in counts)
+        self.chat_area.config(state=tk.NORMAL)
+        self.chat_area.insert('1.0', *self._chat_chunks(entries))
+        self.chat_area.config(state=tk.DISABLED)
+        self.chat_shown.extendleft(reversed(counts))
+        self.chat_lines += added
+        self.chat_area.yview(f"{top_line + added}.0")
 
-        self.chat_area.yview(tk.END)
+    def _clear_chat(self):
+        self.chat_area.config(state=tk.NORMAL)
+        self.chat_area.delete('1.0', tk.END)
         self.chat_area.config(state=tk.DISABLED)
+        self.chat_shown.clear()
+        self.chat_lines = 0
+        self.chat_has_more = self.chat_loading = False
+
+    def _user_color(self, user):
+        if user not in self.user_color_map:
+            color_index = hash(user) % len(self.USER_COLORS)
+            self.user_color_map[user] = self.USER_COLORS[color_index]
+        return self.user_color_map[user]
+
+    # --- Document Helpers ---
+    def _tk_index(self, offset):
+        return f"1.0+{offset}c"
+
+    def _replace_document(self, new_content):
+        """Replaces the whole text widget, keeping the cursor and scroll position."""
+        previous_state = self.text_area.cget('state')
+        self.text_area.config(state=tk.NORMAL)
+        current_scroll_pos = self.text_area.yview()
+        current_index = self.text_area.index(tk.INSERT)
+        self.text_area.delete('1.0', tk.END)
+        self.text_area.insert(tk.END, new_content)
+        try:
+            self.text_area.mark_set(tk.INSERT, current_index)
+        except tk.TclError:
+            self.text_area.mark_set(tk.INSERT, tk.END)
+        self.text_area.yview_moveto(current_scroll_pos[0])
+        self.text_area.config(state=previous_state)
+
+    def _apply_remote_ops(self, ops):
+        """Patches only the affected ranges of the text widget."""
+        if not ops:
+            return
+        previous_state = self.text_area.cget('state')
+        self.text_area.config(state=tk.NORMAL)
+        # Separators keep remote changes out of the user's own undo steps.
+        self.text_area.edit_separator()
+        for op in ops:
+            start = self._tk_index(op["pos"])
+            if op["op"] == "insert":
+                self.text_area.insert(start, op["text"])
+            else:
+                self.text_area.delete(start, self._tk_index(op["pos"] + op["length"]))
+        self.text_area.edit_separator()
+        self.text_area.config(state=previous_state)
+
+    def _patch_document(self, new_content):
+        """Brings the widget to new_content by rewriting only the range that differs."""
+        current_content = self.text_area.get('1.0', 'end-1c')
+        self._apply_remote_ops(compute_ops(current_content, new_content))
+
+    def _collect_local_edits(self):
+        """Diffs the widget against shadow_text and buffers the resulting ops."""
+        current_content = self.text_area.get('1.0', 'end-1c')
+        self.buffered_ops.extend(compute_ops(self.shadow_text, current_content))
+        self.shadow_text = current_content
+
+    def _flush_buffered_ops(self):
+        """Sends buffered ops as one EDIT_OP unless another one is still awaiting its ack."""
+        if self.outstanding_ops is not None or not self.buffered_ops or self.resuming or self.edit_retry_job:
+            return
+        if not (client_socket and GLOBAL_SESSION_ID):
+            return
+        self.outstanding_ops, self.buffered_ops = self.buffered_ops, []
+        self.edit_sent_at = time.monotonic()
+        send_to_server({
+            "type": "EDIT_OP",
+            "doc_id": self.doc_id,
+            "ops": self.outstanding_ops,
+            "version": self.doc_version,
+            "session_id": GLOBAL_SESSION_ID
+        })
+
+    def _receive_remote_ops(self, ops):
+        """Transforms remote ops past our unacknowledged edits, then patches the widget."""
+        self._collect_local_edits()
+        self.server_text = apply_ops(self.server_text, ops)
+        if self.outstanding_ops is not None:
+            self.outstanding_ops, ops = transform(self.outstanding_ops, ops)
+        if self.buffered_ops:
+            self.buffered_ops, ops = transform(self.buffered_ops, ops)
+        self._apply_remote_ops(ops)
+        self.shadow_text = apply_ops(self.shadow_text, ops)
 
     # --- Authentication Dialogs (Fixed to Appear Above) ---
     def open_signup_dialog(self):
@@ -157,25 +469,24 @@ class NotepadClientApp:
         self._handle_auth_request(username, password, "LOGIN")
 
     def _handle_auth_request(self, username, password, type):
-        global client_socket
         if client_socket:
             threading.Thread(target=self._send_credentials, args=(username, password, type)).start()
             self.status_label.config(text=f"Status: Sending {type} request...", fg="orange")
 
     def _send_credentials(self, username, password, type):
-        global client_socket
         try:
-            send_message(client_socket, {"type": type, "user": username, "password": password})
+            send_to_server({"type": type, "user": username, "password": password})
         except Exception as e:
-            self.master.after(0, lambda: mb.showerror("Network Error", f"Failed to send request: {e}"))
+            self.master.after(0, lambda error=e: mb.showerror("Network Error", f"Failed to send request: {error}"))
 
     def logout(self):
-        global GLOBAL_SESSION_ID, GLOBAL_USER_ID, client_socket
+        global GLOBAL_SESSION_ID, GLOBAL_USER_ID
 
+        self.reconnecting = False
         if client_socket:
             if GLOBAL_SESSION_ID:
-                send_message(client_socket, {"type": "LOGOUT", "user": GLOBAL_USER_ID, "session_id": GLOBAL_SESSION_ID})
-            client_socket.close()
+                send_to_server({"type": "LOGOUT", "user": GLOBAL_USER_ID, "session_id": GLOBAL_SESSION_ID})
+            socket_writer.close()
 
         GLOBAL_SESSION_ID = None
         GLOBAL_USER_ID = "UNAUTHENTICATED"
@@ -184,21 +495,83 @@ class NotepadClientApp:
 
     # --- File and Chat Commands ---
     def send_save_command(self):
-        global GLOBAL_SESSION_ID, client_socket
         if client_socket and GLOBAL_SESSION_ID:
-            send_message(client_socket, {"type": "SAVE", "session_id": GLOBAL_SESSION_ID})
+            send_to_server({"type": "SAVE", "session_id": GLOBAL_SESSION_ID})
 
     def send_new_file_command(self):
-        global GLOBAL_SESSION_ID, client_socket
         if client_socket and GLOBAL_SESSION_ID:
-            send_message(client_socket, {"type": "NEW_FILE", "session_id": GLOBAL_SESSION_ID})
+            send_to_server({"type": "NEW_FILE", "session_id": GLOBAL_SESSION_ID})
+
+    def send_list_command(self):
+        if client_socket and GLOBAL_SESSION_ID:
+            send_to_server({"type": "LIST", "session_id": GLOBAL_SESSION_ID})
+
+    def send_history_command(self, before=None):
+        if client_socket and GLOBAL_SESSION_ID:
+            send_to_server({"type": "HISTORY", "before": before, "session_id": GLOBAL_SESSION_ID})
+
+    def show_history(self, message):
+        """Lists revisions from a HISTORY reply, newest first; "Older" asks for the page before."""
+        window = self.history_window
+        if window is None or not window.winfo_exists() or window.doc_id != message.get("doc_id"):
+            if window is not None and window.winfo_exists():
+                window.destroy()
+            window = self.history_window = tk.Toplevel(self.master)
+            window.title(f"History - {message.get('doc_id')}")
+            window.doc_id = message.get("doc_id")
+            window.revisions = []
+            window.listbox = tk.Listbox(window, width=40, height=20)
+            window.listbox.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+            window.listbox.bind('<Double-Button-1>', lambda event: self._request_selected_revision())
+            buttons = tk.Frame(window)
+            buttons.pack(fill='x', padx=10, pady=(0, 10))
+            window.older_btn = tk.Button(buttons, text="Older",
+                                         command=lambda: self.send_history_command(window.revisions[-1]["revision"]))
+            window.older_btn.pack(side=tk.LEFT)
+            tk.Button(buttons, text="View", command=self._request_selected_revision).pack(side=tk.RIGHT)
+        for entry in reversed(message.get("revisions", [])):
+            window.revisions.append(entry)
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry["ts"]))
+            window.listbox.insert(tk.END, f"Revision {entry['revision']}   {when}")
+        window.older_btn.config(state=tk.NORMAL if message.get("has_more") and window.revisions else tk.DISABLED)
+
+    def _request_selected_revision(self):
+        window = self.history_window
+        selection = window.listbox.curselection()
+        if selection and client_socket and GLOBAL_SESSION_ID:
+            revision = window.revisions[selection[0]]["revision"]
+            send_to_server({"type": "GET_REVISION", "revision": revision, "session_id": GLOBAL_SESSION_ID})
+
+    def show_revision(self, message):
+        """Shows a REVISION reply read-only; "Restore" makes it the document's text (an ordinary edit)."""
+        window = tk.Toplevel(self.master)
+        window.title(f"{message.get('doc_id')} - revision {message.get('revision')}")
+        view = scrolledtext.ScrolledText(window, wrap=tk.WORD, width=80, height=25)
+        view.insert('1.0', message.get("content", ""))
+        view.config(state=tk.DISABLED)
+        view.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+
+        def restore():
+            if message.get("doc_id") == self.doc_id and self.loading_state is None:
+                self._patch_document(message.get("content", ""))
+                self.on_text_change(None)
+            window.destroy()
+        tk.Button(window, text="Restore", command=restore).pack(pady=(0, 10))
+
+    def open_document_dialog(self, doc_ids):
+        """Asks which document to open (replying to DOC_LIST); unknown names are created."""
+        doc_id = simpledialog.askstring(
+            "Open File", "Documents:\n" + "\n".join(doc_ids) + "\n\nOpen or create:", parent=self.master)
+        if not doc_id or not (client_socket and GLOBAL_SESSION_ID):
+            return
+        msg_type = "OPEN" if doc_id in doc_ids else "CREATE"
+        send_to_server({"type": msg_type, "doc_id": doc_id, "session_id": GLOBAL_SESSION_ID})
 
     def send_chat(self, event=None):
-        global GLOBAL_SESSION_ID, client_socket
         if client_socket and GLOBAL_SESSION_ID:
             text = self.chat_input.get()
             if text.strip():
-                send_message(client_socket, {"type": "CHAT", "text": text, "session_id": GLOBAL_SESSION_ID})
+                send_to_server({"type": "CHAT", "text": text, "session_id": GLOBAL_SESSION_ID})
                 self.chat_input.delete(0, tk.END)
         return "break"
 
@@ -217,9 +590,10 @@ class NotepadClientApp:
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.connect((HOST, PORT))
-            client_socket = sock
+            attach_socket(sock)
 
-            send_message(client_socket, {"type": "HELLO"})
+            send_to_server({"type": "HELLO", "codecs": supported_codecs(), "compression": ["zlib"],
+                            "chunked_state": True})
             self.master.after(0, lambda: self.status_label.config(text="Status: Socket CONNECTED. Please log in.", fg="blue"))
             self.master.after(0, self.set_connection_state, True)
 
@@ -230,21 +604,87 @@ class NotepadClientApp:
             self.master.after(0, lambda: self.status_label.config(text=error_msg, fg="red"))
             client_socket = None
 
+    def _start_reconnect(self):
+        """Keeps the session and the editor; a background thread reconnects and resumes."""
+        self.reconnecting = True
+        self.append_to_chat("Connection lost. Reconnecting...", user="SYSTEM")
+        threading.Thread(target=self._reconnect_loop, daemon=True).start()
+
+    def _reconnect_loop(self):
+        delay = RECONNECT_INITIAL_DELAY
+        while self.reconnecting:
+            self.master.after(0, lambda d=delay: self.status_label.config(
+                text=f"Status: Connection lost. Reconnecting in {d:.1f}s...", fg="orange"))
+            time.sleep(delay * random.uniform(0.5, 1.0))  # Jitter keeps clients from reconnecting in lockstep
+            if not self.reconnecting:
+                return
+            try:
+                sock = socket.create_connection((HOST, PORT), timeout=CONNECT_TIMEOUT)
+                sock.settimeout(None)
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+
+            self.reconnecting = False
+            self.resuming = True
+            self.edit_sent_at = None  # An ack replayed after the gap says nothing about RTT
+            attach_socket(sock)
+            # The server replays what we missed since doc_version, or sends DOC_STATE.
+            send_to_server({"type": "RESUME", "session_id": GLOBAL_SESSION_ID, "doc_id": self.doc_id,
+                            "version": self.doc_version, "codecs": supported_codecs(), "compression": ["zlib"],
+                            "chunked_state": True})
+            self.master.after(0, lambda: self.status_label.config(text="Status: Resuming session...", fg="orange"))
+            threading.Thread(target=self._listen_to_server, daemon=True).start()
+            return
+
     # --- Listening Thread ---
     def _listen_to_server(self):
-        global client_socket
+        global wire_codec, wire_compress
+        reader = FrameReader(client_socket)
         while client_socket:
-            message = recv_message(client_socket)
+            try:
+                message = reader.read_message()
+            except ProtocolError:
+                message = None
             if message is None:
-                self.message_queue.append({"type": "DISCONNECT"})
+                self.message_queue.put({"type": "DISCONNECT"})
                 break
-            self.message_queue.append(message)
+            if message.get("type") == "HELLO_ACK":
+                wire_codec = CODECS.get(message.get("codec"), JSON_CODEC)
+                wire_compress = message.get("compression") == "zlib"
+                continue
+            self.message_queue.put(message)
+
+    def _next_batch(self):
+        """
+        Takes up to INBOX_BATCH_SIZE messages from the inbox and collapses runs of
+        document updates for the same document: only the last full state of a run
+        is rendered, and consecutive EDIT_OPs are merged into one patch.
+        """
+        batch = []
+        for _ in range(INBOX_BATCH_SIZE):
+            try:
+                message = self.message_queue.get_nowait()
+            except queue.Empty:
+                break
+            previous = batch[-1] if batch else None
+            msg_type = message.get("type")
+            if previous is not None and previous.get("doc_id") == message.get("doc_id") and not previous.get("more"):
+                if previous.get("type") in FULL_STATE_TYPES and msg_type in FULL_STATE_TYPES:
+                    # A DOC_STATE in the run may switch documents; keep that meaning.
+                    batch[-1] = dict(message, type="DOC_STATE") if "DOC_STATE" in (previous["type"], msg_type) else message
+                    continue
+                if previous.get("type") == "EDIT_OP" and msg_type == "EDIT_OP":
+                    batch[-1] = dict(message, ops=previous["ops"] + message.get("ops", []))
+                    continue
+            batch.append(message)
+        return batch
 
     def process_incoming_messages(self):
         global client_socket, GLOBAL_SESSION_ID, GLOBAL_USER_ID
 
-        while self.message_queue:
-            message = self.message_queue.pop(0)
+        batch = self._next_batch()
+        for message in batch:
             msg_type = message.get("type")
 
             if msg_type == "AUTH_SUCCESS":
@@ -258,49 +698,319 @@ class NotepadClientApp:
                     self.append_to_chat(message.get("message", "Sign up successful!"), user="SYSTEM")
 
             elif msg_type == "AUTH_FAIL":
+                if self.resuming:
+                    # Session expired while we were away: stay connected, log in again.
+                    self.resuming = False
+                    GLOBAL_SESSION_ID = None
+                    GLOBAL_USER_ID = "UNAUTHENTICATED"
+                    self.set_app_state(False)
                 error_msg = message.get("message", "Authentication failed.")
                 mb.showerror("Authentication Error", error_msg)
                 self.status_label.config(text="Status: Socket Connected (Auth Failed)", fg="blue")
 
+            elif msg_type in ["EDIT_OP", "EDIT_ACK", "EDIT_UPDATE"] and message.get("doc_id", self.doc_id) != self.doc_id:
+                continue  # Sent for the document we just left
+
             elif msg_type in ["DOC_STATE", "EDIT_UPDATE"]:
                 new_content = message.get("content", "")
-                current_scroll_pos = self.text_area.yview()
-                current_index = self.text_area.index(tk.INSERT)
-                self.text_area.delete('1.0', tk.END)
-                self.text_area.insert(tk.END, new_content)
-                try:
-                    self.text_area.mark_set(tk.INSERT, current_index)
-                except tk.TclError:
-                    self.text_area.mark_set(tk.INSERT, tk.END)
-                self.text_area.yview_moveto(current_scroll_pos[0])
+                switching = msg_type == "DOC_STATE" and message.get("doc_id", self.doc_id) != self.doc_id
+                self.loading_state = None
+                if switching:
+                    # Another document: start over, including the undo history.
+                    self.doc_id = message.get("doc_id", self.doc_id)
+                    self.master.title(f"Collaborative Notepad - {self.doc_id}")
+                    self._clear_remote_cursors()
+                    self._replace_document(new_content)
+                    self.text_area.edit_reset()
+                if message.get("more"):
+                    # A large document: the rest follows in DOC_CHUNKs.
+                    status = (self.status_label.cget("text"), self.status_label.cget("fg"))
+                    self.loading_state = {"chunks": [new_content], "length": message.get("length"),
+                                          "switching": switching, "status": status}
+                    self._show_loading_progress()
+                    continue
+                if switching:
+                    self._set_document_state(new_content, message.get("version", self.doc_version))
+                else:
+                    # A snapshot after RESUME (before RESUMED) or a resync: keep our edits.
+                    self._rebase_onto_state(new_content, message.get("version", self.doc_version))
+
+            elif msg_type == "DOC_CHUNK":
+                if self.loading_state is None or message.get("doc_id") != self.doc_id:
+                    continue
+                self._receive_chunk(message)
+
+            elif msg_type == "EDIT_OP":
+                self._receive_remote_ops(message.get("ops", []))
+                self.doc_version = message.get("version", self.doc_version)
+
+            elif msg_type == "EDIT_ACK":
+                if self.edit_sent_at is not None:
+                    self._record_ack_rtt(time.monotonic() - self.edit_sent_at)
+                    self.edit_sent_at = None
+                self.doc_version = message.get("version", self.doc_version)
+                if self.outstanding_ops is not None:
+                    self.server_text = apply_ops(self.server_text, self.outstanding_ops)
+                self.outstanding_ops = None
+                self._flush_buffered_ops()
+
+            elif msg_type == "PRESENCE":
+                if message.get("doc_id") == self.doc_id:
+                    self._receive_presence(message)
+
+            elif msg_type == "RESUMED":
+                self.resuming = False
+                self.presence_sent = None  # A new connection: the server does not know our caret
+                self.chat_loading = False  # A CHAT_HISTORY in flight was lost with the old one
+                GLOBAL_USER_ID = message.get("user", GLOBAL_USER_ID)
+                self.status_label.config(text=f"Status: Authenticated as {GLOBAL_USER_ID}", fg="green")
+                self.append_to_chat("Reconnected. Session resumed.", user="SYSTEM")
+                if self.outstanding_ops is not None:
+                    # Its ack was not replayed, so the server never got it: send it again.
+                    self.buffered_ops = self.outstanding_ops + self.buffered_ops
+                    self.outstanding_ops = None
+                self._collect_local_edits()  # Typed while disconnected
+                self._flush_buffered_ops()
+
+            elif msg_type == "DOC_LIST":
+                self.open_document_dialog(message.get("documents", []))
+
+            elif msg_type == "HISTORY":
+                self.show_history(message)
+
+            elif msg_type == "REVISION":
+                self.show_revision(message)
 
             elif msg_type == "CHAT_MESSAGE":
                 user = message.get("user")
                 text = message.get("text")
-                self.append_to_chat(text, user=user)
+                self.append_to_chat(text, user=user, when=message.get("ts"))
+
+            elif msg_type == "CHAT_HISTORY":
+                self._receive_chat_history(message)
 
             elif msg_type == "NOTIFICATION":
                 self.append_to_chat(message.get("message"), user="NOTIFICATION", color="darkorange")
 
+            elif msg_type == "THROTTLED":
+                self._receive_throttled(message)
+
             elif msg_type == "DISCONNECT":
+                client_socket = None
+                self.resuming = False
+                if GLOBAL_SESSION_ID and not self.reconnecting:
+                    self._start_reconnect()
+                    continue
                 self.status_label.config(text="Status: Server Disconnected", fg="red")
                 self.set_connection_state(False)
-                client_socket = None
                 GLOBAL_SESSION_ID = None
                 GLOBAL_USER_ID = "UNAUTHENTICATED"
 
-        self.master.after(100, self.process_incoming_messages)
+        delay = 1 if len(batch) == INBOX_BATCH_SIZE else INBOX_POLL_MS
+        self.master.after(delay, self.process_incoming_messages)
+
+    # --- Document State ---
+    def _set_document_state(self, content, version):
+        """Takes a full state from the server as the base for further edits."""
+        self.shadow_text = content
+        self.server_text = content
+        self.doc_version = version
+        self.outstanding_ops = None
+        self.buffered_ops = []
+
+    def _rebase_onto_state(self, content, version):
+        """
+        Takes a full state of the open document without losing local edits: the ones
+        the server has not acknowledged (sent, buffered, or still only in the widget)
+        are transformed past the changes it brings and buffered again.
+        """
+        self._collect_local_edits()
+        local = (self.outstanding_ops or []) + self.buffered_ops
+        remote = compute_ops(self.server_text, content)
+        if self.outstanding_ops:
+            # No ack says whether the in-flight EDIT_OP made it: if the state is closer to
+            # the text with it applied, it did, and must not be applied twice.
+            sent_text = apply_ops(self.server_text, self.outstanding_ops)
+            remote_after_sent = compute_ops(sent_text, content)
+            if _changed_chars(remote_after_sent) < _changed_chars(remote):
+                local, remote = self.buffered_ops, remote_after_sent
+        local, _ = transform(local, remote)
+        try:
+            text = apply_ops(content, local)
+        except ValueError:
+            local, text = [], content
+            self.append_to_chat("The document was reloaded from the server; your unsent edits "
+                                "could not be merged into it.", user="NOTIFICATION", color="darkorange")
+        self._patch_document(text)
+        self._set_document_state(content, version)
+        self.shadow_text, self.buffered_ops = text, local
+        self._flush_buffered_ops()  # Held back while resuming; RESUMED sends them
+
+    def _receive_chunk(self, message):
+        """
+        Adds one DOC_CHUNK. A newly opened document is shown as it arrives, and text
+        typed meanwhile is diffed against the full state afterwards. A resync of the
+        open one is applied once complete, with local edits rebased onto it.
+        """
+        loading = self.loading_state
+        content = message.get("content", "")
+        loading["chunks"].append(content)
+        if loading["switching"]:
+            previous_state = self.text_area.cget('state')
+            self.text_area.config(state=tk.NORMAL)
+            self.text_area.insert(tk.END + "-1c", content)
+            self.text_area.config(state=previous_state)
+        if message.get("more"):
+            self._show_loading_progress()
+            return
+        self.loading_state = None
+        new_content = "".join(loading["chunks"])
+        if loading["switching"]:
+            self.text_area.edit_reset()
+            self._set_document_state(new_content, message.get("version", self.doc_version))
+        else:
+            self._rebase_onto_state(new_content, message.get("version", self.doc_version))
+        text, color = loading["status"]
+        self.status_label.config(text=text, fg=color)
+        self.on_text_change(None)  # Sends whatever was typed while loading
+
+    def _show_loading_progress(self):
+        loading = self.loading_state
+        received = sum(len(chunk) for chunk in loading["chunks"])
+        percent = received * 100 // loading["length"] if loading["length"] else 100
+        self.status_label.config(text=f"Status: Loading {self.doc_id}... {percent}%", fg="orange")
 
     # --- Text Change Event ---
     def on_text_change(self, event):
-        global GLOBAL_SESSION_ID, client_socket
-        if client_socket and GLOBAL_SESSION_ID:
-            current_content = self.text_area.get('1.0', tk.END)
-            send_message(client_socket, {
-                "type": "EDIT",
-                "content": current_content,
-                "session_id": GLOBAL_SESSION_ID
-            })
+        # Keystrokes within the window go out as one EDIT_OP.
+        if client_socket and GLOBAL_SESSION_ID and self.edit_flush_job is None:
+            self.edit_flush_job = self.master.after(self.edit_window_ms, self._send_local_edits)
+        self.schedule_presence()
+
+    def _send_local_edits(self):
+        self.edit_flush_job = None
+        if client_socket and GLOBAL_SESSION_ID and self.loading_state is None:
+            self._collect_local_edits()
+            self._flush_buffered_ops()
+
+    def _receive_throttled(self, message):
+        """The server dropped one of our messages for sending too fast."""
+        retry_ms = max(1, int(message.get("retry_after", 0) * 1000))
+        if message.get("message_type") == "EDIT_OP":
+            # Not applied: send it again (with whatever was typed since) once allowed.
+            if self.outstanding_ops is not None:
+                self.buffered_ops = self.outstanding_ops + self.buffered_ops
+                self.outstanding_ops = None
+                self.edit_sent_at = None
+            if self.edit_retry_job is None:
+                self.edit_retry_job = self.master.after(retry_ms, self._retry_throttled_edits)
+        elif message.get("message_type") != "PRESENCE":
+            if message.get("message_type") == "CHAT_HISTORY":
+                self.chat_loading = False  # Scrolling to the top asks again
+            self.append_to_chat(f"Slow down: your {message.get('message_type')} was not sent "
+                                f"(try again in {retry_ms / 1000:.1f} s).", user="NOTIFICATION")
+
+    def _retry_throttled_edits(self):
+        self.edit_retry_job = None
+        self._flush_buffered_ops()
+
+    # --- Live Cursors ---
+    def schedule_presence(self, event=None):
+        if client_socket and GLOBAL_SESSION_ID and self.presence_job is None:
+            self.presence_job = self.master.after(PRESENCE_INTERVAL_MS, self._send_presence)
+
+    def _send_presence(self):
+        """Sends our caret and selection (chars into the text) if they changed since the last one."""
+        self.presence_job = None
+        if not (client_socket and GLOBAL_SESSION_ID and self.doc_id) or self.loading_state is not None:
+            return
+        cursor = self._offset(tk.INSERT)
+        selection = self.text_area.tag_ranges(tk.SEL)
+        selection = [self._offset(selection[0]), self._offset(selection[1])] if selection else None
+        if self.presence_sent == (self.doc_id, cursor, selection):
+            return
+        self.presence_sent = (self.doc_id, cursor, selection)
+        send_to_server({
+            "type": "PRESENCE",
+            "doc_id": self.doc_id,
+            "cursor": cursor,
+            "selection": selection,
+            "version": self.doc_version,
+            "session_id": GLOBAL_SESSION_ID
+        })
+
+    def _offset(self, index):
+        counted = self.text_area.count('1.0', index, 'chars')
+        return counted[0] if counted else 0
+
+    def _receive_presence(self, message):
+        if "you" in message:
+            self.presence_id = message["you"]
+        for entry in message.get("users", []):
+            if entry.get("id") != self.presence_id:
+                self._draw_remote_cursor(entry)
+        for presence_id in message.get("left", []):
+            self._remove_remote_cursor(presence_id)
+
+    def _draw_remote_cursor(self, entry):
+        """Moves one user's caret and selection tags; the rest of the text is untouched."""
+        presence_id = entry["id"]
+        cursor_tag, selection_tag = f"cursor-{presence_id}", f"sel-{presence_id}"
+        if presence_id not in self.remote_cursors:
+            color = self._user_color(entry.get("user"))
+            self.text_area.tag_configure(cursor_tag, background=color, foreground="white")
+            self.text_area.tag_configure(selection_tag, background=color, bgstipple="gray25")
+            for tag in (selection_tag, cursor_tag):
+                self.text_area.tag_lower(tag, tk.SEL)  # Our own selection stays on top
+            self.remote_cursors[presence_id] = entry.get("user")
+        self.text_area.tag_remove(cursor_tag, '1.0', tk.END)
+        self.text_area.tag_remove(selection_tag, '1.0', tk.END)
+        selection = entry.get("selection")
+        if selection:
+            self.text_area.tag_add(selection_tag, self._tk_index(min(selection)), self._tk_index(max(selection)))
+        # The caret is shown as the char after it, or the one before it at the end of a line.
+        index = self.text_area.index(self._tk_index(entry.get("cursor", 0)))
+        if self.text_area.compare(index, '==', f"{index} lineend"):
+            index = self.text_area.index(f"{index}-1c")
+        self.text_area.tag_add(cursor_tag, index)
+
+    def _remove_remote_cursor(self, presence_id):
+        if self.remote_cursors.pop(presence_id, None) is not None:
+            self.text_area.tag_delete(f"cursor-{presence_id}", f"sel-{presence_id}")
+
+    def _clear_remote_cursors(self):
+        for presence_id in list(self.remote_cursors):
+            self._remove_remote_cursor(presence_id)
+        self.presence_id = None
+        self.presence_sent = None
+
+    def _record_ack_rtt(self, rtt):
+        """Widens the edit batching window as the round trip to the server grows."""
+        if self.ack_rtt is None:
+            self.ack_rtt = rtt
+        else:
+            self.ack_rtt += RTT_SMOOTHING * (rtt - self.ack_rtt)
+        window_ms = int(self.ack_rtt * 1000 / 2)
+        self.edit_window_ms = max(EDIT_WINDOW_MIN_MS, min(EDIT_WINDOW_MAX_MS, window_ms))
+
+    def refresh_traffic(self):
+        """Shows messages and bytes sent per second in the status bar."""
+        writer, last_messages, last_bytes = self.traffic_baseline
+        if socket_writer is not writer:
+            last_messages = last_bytes = 0  # New connection, new counters
+        if socket_writer:
+            messages = socket_writer.messages_sent
+            sent_bytes = socket_writer.bytes_sent
+            seconds = TRAFFIC_REFRESH_MS / 1000
+            rtt = f"{self.ack_rtt * 1000:.0f} ms" if self.ack_rtt is not None else "-"
+            self.traffic_label.config(
+                text=f"↑ {(messages - last_messages) / seconds:.0f} msg/s, "
+                     f"{(sent_bytes - last_bytes) / seconds / 1024:.1f} KB/s | RTT {rtt}, batch {self.edit_window_ms} ms")
+            self.traffic_baseline = (socket_writer, messages, sent_bytes)
+        else:
+            self.traffic_label.config(text="")
+            self.traffic_baseline = (None, 0, 0)
+        self.master.after(TRAFFIC_REFRESH_MS, self.refresh_traffic)
 
 
 # --- Main Execution ---
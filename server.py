@@ -1,195 +1,922 @@
 # server.py - Database-Backed Authentication Server (FINAL FIXED VERSION)
+import asyncio
+import math
 import socket
 import threading
 import os
+import sys
 import time
-from secrets import token_hex 
-from utils.protocol_helpers import send_message, recv_message
-from utils.database import initialize_db, create_user, find_user_by_username
-from utils.encryption import check_password
+from concurrent.futures import ThreadPoolExecutor
+from secrets import token_hex
+from utils.protocol_helpers import (
+    Frame, FrameReader, FrameTooLarge, negotiate_codec, send_buffers, read_sized_message_async
+)
+from utils.database import ChatStore, PoolTimeout, initialize_db, create_user, find_user_by_username
+from utils.encryption import AuthPool, ServerBusy, check_password, hash_password
+from utils.backplane import connect_backplane
+from utils.chat import ChatHistory
+from utils.cluster import ClusterDocumentManager
+from utils.documents import DocumentManager
+from utils.merge_engine import DocumentTooLarge
+from utils.log import configure_logging, get_logger, rate_limit
+from utils.metrics import SIZE_BUCKETS, registry, start_metrics_server
+from utils.outbound import OutboundQueue
+from utils.presence import PresenceHub
+from utils.ratelimit import RateLimiter
+from utils.sessions import SessionRegistry
 
 # --- Configuration and State ---
-HOST = '127.0.0.1' 
-PORT = 8080
-DOC_PATH = 'documents/master_doc.txt'
+HOST = '127.0.0.1'
+PORT = int(os.environ.get('NOTEPAD_PORT', '8080'))
+DOCUMENTS_DIR = 'documents'
+DEFAULT_DOC_ID = 'master_doc'  # documents/master_doc.txt, opened by HELLO
+MAX_LOADED_DOCUMENTS = 1000  # idle documents beyond this are saved and evicted (LRU)
+LISTEN_BACKLOG = 128
+ASYNC_LISTEN_BACKLOG = 4096
+ASYNC_EXECUTOR_WORKERS = 16
+
+# Per-client send budget. A client whose queue exceeds any of these is disconnected.
+OUTBOUND_MAX_MESSAGES = 1000
+OUTBOUND_MAX_BYTES = 8 * 1024 * 1024
+OUTBOUND_MAX_LAG = 10.0  # seconds the oldest queued message may wait
+CLOSE_FLUSH_TIMEOUT = 2.0  # seconds to flush queued replies before closing a socket
+AUTOSAVE_DELAY = 2.0  # seconds an edit may wait before the document file is rewritten
+SAVE_TIMEOUT = 10.0  # seconds an explicit SAVE waits for the write to reach disk
+SESSION_RESUME_TTL = 300.0  # seconds a session outlives its connection, for RESUME
+SESSION_EXPIRY_TICK = 1.0  # resolution of the session expiry timer wheel
+
+# Chat: the newest CHAT_BUFFER_SIZE messages of each document stay in memory; all
+# are written to the database in batches every CHAT_FLUSH_INTERVAL seconds. A login
+# (or OPEN) gets the last CHAT_LOGIN_BACKLOG messages; CHAT_HISTORY pages further back.
+CHAT_BUFFER_SIZE = 200
+CHAT_FLUSH_INTERVAL = 0.5
+CHAT_LOGIN_BACKLOG = 50
+CHAT_PAGE_SIZE = 50
+CHAT_PAGE_MAX = 200
+CHAT_MAX_CHARS = 4000  # longer CHAT text is refused
+# Revision history (utils/history.py): HISTORY lists revisions a page at a time,
+# newest first by page; GET_REVISION returns the text of one.
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 500
+# Live cursors: PRESENCE updates are collected per document and sent out as one
+# frame per document this many times a second (utils/presence.py).
+PRESENCE_HZ = 10
+
+# Inbound limits. A frame over MAX_FRAME_BYTES (MAX_LOGIN_FRAME_BYTES before the
+# connection has a session) is refused from its 4-byte header, before its body is
+# read, and the connection is closed. Edits may not grow a document past
+# MAX_DOCUMENT_CHARS.
+MAX_FRAME_BYTES = int(os.environ.get('NOTEPAD_MAX_FRAME_BYTES', str(16 * 1024 * 1024)))
+MAX_LOGIN_FRAME_BYTES = 64 * 1024
+MAX_DOCUMENT_CHARS = int(os.environ.get('NOTEPAD_MAX_DOCUMENT_CHARS', str(16 * 1024 * 1024)))
+# Token buckets per connection (utils/ratelimit.py), as (per second, burst): one per
+# message type below, one for all messages and one for inbound bytes. A message over
+# a limit is dropped and the client gets a THROTTLED notice (one per limit until it
+# may retry); after THROTTLE_DISCONNECT_AFTER refusals in a row it is disconnected.
+# NOTEPAD_RATE_LIMITS=0 turns the buckets off (frame and document caps stay).
+RATE_LIMITS = {
+    "EDIT_OP": (100, 200), "EDIT": (10, 20), "PRESENCE": (30, 60), "CHAT": (5, 20),
+    "LOGIN": (1, 5), "SIGNUP": (1, 5), "SAVE": (2, 10), "NEW_FILE": (1, 5), "CREATE": (1, 5),
+    "OPEN": (5, 20), "LIST": (5, 20), "CHAT_HISTORY": (10, 50), "HISTORY": (10, 50), "GET_REVISION": (10, 50),
+    "STATS": (2, 10),
+}
+SESSION_MESSAGE_LIMIT = (300, 600)
+SESSION_BYTE_LIMIT = (4 * 1024 * 1024, MAX_FRAME_BYTES)
+THROTTLE_DISCONNECT_AFTER = 1000
+RATE_LIMITING = os.environ.get('NOTEPAD_RATE_LIMITS', '1') != '0'
+
+# Routes that call PostgreSQL or touch files. The asyncio server runs them in an
+# executor; everything else is handled directly on the event loop.
+BLOCKING_ROUTES = {"HELLO", "RESUME", "SAVE", "NEW_FILE", "OPEN", "CREATE", "LIST", "STATS", "CHAT_HISTORY",
+                   "HISTORY", "GET_REVISION"}
+
+# Routes that run bcrypt (auth_route). Both servers hand only the bcrypt call to the
+# auth pool: AUTH_WORKERS threads (one per core) and at most AUTH_MAX_QUEUE waiting;
+# beyond that the client gets an immediate "server busy" AUTH_FAIL. Their database
+# calls and replies stay on the connection's thread (or the blocking-route executor).
+AUTH_ROUTES = {"LOGIN", "SIGNUP"}
+AUTH_WORKERS = os.cpu_count() or 1
+AUTH_MAX_QUEUE = 64
+AUTH_WORKER_NICE = int(os.environ.get('NOTEPAD_AUTH_NICE', '10'))  # 0 keeps bcrypt at normal priority
+
+# Metrics: always collected; STATS (admins only) returns them, and a plaintext
+# endpoint serves them at http://METRICS_HOST:METRICS_PORT/metrics (0 disables it).
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = int(os.environ.get('NOTEPAD_METRICS_PORT', '9090'))
+# Message types that get their own metrics; anything else is counted as "UNKNOWN".
+MESSAGE_TYPES = {"HELLO", "RESUME", "SIGNUP", "LOGIN", "LOGOUT", "LIST", "OPEN", "CREATE", "NEW_FILE",
+                 "EDIT_OP", "EDIT", "SAVE", "CHAT", "CHAT_HISTORY", "STATS",
+                 "HISTORY", "GET_REVISION", "PRESENCE"}
+
+# Cluster mode: several server processes share documents through a backplane
+# broker (see utils/backplane.py), e.g. NOTEPAD_BACKPLANE=unix:/tmp/notepad-backplane.sock.
+# Unset: this process serves everything on its own.
+BACKPLANE = os.environ.get('NOTEPAD_BACKPLANE')
+NODE_ID = os.environ.get('NOTEPAD_NODE_ID', f'{HOST}:{PORT}')
+
+log = get_logger("server")
 
 # Shared State
-connected_clients = []
-doc_lock = threading.Lock() 
-current_document = "" 
-ACTIVE_SESSIONS = {}  # {session_id: user_id}
+def _session_expired(session_id, user_id):
+    log.info("Session %s for %s expired.", session_id, user_id)
+
+sessions = SessionRegistry(SESSION_RESUME_TTL, SESSION_EXPIRY_TICK,
+                           on_expire=_session_expired)  # sessions and connections, with its own lock
+chat_history = ChatHistory(ChatStore(), CHAT_BUFFER_SIZE, MAX_LOADED_DOCUMENTS, CHAT_FLUSH_INTERVAL)
+if BACKPLANE:
+    # Chat relayed from other processes is buffered here too; the receiving process stores it.
+    documents = ClusterDocumentManager(DOCUMENTS_DIR, connect_backplane(BACKPLANE, NODE_ID),
+                                       on_global=lambda message_dict: deliver_to_all(Frame(message_dict)),
+                                       on_chat=lambda doc_id, m: chat_history.remember(
+                                           doc_id, {"user": m.get("user"), "text": m.get("text"), "ts": m.get("ts")}),
+                                       max_loaded=MAX_LOADED_DOCUMENTS, autosave_delay=AUTOSAVE_DELAY,
+                                       max_length=MAX_DOCUMENT_CHARS)
+else:
+    documents = DocumentManager(DOCUMENTS_DIR, max_loaded=MAX_LOADED_DOCUMENTS, autosave_delay=AUTOSAVE_DELAY,
+                                max_length=MAX_DOCUMENT_CHARS)  # each document has its own lock
+auth_pool = AuthPool(AUTH_WORKERS, AUTH_MAX_QUEUE, AUTH_WORKER_NICE)
+presence = PresenceHub(PRESENCE_HZ)
+
+registry.add_collector("sessions", sessions.stats)
+registry.add_collector("autosave", documents.autosave.stats)
+registry.add_collector("auth_pool", auth_pool.stats)
+registry.add_collector("chat", chat_history.stats)
+registry.add_collector("presence", presence.stats)
+registry.add_collector("log", lambda: {"suppressed": rate_limit.suppressed_total})
+FANOUT_SECONDS = registry.histogram("fanout_seconds", scope="server")
+FANOUT_RECIPIENTS = registry.histogram("fanout_recipients", SIZE_BUCKETS, scope="server")
+THROTTLED = registry.counter("messages_throttled")
+FRAMES_TOO_LARGE = registry.counter("frames_too_large")
+_route_metrics = {}  # {message type: (handle time histogram, bytes_in counter)}
+
+
+def route_metrics(msg_type):
+    label = msg_type if msg_type in MESSAGE_TYPES else "UNKNOWN"
+    metrics = _route_metrics.get(label)
+    if metrics is None:
+        metrics = _route_metrics[label] = (registry.histogram("handle_seconds", type=label),
+                                           registry.counter("bytes_in", type=label))
+    return metrics
+
+
+def new_outbound_queue():
+    return OutboundQueue(OUTBOUND_MAX_MESSAGES, OUTBOUND_MAX_BYTES, OUTBOUND_MAX_LAG)
+
+
+def new_rate_limiter():
+    if not RATE_LIMITING:
+        return None
+    return RateLimiter(RATE_LIMITS, SESSION_MESSAGE_LIMIT, SESSION_BYTE_LIMIT)
+
+
+def frame_limit(conn):
+    return MAX_FRAME_BYTES if conn.session_id else MAX_LOGIN_FRAME_BYTES
+
+
+class ClientConnection:
+    """A connected client socket; a reader thread handles messages, a writer thread sends."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.peer = sock.getpeername()
+        self.user_id = "UNAUTHENTICATED"
+        self.session_id = None
+        self.document = None  # Document this client has open
+        self.chunked_state = False  # accepts DOC_STATE in DOC_CHUNK pieces (HELLO / RESUME)
+        self.presence_id = token_hex(4)  # names this connection's cursor to other clients
+        self.limiter = new_rate_limiter()  # None with NOTEPAD_RATE_LIMITS=0
+        self.outbound = new_outbound_queue()
+        self.reader = FrameReader(sock)
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def send(self, message):
+        """Queues a message dict or pre-encoded Frame; never blocks on the socket."""
+        frame = message if isinstance(message, Frame) else Frame(message)
+        if not self.outbound.put(frame):
+            self.abort()
+
+    def send_stream(self, frames):
+        """Queues an iterator of Frames, encoded one at a time as the socket takes them."""
+        if not self.outbound.put_stream(frames):
+            self.abort()
+
+    def _write_loop(self):
+        while True:
+            buffers = self.outbound.get()
+            if buffers is None:
+                return
+            try:
+                send_buffers(self.sock, buffers)
+            except OSError:
+                self.abort()
+                return
+
+    def abort(self):
+        """Drops a client that fell too far behind; its reader thread then cleans up."""
+        if not self.outbound.closed:
+            log.warning("Disconnecting %s (%s): outbound queue over budget or socket error.", self.user_id, self.peer)
+        self.outbound.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.outbound.close(discard=False)
+        self.writer_thread.join(CLOSE_FLUSH_TIMEOUT)
+        self.abort()
+        self.sock.close()
+
 
 def load_document():
-    """Loads the document from disk and initializes the DB."""
-    global current_document
-    os.makedirs('documents', exist_ok=True)
-    
+    """Initializes the DB and makes sure the default document exists."""
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+
     # --- Initialize DB and create test admin user ---
     initialize_db()
     if not find_user_by_username("admin"):
         create_user("admin", "adminpass", is_admin=True)
-    
-    # Load or initialize document
-    if os.path.exists(DOC_PATH):
-        with open(DOC_PATH, 'r') as f:
-            current_document = f.read()
+
+    # Initialize the default document; others are loaded on demand
+    if not documents.exists(DEFAULT_DOC_ID):
+        try:
+            documents.create(DEFAULT_DOC_ID, "Welcome to the Collaborative Notepad!")
+        except FileExistsError:
+            pass  # Another server process of the cluster created it first
+
+    # Rebuild it from its last snapshot plus the log tail (recovers edits after a crash)
+    started = time.perf_counter()
+    doc = documents.get(DEFAULT_DOC_ID)
+    if doc.remote:
+        log.info("'%s' is owned by %s", DEFAULT_DOC_ID, documents.owner_of(DEFAULT_DOC_ID))
     else:
-        current_document = "Welcome to the Collaborative Notepad!"
-        with open(DOC_PATH, 'w') as f:
-            f.write(current_document) 
+        log.info("Loaded '%s' at revision %d in %.1f ms", DEFAULT_DOC_ID, doc.engine.revision,
+                 (time.perf_counter() - started) * 1000)
+
+def start_metrics_endpoint():
+    if not METRICS_PORT:
+        return
+    try:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+        log.info("Metrics at http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        log.warning("Metrics endpoint disabled, cannot listen on %s:%d: %s", METRICS_HOST, METRICS_PORT, e)
+
+def broadcast_message(message_dict, exclude=None):
+    """Sends a message to all connected clients (of every process, in cluster mode)."""
+    deliver_to_all(Frame(message_dict), exclude)
+    if BACKPLANE:
+        documents.publish_global(message_dict)
+
+def deliver_to_all(frame, exclude=None):
+    """Sends a frame to every connection of this process. It is encoded once for all of them."""
+    started = time.perf_counter()
+    recipients = sessions.connections()
+    for conn in recipients:
+        if conn is not exclude:
+            conn.send(frame)
+    FANOUT_SECONDS.observe(time.perf_counter() - started)
+    FANOUT_RECIPIENTS.observe(len(recipients))
+
+def _is_position(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def send_chat_history(conn, doc_id, before=None, limit=CHAT_LOGIN_BACKLOG):
+    """Sends up to `limit` chat messages of doc_id older than `before` (None: the newest)."""
+    messages = chat_history.page(doc_id, before, limit)
+    conn.send({"type": "CHAT_HISTORY", "doc_id": doc_id, "messages": messages, "before": before,
+               "has_more": len(messages) == limit})
+
+def register_client(conn):
+    """Adds a new, not yet authenticated connection to the registry."""
+    sessions.add_connection(conn)
+    log.debug("New connection from %s. Waiting for authentication...", conn.peer)
+
+def auth_route(conn, message):
+    """
+    LOGIN and SIGNUP, as a generator: it yields each bcrypt job as (fn, *args) and is
+    sent its result. Only that job runs on the auth pool; the database calls and the
+    reply run wherever the driver resumes the generator (run_auth_route on the
+    connection's thread, run_auth_route_async in the blocking-route executor), so
+    slow database I/O never holds a bcrypt worker. Returns whether to keep the
+    connection open.
+    """
+    msg_type = message.get("type")
+    if not isinstance(message.get("user"), str) or not isinstance(message.get("password"), str):
+        conn.send({"type": "AUTH_FAIL", "message": "Username and password are required."})
+        return True
+
+    # --- SIGNUP ROUTE ---
+    if msg_type == "SIGNUP":
+        new_user = message.get("user")
+        password = message.get("password")
 
-def broadcast_message(message_dict, exclude_sock=None):
-    """Sends a message to all connected clients."""
-    global connected_clients
-    for client_sock, user_id, session_id in list(connected_clients):
-        if client_sock != exclude_sock:
-            send_message(client_sock, message_dict)
+        try:
+            password_hash = yield hash_password, password
+        except Exception as e:
+            log.error("hash_password failed for %s: %s", new_user, e)
+            conn.send({"type": "AUTH_FAIL", "message": "Error creating the account."})
+            return True
+        if create_user(new_user, password, password_hash=password_hash):
+            conn.send({"type": "AUTH_SUCCESS", "message": "Signup successful! Please log in."})
+        else:
+            conn.send({"type": "AUTH_FAIL", "message": "Username already exists."})
+        return True
+
+    # --- LOGIN ROUTE (FIXED) ---
+    new_id = message.get("user")
+    password = message.get("password")
+
+    try:
+        user_data = find_user_by_username(new_id)
+    except PoolTimeout:
+        conn.send({"type": "AUTH_FAIL", "message": "Server busy, please try again in a moment.", "busy": True})
+        return True
+    log.debug("Attempting login for '%s', found in DB: %s", new_id, user_data is not None)
+
+    if user_data:
+        try:
+            is_valid = yield check_password, password, user_data['password_hash']
+        except Exception as e:
+            log.error("check_password failed for %s: %s", new_id, e)
+            conn.send({"type": "AUTH_FAIL", "message": "Error verifying password."})
+            return True
+    else:
+        is_valid = False
+
+    if is_valid:
+        session_id = sessions.create(conn, new_id)
+
+        conn.send({"type": "AUTH_SUCCESS", "session_id": session_id, "user": new_id})
+        log.info("Client %s authenticated as %s. Session: %s", conn.peer, new_id, session_id)
+        if conn.document is not None:
+            send_chat_history(conn, conn.document.doc_id)
+    else:
+        conn.send({"type": "AUTH_FAIL", "message": "Invalid username or password."})
+        log.info("Authentication failed for '%s'. Client remains connected.", new_id)
+        # FIXED: do not break connection
+    return True
+
+def resume_auth_route(steps, job):
+    """
+    Runs an auth_route generator up to its next bcrypt job, handing it the outcome of
+    the last one (a finished Future; None to start). Returns (next job, None), or
+    (None, keep_open) once the route is done.
+    """
+    try:
+        if job is None:
+            return next(steps), None
+        error = job.exception()
+        return (steps.throw(error) if error is not None else steps.send(job.result())), None
+    except StopIteration as done:
+        return None, done.value
+
+def submit_auth_job(conn, steps, bcrypt_job):
+    """Queues a bcrypt job on the auth pool. Returns its Future, or None if the pool is full (the client is told so)."""
+    try:
+        return auth_pool.submit(*bcrypt_job)
+    except ServerBusy:
+        steps.close()
+        conn.send({"type": "AUTH_FAIL", "message": "Server busy, please try again in a moment.", "busy": True})
+        return None
+
+def run_auth_route(conn, message):
+    """Handles LOGIN/SIGNUP on the connection's thread, waiting there for each bcrypt job."""
+    started = time.perf_counter()
+    try:
+        steps = auth_route(conn, message)
+        job = None
+        while True:
+            bcrypt_job, keep_open = resume_auth_route(steps, job)
+            if bcrypt_job is None:
+                return keep_open
+            job = submit_auth_job(conn, steps, bcrypt_job)
+            if job is None:
+                return True
+            job.exception()  # Waits for it
+    finally:
+        route_metrics(message.get("type"))[0].observe(time.perf_counter() - started)
+
+async def run_auth_route_async(conn, message, executor):
+    """Handles LOGIN/SIGNUP for the event loop: database steps in `executor`, bcrypt jobs awaited, not waited on."""
+    loop = conn.loop
+    started = time.perf_counter()
+    try:
+        steps = auth_route(conn, message)
+        job = None
+        while True:
+            bcrypt_job, keep_open = await loop.run_in_executor(executor, resume_auth_route, steps, job)
+            if bcrypt_job is None:
+                return keep_open
+            job = submit_auth_job(conn, steps, bcrypt_job)
+            if job is None:
+                return True
+            await asyncio.wait((asyncio.wrap_future(job),))
+    finally:
+        route_metrics(message.get("type"))[0].observe(time.perf_counter() - started)
+
+def handle_message(conn, message):
+    """
+    Routes one client message and records how long that took. Shared by the
+    threaded and the asyncio server. Returns False when the connection should be closed.
+    """
+    started = time.perf_counter()
+    try:
+        return route_message(conn, message)
+    finally:
+        route_metrics(message.get("type"))[0].observe(time.perf_counter() - started)
+
+def record_inbound(message, size):
+    route_metrics(message.get("type"))[1].inc(size)
+
+def throttle(conn, message, size):
+    """
+    Checks a message against conn's rate limits before it is handled. Returns None
+    if it may be; otherwise it is dropped, and the result says whether to keep the
+    connection open (False once the client ignored THROTTLED for too long).
+    """
+    if conn.limiter is None:
+        return None
+    refused = conn.limiter.check(message.get("type"), size)
+    if refused is None:
+        return None
+    limit, retry_after, notify = refused
+    THROTTLED.inc()
+    if conn.limiter.refused_in_a_row >= THROTTLE_DISCONNECT_AFTER:
+        log.warning("Disconnecting %s (%s): kept sending past its %s limit.", conn.user_id, conn.peer, limit)
+        return False
+    if notify:
+        # EDIT_OPs are dropped too: clients send the refused one again after retry_after.
+        conn.send({"type": "THROTTLED", "message_type": message.get("type"), "limit": limit,
+                   "retry_after": math.ceil(retry_after * 1000) / 1000})
+    return True
+
+def refuse_frame(conn, error):
+    """Tells a client its frame was over the size limit; the connection is then closed."""
+    FRAMES_TOO_LARGE.inc()
+    log.warning("Closing %s (%s): %s.", conn.user_id, conn.peer, error)
+    conn.send({"type": "NOTIFICATION", "message": f"Message too large ({error.size} bytes, limit {error.limit})."})
+
+def route_message(conn, message):
+    msg_type = message.get("type")
+
+    # --- HELLO handshake ---
+    if msg_type == "HELLO":
+        # Codec negotiation: HELLO_ACK goes out in JSON, everything after it in the
+        # chosen codec. Clients that offer nothing (older ones) stay on plain JSON.
+        codec, compress = negotiate_codec(message.get("codecs"), message.get("compression"))
+        conn.send({"type": "HELLO_ACK", "codec": codec.name, "compression": "zlib" if compress else None})
+        conn.outbound.set_encoding(codec, compress)
+        conn.chunked_state = bool(message.get("chunked_state"))
+        try:
+            documents.subscribe(conn, message.get("doc_id", DEFAULT_DOC_ID))
+        except (KeyError, ValueError):
+            documents.subscribe(conn, DEFAULT_DOC_ID)
+        return True
+
+    # --- RESUME (reconnect with an existing session instead of HELLO + LOGIN) ---
+    if msg_type == "RESUME":
+        codec, compress = negotiate_codec(message.get("codecs"), message.get("compression"))
+        conn.send({"type": "HELLO_ACK", "codec": codec.name, "compression": "zlib" if compress else None})
+        conn.outbound.set_encoding(codec, compress)
+        conn.chunked_state = bool(message.get("chunked_state"))
+        session_id = message.get("session_id")
+        resumed = sessions.resume(conn, session_id)
+        doc_id = message.get("doc_id", DEFAULT_DOC_ID)
+
+        if resumed is None:
+            try:
+                documents.subscribe(conn, doc_id)
+            except (KeyError, ValueError):
+                documents.subscribe(conn, DEFAULT_DOC_ID)
+            conn.send({"type": "AUTH_FAIL", "message": "Your session has expired. Please log in again."})
+            return True
+
+        resumed_user, stale_conns = resumed
+        for stale_conn in stale_conns:
+            stale_conn.abort()  # The old socket has not noticed the drop yet
+        try:
+            # Replays only the edits after the client's last revision, if still in history.
+            documents.subscribe(conn, doc_id, since=message.get("version"))
+        except (KeyError, ValueError):
+            documents.subscribe(conn, DEFAULT_DOC_ID)
+        conn.send({"type": "RESUMED", "session_id": session_id, "user": resumed_user})
+        log.info("Client %s resumed session %s as %s.", conn.peer, session_id, resumed_user)
+        return True
+
+    # --- AUTH VALIDATION ---
+    if msg_type not in ["LOGIN", "SIGNUP", "HELLO", "RESUME", "LOGOUT"]:
+        if sessions.validate(conn, message.get("session_id")) is None:
+            conn.send({"type": "AUTH_FAIL", "message": "Authentication required."})
+            return False
+    user_id = conn.user_id
+    doc = conn.document
+
+    # (LOGIN and SIGNUP are handled by auth_route.)
+
+    # --- LOGOUT ROUTE ---
+    if msg_type == "LOGOUT":
+        log.info("Client %s requested logout. Closing connection.", user_id)
+        sessions.end(conn.session_id)
+        return False
+
+    # --- STATS (administrators only) ---
+    elif msg_type == "STATS":
+        user_data = find_user_by_username(user_id)
+        if user_data and user_data.get('is_admin'):
+            conn.send({"type": "STATS", "metrics": registry.snapshot()})
+        else:
+            conn.send({"type": "NOTIFICATION", "message": "Server statistics are only available to administrators."})
+
+    # --- Document Routes (LIST, OPEN, CREATE, NEW_FILE) ---
+    elif msg_type == "LIST":
+        conn.send({"type": "DOC_LIST", "documents": documents.list_ids()})
+
+    elif msg_type == "OPEN":
+        try:
+            documents.subscribe(conn, message.get("doc_id"))
+        except (KeyError, ValueError):
+            conn.send({"type": "NOTIFICATION", "message": f"No document named {message.get('doc_id')!r}."})
+            return True
+        send_chat_history(conn, message.get("doc_id"))
+
+    elif msg_type == "CREATE":
+        try:
+            documents.create(message.get("doc_id"))
+        except ValueError:
+            conn.send({"type": "NOTIFICATION", "message": "Document names may only use letters, digits, '-' and '_'."})
+            return True
+        except FileExistsError:
+            conn.send({"type": "NOTIFICATION", "message": f"Document {message.get('doc_id')!r} already exists."})
+            return True
+        except OSError as e:
+            log.error("Could not create document %r: %s", message.get("doc_id"), e)
+            conn.send({"type": "NOTIFICATION", "message": "The document could not be created; please try again later."})
+            return True
+        documents.subscribe(conn, message.get("doc_id"))
+
+    elif msg_type == "NEW_FILE":
+        # A fresh document for the requester; nobody else's document is touched.
+        try:
+            new_doc = documents.create(f"untitled-{token_hex(4)}",
+                                       f"New document started by {user_id} at {time.strftime('%H:%M:%S')}.")
+        except OSError as e:
+            log.error("Could not create a new file for %s: %s", user_id, e)
+            conn.send({"type": "NOTIFICATION", "message": "The document could not be created; please try again later."})
+            return True
+        documents.subscribe(conn, new_doc.doc_id)
+        broadcast_message({"type": "NOTIFICATION", "message": f"{user_id} created a new file ({new_doc.doc_id})."})
+
+    # --- Protected Routes on the open document (edits, SAVE, chat, presence, history) ---
+    elif doc is None:
+        conn.send({"type": "NOTIFICATION", "message": "Open a document first."})
+
+    elif msg_type == "EDIT_OP":
+        if message.get("doc_id", doc.doc_id) != doc.doc_id:
+            return True  # In flight while the client switched documents
+        if doc.remote:
+            doc.forward_edit(conn, message)  # The owning process orders it and answers via the backplane
+            return True
+        ops = message.get("ops", [])
+        with doc.lock:
+            try:
+                revision, merged_ops = doc.submit(message.get("version"), ops, origin=conn.session_id)
+                doc.queue_send(conn, {"type": "EDIT_ACK", "doc_id": doc.doc_id, "version": revision})
+                doc.queue_broadcast({"type": "EDIT_OP", "doc_id": doc.doc_id, "ops": merged_ops,
+                                     "version": revision, "user": user_id}, exclude=conn, origin=conn.session_id)
+            except DocumentTooLarge:
+                doc.queue_send(conn, {"type": "NOTIFICATION", "message": f"The document has reached its size "
+                                      f"limit ({MAX_DOCUMENT_CHARS} characters); the edit was undone."})
+                doc.queue_state(conn)
+            except ValueError as e:
+                # The client is out of sync: resend the authoritative state.
+                log.warning("Rejected EDIT_OP from %s: %s", user_id, e)
+                doc.queue_state(conn)
+        doc.flush_outbox()
+
+    elif msg_type == "EDIT":
+        # Full-content fallback for clients that do not send EDIT_OP.
+        content = message.get("content", "")
+        if not isinstance(content, str):
+            conn.send({"type": "NOTIFICATION", "message": "Invalid EDIT: content must be text."})
+            return True
+        if len(content) > MAX_DOCUMENT_CHARS:
+            conn.send({"type": "NOTIFICATION", "message": f"Documents are limited to {MAX_DOCUMENT_CHARS} characters."})
+            return True
+        if doc.remote:
+            doc.forward_replace(conn, content)
+            return True
+        with doc.lock:
+            revision = doc.replace(content, origin=conn.session_id)
+            doc.queue_broadcast({"type": "EDIT_UPDATE", "doc_id": doc.doc_id, "content": str(doc.engine.text),
+                                 "version": revision}, exclude=conn, origin=conn.session_id)
+        doc.flush_outbox()
+
+    elif msg_type == "SAVE":
+        # Edits are autosaved anyway; this waits for the write without holding doc.lock.
+        if doc.save(SAVE_TIMEOUT):
+            save_msg = f"Document saved by {user_id}."
+            doc.broadcast({"type": "NOTIFICATION", "message": save_msg})
+        else:
+            conn.send({"type": "NOTIFICATION", "message": "Save is taking longer than expected; it will complete in the background."})
+
+    elif msg_type == "CHAT":
+        chat_text = message.get("text", "")
+        if not isinstance(chat_text, str) or len(chat_text) > CHAT_MAX_CHARS:
+            conn.send({"type": "NOTIFICATION", "message": f"Chat messages must be text of at most {CHAT_MAX_CHARS} characters."})
+            return True
+        # Buffered and queued for the database; the broadcast does not wait for either.
+        entry = chat_history.record(doc.doc_id, user_id, chat_text)
+        doc.broadcast({"type": "CHAT_MESSAGE", "doc_id": doc.doc_id, "user": user_id, "text": chat_text,
+                       "ts": entry["ts"]})
+
+    elif msg_type == "CHAT_HISTORY":
+        # Older messages, from the in-memory buffer or the (doc_id, sent_at) index.
+        try:
+            before = float(message["before"]) if message.get("before") is not None else None
+            limit = max(1, min(int(message.get("limit", CHAT_PAGE_SIZE)), CHAT_PAGE_MAX))
+        except (TypeError, ValueError):
+            conn.send({"type": "NOTIFICATION", "message": "Invalid CHAT_HISTORY request."})
+            return True
+        send_chat_history(conn, doc.doc_id, before, limit)
+
+    elif msg_type == "PRESENCE":
+        # Caret (and selection) of this client; sent out with everyone else's on the next tick.
+        if message.get("doc_id", doc.doc_id) != doc.doc_id:
+            return True
+        cursor, selection, version = message.get("cursor"), message.get("selection"), message.get("version")
+        valid = (_is_position(cursor) and (version is None or _is_position(version))
+                 and (selection is None or (isinstance(selection, list) and len(selection) == 2
+                                            and all(_is_position(p) for p in selection))))
+        if not valid:
+            conn.send({"type": "NOTIFICATION", "message": "Invalid PRESENCE message."})
+            return True
+        presence.update(conn, doc, cursor, selection, version)
+
+    elif msg_type == "HISTORY":
+        # Revisions older than `before` (default: the newest), oldest first.
+        try:
+            before = int(message["before"]) if message.get("before") is not None else None
+            limit = max(1, min(int(message.get("limit", HISTORY_PAGE_SIZE)), HISTORY_PAGE_MAX))
+        except (TypeError, ValueError):
+            conn.send({"type": "NOTIFICATION", "message": "Invalid HISTORY request."})
+            return True
+        revisions = doc.history_page(before, limit)
+        if revisions is None:
+            conn.send({"type": "NOTIFICATION", "message": "History is not available right now."})
+            return True
+        conn.send({"type": "HISTORY", "doc_id": doc.doc_id, "revisions": revisions, "before": before,
+                   "has_more": len(revisions) == limit})
+
+    elif msg_type == "GET_REVISION":
+        # One past revision, by number or as of a time (seconds since the epoch).
+        try:
+            revision = int(message["revision"]) if message.get("revision") is not None else None
+            at = float(message["at"]) if message.get("at") is not None else None
+            if (revision is None) == (at is None):
+                raise ValueError("give either revision or at")
+        except (TypeError, ValueError):
+            conn.send({"type": "NOTIFICATION", "message": "Invalid GET_REVISION request."})
+            return True
+        found = doc.read_revision(revision, at)
+        if found is None:
+            conn.send({"type": "NOTIFICATION", "message": "That revision is not in the history."})
+            return True
+        conn.send({"type": "REVISION", "doc_id": doc.doc_id, "revision": found["revision"],
+                   "ts": found["ts"], "content": found["content"]})
+
+    return True
+
+def unregister_client(conn):
+    """
+    Removes the connection from the registry. Its session stays resumable for
+    SESSION_RESUME_TTL seconds (LOGOUT ends it right away).
+    """
+    log.debug("Client %s disconnected.", conn.user_id)
+    documents.unsubscribe(conn)
+    sessions.remove_connection(conn)
 
 def handle_client(sock):
     """Handles all communication for a single client in its own thread."""
-    global current_document, connected_clients, doc_lock, ACTIVE_SESSIONS
-
-    user_id = "UNAUTHENTICATED" 
-    session_id = None
-    
-    with doc_lock:
-        connected_clients.append((sock, user_id, session_id))
-    
-    print(f"New connection from {sock.getpeername()}. Waiting for authentication...")
+    conn = ClientConnection(sock)
+    register_client(conn)
 
     while True:
         try:
-            message = recv_message(sock)
+            conn.reader.max_frame_size = frame_limit(conn)
+            message = conn.reader.read_message()
             if message is None:
                 break
-            
-            msg_type = message.get("type")
-
-            # --- HELLO handshake ---
-            if msg_type == "HELLO":
-                send_message(sock, {"type": "DOC_STATE", "content": current_document})
+            record_inbound(message, conn.reader.last_frame_size)
+            throttled = throttle(conn, message, conn.reader.last_frame_size)
+            if throttled is not None:
+                if not throttled:
+                    break
                 continue
-            
-            # --- AUTH VALIDATION ---
-            if msg_type not in ["LOGIN", "SIGNUP", "HELLO", "LOGOUT"]:
-                session_id = message.get("session_id")
-                if session_id not in ACTIVE_SESSIONS:
-                    send_message(sock, {"type": "AUTH_FAIL", "message": "Authentication required."})
-                    break 
-                user_id = ACTIVE_SESSIONS[session_id]
-            
-            # --- SIGNUP ROUTE ---
-            if msg_type == "SIGNUP":
-                new_user = message.get("user")
-                password = message.get("password")
-                
-                if create_user(new_user, password):
-                    send_message(sock, {"type": "AUTH_SUCCESS", "message": "Signup successful! Please log in."})
-                else:
-                    send_message(sock, {"type": "AUTH_FAIL", "message": "Username already exists."})
-
-            # --- LOGIN ROUTE (FIXED) ---
-            elif msg_type == "LOGIN":
-                new_id = message.get("user")
-                password = message.get("password") 
-                
-                user_data = find_user_by_username(new_id)
-                print(f"[DEBUG] Attempting login for '{new_id}', found in DB: {user_data is not None}")
-
-                if user_data:
-                    try:
-                        is_valid = check_password(password, user_data['password_hash'])
-                    except Exception as e:
-                        print(f"[ERROR] check_password failed for {new_id}: {e}")
-                        send_message(sock, {"type": "AUTH_FAIL", "message": "Error verifying password."})
-                        continue
-                else:
-                    is_valid = False
-
-                if is_valid:
-                    session_id = token_hex(16)
-                    with doc_lock:
-                        ACTIVE_SESSIONS[session_id] = new_id
-                        connected_clients = [
-                            (s, new_id, session_id) if s == sock else (s, u, sid)
-                            for s, u, sid in connected_clients
-                        ]
-                        user_id = new_id
-                        
-                    send_message(sock, {"type": "AUTH_SUCCESS", "session_id": session_id, "user": new_id})
-                    print(f"✅ Client {sock.getpeername()} authenticated as {new_id}. Session: {session_id}")
-                else:
-                    send_message(sock, {"type": "AUTH_FAIL", "message": "Invalid username or password."})
-                    print(f"❌ Authentication failed for '{new_id}'. Client remains connected.")
-                    continue  # FIXED: do not break connection
-
-            # --- LOGOUT ROUTE ---
-            elif msg_type == "LOGOUT":
-                print(f"Client {user_id} requested logout. Closing connection.")
+            if message.get("type") in AUTH_ROUTES:
+                keep_open = run_auth_route(conn, message)
+            else:
+                keep_open = handle_message(conn, message)
+            if not keep_open:
                 break
-
-            # --- Protected Routes (EDIT, SAVE, NEW_FILE, CHAT) ---
-            elif msg_type == "EDIT":
-                with doc_lock:
-                    current_document = message.get("content", "")
-                    broadcast_message({"type": "EDIT_UPDATE", "content": current_document}, exclude_sock=sock)
-            
-            elif msg_type == "SAVE":
-                with doc_lock:
-                    with open(DOC_PATH, 'w') as f:
-                        f.write(current_document)
-                save_msg = f"Document saved by {user_id}."
-                broadcast_message({"type": "NOTIFICATION", "message": save_msg})
-
-            elif msg_type == "NEW_FILE":
-                with doc_lock:
-                    current_document = f"New document started by {user_id} at {time.strftime('%H:%M:%S')}."
-                    with open(DOC_PATH, 'w') as f:
-                        f.write(current_document)
-                broadcast_message({"type": "DOC_STATE", "content": current_document})
-                broadcast_message({"type": "NOTIFICATION", "message": f"{user_id} created a new file."})
-            
-            elif msg_type == "CHAT":
-                chat_text = message.get("text", "")
-                broadcast_message({"type": "CHAT_MESSAGE", "user": user_id, "text": chat_text})
-            
+        except FrameTooLarge as e:
+            refuse_frame(conn, e)
+            break
         except Exception as e:
-            print(f"Error handling client {user_id} ({sock.getpeername()}): {e}")
+            log.error("Error handling client %s (%s): %s", conn.user_id, conn.peer, e)
             break
 
     # --- CLEANUP ---
-    print(f"Client {user_id} disconnected.")
-    session_to_remove = next((sid for sid, uid in ACTIVE_SESSIONS.items() if uid == user_id), None)
-    if session_to_remove:
-        with doc_lock:
-            del ACTIVE_SESSIONS[session_to_remove]
-            print(f"Session {session_to_remove} for {user_id} terminated.")
-    
-    with doc_lock:
-        connected_clients = [c for c in connected_clients if c[0] != sock]
-    sock.close()
+    unregister_client(conn)
+    conn.close()
 
 def start_server():
     """Starts the main server listener loop."""
-    os.makedirs('documents', exist_ok=True)
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
     load_document()
-    
+    start_metrics_endpoint()
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((HOST, PORT))
-        sock.listen(5)
-        print(f"✅ Server listening on {HOST}:{PORT}")
-        
+        sock.listen(LISTEN_BACKLOG)
+        log.info("Server listening on %s:%d", HOST, PORT)
+
         while True:
             try:
                 client_sock, addr = sock.accept()
                 threading.Thread(target=handle_client, args=(client_sock,), daemon=True).start()
             except KeyboardInterrupt:
-                print("\nServer shutting down...")
+                log.info("Server shutting down...")
+                documents.save_all()
+                chat_history.flush()
+                log.info("Autosave stats: %s", documents.autosave.stats())
                 break
             except Exception as e:
-                print(f"Server acceptance error: {e}")
+                log.error("Server acceptance error: %s", e)
+                break
+
+# --- asyncio Server (python server.py --async) ---
+class AsyncClientConnection:
+    """A connected client served by the asyncio event loop; a writer task drains its queue."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.peer = writer.get_extra_info('peername')
+        self.user_id = "UNAUTHENTICATED"
+        self.session_id = None
+        self.document = None  # Document this client has open
+        self.chunked_state = False  # accepts DOC_STATE in DOC_CHUNK pieces (HELLO / RESUME)
+        self.presence_id = token_hex(4)  # names this connection's cursor to other clients
+        self.limiter = new_rate_limiter()  # None with NOTEPAD_RATE_LIMITS=0
+        self.outbound = new_outbound_queue()
+        self.wakeup = asyncio.Event()
+        self.writer_task = self.loop.create_task(self._write_loop())
+
+    def send(self, message):
+        # Blocking routes call this from executor threads; the event and the
+        # transport are only touched from the event loop thread.
+        frame = message if isinstance(message, Frame) else Frame(message)
+        self._notify(self.outbound.put(frame))
+
+    def send_stream(self, frames):
+        """Queues an iterator of Frames; the writer takes one per wakeup, between other messages."""
+        self._notify(self.outbound.put_stream(frames))
+
+    def _notify(self, queued):
+        callback = self.wakeup.set if queued else self.abort
+        if threading.get_ident() == self.loop_thread:
+            callback()
+        else:
+            self.loop.call_soon_threadsafe(callback)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                buffers = self.outbound.drain()
+                if buffers:
+                    self.writer.writelines(buffers)
+                    await self.writer.drain()
+                if len(self.outbound):
+                    self.wakeup.set()  # The rest of a streamed DOC_STATE
+                elif self.outbound.closed:
+                    break
+        except ConnectionError:
+            self.abort()
+        self.writer.close()
+
+    def abort(self):
+        """Drops a client that fell too far behind; its reader coroutine then cleans up."""
+        if not self.outbound.closed:
+            log.warning("Disconnecting %s (%s): outbound queue over budget or socket error.", self.user_id, self.peer)
+        self.outbound.close()
+        self.wakeup.set()
+        self.writer.transport.abort()
+
+    def close(self):
+        self.outbound.close(discard=False)
+        self.wakeup.set()
+        self.loop.call_later(CLOSE_FLUSH_TIMEOUT, self.writer.transport.abort)
+
+
+async def handle_client_async(reader, writer, executor):
+    """Serves one client on the event loop; blocking routes are pushed to `executor`."""
+    conn = AsyncClientConnection(writer)
+    register_client(conn)
+    loop = conn.loop
+
+    try:
+        while True:
+            message, size = await read_sized_message_async(reader, frame_limit(conn))
+            if message is None:
+                break
+            record_inbound(message, size)
+            throttled = throttle(conn, message, size)
+            if throttled is not None:
+                if not throttled:
+                    break
+                continue
+            if message.get("type") in AUTH_ROUTES:
+                keep_open = await run_auth_route_async(conn, message, executor)
+            elif message.get("type") in BLOCKING_ROUTES:
+                keep_open = await loop.run_in_executor(executor, handle_message, conn, message)
+            else:
+                keep_open = handle_message(conn, message)
+            if not keep_open:
                 break
+    except FrameTooLarge as e:
+        refuse_frame(conn, e)
+    except asyncio.CancelledError:
+        pass  # Server shutting down: clean up and end normally
+    except Exception as e:
+        log.error("Error handling client %s (%s): %s", conn.user_id, conn.peer, e)
+
+    # --- CLEANUP ---
+    unregister_client(conn)
+    conn.close()
+
+def raise_open_file_limit():
+    """Lifts the soft file descriptor limit to the hard limit (one fd per connection)."""
+    try:
+        import resource
+    except ImportError:
+        return  # Not available on Windows
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            log.warning("Could not raise open file limit (%d): %s", soft, e)
+
+async def serve_async():
+    executor = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS, thread_name_prefix="blocking-route")
+    client_tasks = set()
+
+    async def serve_client(reader, writer):
+        task = asyncio.current_task()
+        client_tasks.add(task)
+        try:
+            await handle_client_async(reader, writer, executor)
+        finally:
+            client_tasks.discard(task)
+
+    server = await asyncio.start_server(
+        serve_client, HOST, PORT, backlog=ASYNC_LISTEN_BACKLOG, reuse_address=True,
+    )
+    log.info("Async server listening on %s:%d", HOST, PORT)
+    try:
+        await server.serve_forever()
+    finally:
+        # Ctrl-C: stop accepting, then end every client before the event loop goes away.
+        server.close()
+        for task in client_tasks:
+            task.cancel()
+        await asyncio.gather(*client_tasks, return_exceptions=True)
+        await server.wait_closed()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def start_async_server():
+    """Starts the single-process asyncio server; same protocol and routes as start_server."""
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+    load_document()
+    start_metrics_endpoint()
+    raise_open_file_limit()
+    try:
+        asyncio.run(serve_async())
+    except KeyboardInterrupt:
+        log.info("Server shutting down...")
+        documents.save_all()
+        chat_history.flush()
+        log.info("Autosave stats: %s", documents.autosave.stats())
 
 if __name__ == "__main__":
-    start_server()
+    configure_logging()
+    if "--async" in sys.argv[1:]:
+        start_async_server()
+    else:
+        start_server()
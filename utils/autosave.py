@@ -0,0 +1,107 @@
+# utils/autosave.py
+# Write-behind saving of documents to their .txt files.
+import threading
+import time
+
+from utils.log import get_logger
+from utils.oplog import atomic_write
+
+log = get_logger("autosave")
+
+
+class AutosaveScheduler:
+    """
+    Saves dirty documents from one background worker thread.
+
+    schedule() only records a deadline, so it is safe to call with a document lock
+    held. The worker copies the document state under its lock (text is an immutable
+    Rope, so this is a reference grab), releases the lock and streams the file out
+    with an atomic replace. A document already waiting to be saved is written once, however
+    many times it was scheduled in the meantime.
+    """
+
+    def __init__(self, delay=2.0):
+        self.delay = delay  # seconds an edit may wait before it is written
+        self._due = {}  # {document: monotonic deadline}
+        self._cond = threading.Condition()  # guards _due, counters and Document.saved_revision
+        # --- Counters ---
+        self.saves = 0
+        self.coalesced = 0  # save requests folded into an already pending write
+        self.failures = 0
+        self.bytes_written = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        threading.Thread(target=self._run, name="autosave", daemon=True).start()
+
+    def schedule(self, doc, delay=None):
+        """Asks for doc to be written within `delay` seconds (default: self.delay)."""
+        deadline = time.monotonic() + (self.delay if delay is None else delay)
+        with self._cond:
+            current = self._due.get(doc)
+            if current is not None:
+                self.coalesced += 1
+                if current <= deadline:
+                    return
+            self._due[doc] = deadline
+            self._cond.notify()
+
+    def save_now(self, doc, timeout=None):
+        """
+        Writes doc as soon as possible and blocks until the state it has now is on
+        disk. Does not hold the document lock while waiting. Returns False on timeout.
+        """
+        with doc.lock:
+            target = doc.engine.revision
+        with self._cond:
+            if doc.saved_revision == target:
+                return True
+        self.schedule(doc, delay=0)
+        with self._cond:
+            return self._cond.wait_for(lambda: doc.saved_revision >= target, timeout)
+
+    def stats(self):
+        with self._cond:
+            return {"saves": self.saves, "coalesced": self.coalesced, "failures": self.failures,
+                    "pending": len(self._due), "bytes_written": self.bytes_written,
+                    "avg_latency_ms": self.total_latency / self.saves * 1000 if self.saves else 0.0,
+                    "max_latency_ms": self.max_latency * 1000}
+
+    # --- Worker thread ---
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [doc for doc, deadline in self._due.items() if deadline <= now]
+                    if due:
+                        break
+                    self._cond.wait(min(self._due.values()) - now if self._due else None)
+                for doc in due:
+                    del self._due[doc]
+            for doc in due:
+                self._write(doc)
+
+    def _write(self, doc):
+        started = time.perf_counter()
+        with doc.lock:
+            text, revision = doc.engine.text, doc.engine.revision
+        if revision == doc.saved_revision:
+            return  # Nothing changed since the last write
+
+        try:
+            written = atomic_write(doc.path, text.encoded_chunks())
+        except OSError as e:
+            log.error("Autosave of %s failed: %s", doc.doc_id, e)
+            with self._cond:
+                self.failures += 1
+            self.schedule(doc)  # Retry later; edits stay safe in the write-ahead log
+            return
+
+        elapsed = time.perf_counter() - started
+        with self._cond:
+            doc.saved_revision = max(doc.saved_revision, revision)
+            self.saves += 1
+            self.bytes_written += written
+            self.total_latency += elapsed
+            self.max_latency = max(self.max_latency, elapsed)
+            self._cond.notify_all()
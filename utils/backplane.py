@@ -0,0 +1,423 @@
+# utils/backplane.py
+# Pub/sub between server processes: ordered channels plus single-owner claims.
+#
+# Several server processes on one host (or several hosts, over TCP) share a broker:
+#   python -m utils.backplane unix:/tmp/notepad-backplane.sock
+#   python -m utils.backplane tcp:0.0.0.0:7000
+# and each server is started with NOTEPAD_BACKPLANE set to the same address.
+# NOTEPAD_BACKPLANE=local uses an in-process broker (several nodes in one process, for tests).
+import itertools
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from utils.log import configure_logging, get_logger
+from utils.metrics import registry
+from utils.protocol_helpers import Frame, FrameReader, encode_frame, send_buffers
+
+DEFAULT_ADDRESS = "unix:/tmp/notepad-backplane.sock"
+RELEASED_CHANNEL = "owners"  # {"kind": "released", "keys": [...], "node": id} when a node leaves
+CLAIM_TIMEOUT = 5.0  # seconds to wait for the broker to answer a claim
+RECONNECT_INITIAL_DELAY = 0.5  # seconds before the first reconnect attempt, doubled up to
+RECONNECT_MAX_DELAY = 10.0
+
+log = get_logger("backplane")
+PUBLISHED = registry.counter("backplane_published")
+RECEIVED = registry.counter("backplane_received")
+
+
+class Backplane:
+    """
+    One server process's (node's) connection to the others.
+
+    publish(channel, message) reaches every node subscribed to the channel except
+    the sender; messages from one sender arrive in the order they were published.
+    Callbacks run as callback(channel, message) on a single dispatch thread per
+    node, one at a time. claim(key) makes the caller the owner of key unless some
+    node already is, and returns the owner's node ID; a node's claims are released,
+    and announced on RELEASED_CHANNEL, when it disconnects.
+    """
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self._callbacks = {}  # {channel: callback}
+        self._inbox = queue.Queue()
+        threading.Thread(target=self._dispatch, name="backplane-dispatch", daemon=True).start()
+
+    def subscribe(self, channel, callback):
+        self._callbacks[channel] = callback
+        self._subscribe(channel)
+
+    def unsubscribe(self, channel):
+        self._callbacks.pop(channel, None)
+        self._unsubscribe(channel)
+
+    def _deliver(self, channel, message):
+        RECEIVED.inc()
+        self._inbox.put((channel, message))
+
+    def _dispatch(self):
+        while True:
+            channel, message = self._inbox.get()
+            callback = self._callbacks.get(channel)
+            if callback is None:
+                continue  # Unsubscribed while the message was in flight
+            try:
+                callback(channel, message)
+            except Exception as e:
+                log.error("Backplane handler for %s failed: %s", channel, e)
+
+
+# --- In-process broker ---
+class LocalBroker:
+    """
+    Channels and owner claims held in memory. Used directly by LocalBackplane and,
+    behind a socket, by BrokerServer. A node is any object with `node_id` and
+    `_deliver(channel, message)`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # {channel: set of nodes}
+        self._owners = {}  # {key: node_id}
+
+    def subscribe(self, node, channel):
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(node)
+
+    def unsubscribe(self, node, channel):
+        with self._lock:
+            nodes = self._subscribers.get(channel)
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del self._subscribers[channel]
+
+    def publish(self, sender, channel, message):
+        with self._lock:
+            targets = [node for node in self._subscribers.get(channel, ()) if node is not sender]
+        for node in targets:
+            node._deliver(channel, message)
+
+    def claim(self, node, key):
+        with self._lock:
+            return self._owners.setdefault(key, node.node_id)
+
+    def leave(self, node):
+        """Drops a node's subscriptions and releases its claims."""
+        with self._lock:
+            for channel in [c for c, nodes in self._subscribers.items() if node in nodes]:
+                self._subscribers[channel].discard(node)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+            keys = [key for key, owner in self._owners.items() if owner == node.node_id]
+            for key in keys:
+                del self._owners[key]
+        if keys:
+            log.info("Node %s left; released %d claims.", node.node_id, len(keys))
+            self.publish(node, RELEASED_CHANNEL, {"kind": "released", "keys": keys, "node": node.node_id})
+
+
+_local_broker = LocalBroker()
+
+
+class LocalBackplane(Backplane):
+    """A node attached to an in-process LocalBroker (default: one shared per process)."""
+
+    def __init__(self, node_id, broker=None):
+        super().__init__(node_id)
+        self.broker = broker or _local_broker
+
+    def _subscribe(self, channel):
+        self.broker.subscribe(self, channel)
+
+    def _unsubscribe(self, channel):
+        self.broker.unsubscribe(self, channel)
+
+    def publish(self, channel, message):
+        PUBLISHED.inc()
+        self.broker.publish(self, channel, message)
+
+    def claim(self, key):
+        return self.broker.claim(self, key)
+
+    def close(self):
+        self.broker.leave(self)
+
+
+# --- Socket broker ---
+def parse_address(address):
+    """'unix:/path' or 'tcp:host:port' -> (socket family, address)."""
+    scheme, _, rest = address.partition(":")
+    if scheme == "unix":
+        return socket.AF_UNIX, rest
+    if scheme == "tcp":
+        host, _, port = rest.rpartition(":")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"unknown backplane address {address!r} (use unix:/path or tcp:host:port)")
+
+
+class SocketBackplane(Backplane):
+    """
+    A node connected to a BrokerServer. Frames are the client protocol's
+    (protocol_helpers): {"op": "hello" | "sub" | "unsub" | "pub" | "claim", ...} up,
+    {"op": "msg" | "claimed", ...} down.
+
+    If the broker connection is lost, the node keeps serving its own clients:
+    publish() drops messages for the other nodes (logged once per outage) and
+    claim() raises ConnectionError, while a background thread reconnects with
+    backoff, subscribes again and claims again the keys this node owned.
+    """
+
+    def __init__(self, address, node_id):
+        super().__init__(node_id)
+        self.address = address
+        self.sock = None  # None while disconnected
+        self._send_lock = threading.Lock()  # guards sock and the frames written to it
+        self._claims = {}  # {request id: Future}
+        self._ids = itertools.count(1)
+        self._owned = set()  # keys claimed by this node, claimed again after a reconnect
+        self._dropped = 0  # messages published during the current outage
+        self._closed = False
+        self._connect()
+        threading.Thread(target=self._run, name="backplane-reader", daemon=True).start()
+
+    def _connect(self):
+        """Opens the connection, announces the node and (again) its subscriptions and claims."""
+        family, target = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(target)
+        except OSError:
+            sock.close()
+            raise
+        with self._send_lock:
+            self.sock = sock
+            try:
+                self._write({"op": "hello", "node": self.node_id})
+                for channel in list(self._callbacks):
+                    self._write({"op": "sub", "channel": channel})
+                for key in list(self._owned):
+                    self._write({"op": "claim", "key": key, "id": self._track_claim(key)})
+            except OSError:
+                self.sock = None
+                sock.close()
+                raise
+
+    def _track_claim(self, key):
+        """Registers a claim sent on reconnect; nobody waits for its reply, so check it here."""
+        request_id = next(self._ids)
+        future = self._claims[request_id] = Future()
+
+        def claimed(future):
+            self._claims.pop(request_id, None)
+            if future.exception() is None and future.result() != self.node_id:
+                self._owned.discard(key)
+                log.error("'%s' was claimed by node %s while this node was disconnected.", key, future.result())
+
+        future.add_done_callback(claimed)
+        return request_id
+
+    def _write(self, message):
+        # Call with _send_lock held.
+        if self.sock is None:
+            raise ConnectionError("not connected to the backplane broker")
+        send_buffers(self.sock, encode_frame(message))
+
+    def _send(self, message):
+        with self._send_lock:
+            try:
+                self._write(message)
+            except OSError:
+                self._shutdown()  # The reader thread sees the closed socket and reconnects
+                raise
+
+    def _shutdown(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _subscribe(self, channel):
+        try:
+            self._send({"op": "sub", "channel": channel})
+        except OSError:
+            pass  # Subscribed again once reconnected
+
+    def _unsubscribe(self, channel):
+        try:
+            self._send({"op": "unsub", "channel": channel})
+        except OSError:
+            pass  # Not subscribed again once reconnected
+
+    def publish(self, channel, message):
+        PUBLISHED.inc()
+        try:
+            self._send({"op": "pub", "channel": channel, "message": message})
+        except OSError as e:
+            # Local delivery does not go through the broker; only the other nodes miss it.
+            self._dropped += 1
+            if self._dropped == 1:
+                log.warning("Backplane broker unreachable (%s); publishing to this node only.", e)
+
+    def claim(self, key):
+        """Returns the owner of key. Raises ConnectionError while the broker is unreachable."""
+        request_id = next(self._ids)
+        future = self._claims[request_id] = Future()
+        try:
+            self._send({"op": "claim", "key": key, "id": request_id})
+            owner = future.result(CLAIM_TIMEOUT)
+        finally:
+            self._claims.pop(request_id, None)
+        if owner == self.node_id:
+            self._owned.add(key)
+        return owner
+
+    def close(self):
+        self._closed = True
+        with self._send_lock:
+            self._shutdown()
+            if self.sock is not None:
+                self.sock.close()
+
+    def _run(self):
+        while True:
+            self._read_loop(self.sock)
+            with self._send_lock:
+                sock, self.sock = self.sock, None
+            sock.close()
+            for request_id in list(self._claims):
+                future = self._claims.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_exception(ConnectionError("lost the connection to the backplane broker"))
+            if self._closed:
+                return
+            log.error("Lost the connection to the backplane broker; reconnecting.")
+            if not self._reconnect():
+                return
+
+    def _reconnect(self):
+        """Retries with exponential backoff until connected (True) or closed (False)."""
+        delay = RECONNECT_INITIAL_DELAY
+        while not self._closed:
+            time.sleep(delay)
+            try:
+                self._connect()
+            except OSError as e:
+                log.warning("Backplane broker still unreachable: %s", e)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            log.info("Reconnected to the backplane broker at %s (%d messages were not relayed).",
+                     self.address, self._dropped)
+            self._dropped = 0
+            return True
+        return False
+
+    def _read_loop(self, sock):
+        # Claim replies are resolved here, not on the dispatch thread, so handlers may claim.
+        reader = FrameReader(sock)
+        while True:
+            message = reader.read_message()
+            if message is None:
+                return
+            if message.get("op") == "msg":
+                self._deliver(message["channel"], message["message"])
+            elif message.get("op") == "claimed":
+                future = self._claims.get(message.get("id"))
+                if future is not None and not future.done():
+                    future.set_result(message["owner"])
+
+
+class _BrokerClient:
+    """A node connected to BrokerServer; frames for it are sent by its own writer thread."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.node_id = None
+        self.outbox = queue.Queue()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _deliver(self, channel, message):
+        if not isinstance(message, Frame):
+            message = Frame({"op": "msg", "channel": channel, "message": message})
+        self.outbox.put(message.buffers())
+
+    def _write_loop(self):
+        while True:
+            buffers = self.outbox.get()
+            if buffers is None:
+                return
+            try:
+                send_buffers(self.sock, buffers)
+            except OSError:
+                return
+
+
+class BrokerServer:
+    """Serves a LocalBroker to server processes over a Unix or TCP socket."""
+
+    def __init__(self, address=DEFAULT_ADDRESS):
+        self.address = address
+        self.broker = LocalBroker()
+
+    def serve_forever(self):
+        family, target = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(target):
+            os.unlink(target)  # Left over from a previous broker
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(target)
+            sock.listen()
+            log.info("Backplane broker listening on %s", self.address)
+            while True:
+                client_sock, _ = sock.accept()
+                threading.Thread(target=self._serve_client, args=(client_sock,), daemon=True).start()
+
+    def _serve_client(self, sock):
+        client = _BrokerClient(sock)
+        reader = FrameReader(sock)
+        while True:
+            message = reader.read_message()
+            if message is None:
+                break
+            op = message.get("op")
+            if op == "pub":
+                channel = message["channel"]
+                # Encoded once for every subscriber.
+                frame = Frame({"op": "msg", "channel": channel, "message": message["message"]})
+                self.broker.publish(client, channel, frame)
+            elif op == "sub":
+                self.broker.subscribe(client, message["channel"])
+            elif op == "unsub":
+                self.broker.unsubscribe(client, message["channel"])
+            elif op == "claim":
+                owner = self.broker.claim(client, message["key"])
+                client.outbox.put(encode_frame({"op": "claimed", "id": message["id"], "owner": owner}))
+            elif op == "hello":
+                client.node_id = message["node"]
+                log.info("Node %s joined.", client.node_id)
+        if client.node_id is not None:
+            self.broker.leave(client)
+        client.outbox.put(None)
+        sock.close()
+
+
+def connect_backplane(address, node_id):
+    """'local' for the in-process broker, else the address of a BrokerServer."""
+    if address == "local":
+        return LocalBackplane(node_id)
+    return SocketBackplane(address, node_id)
+
+
+if __name__ == "__main__":
+    configure_logging()
+    try:
+        BrokerServer(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_ADDRESS).serve_forever()
+    except KeyboardInterrupt:
+        pass
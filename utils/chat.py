@@ -0,0 +1,240 @@
+# utils/chat.py
+# Recent chat per document in memory, written to the database in batches.
+import threading
+import time
+from collections import OrderedDict, deque
+
+from utils.log import get_logger
+
+log = get_logger("chat")
+
+
+class ChatHistory:
+    """
+    Keeps the last `buffer_size` chat messages of each document in a ring buffer
+    and hands new ones to a background writer, so CHAT never waits for the
+    database. Messages are dicts {"user", "text", "ts"} (ts: time.time()).
+
+    `store` is an object with insert(rows) -> bool, rows being (doc_id, user,
+    text, ts) tuples, and before(doc_id, ts, limit) -> messages older than ts,
+    oldest first (see utils.database.ChatStore).
+
+    A ring always holds a contiguous run of a document's newest messages. Until it
+    has been topped up from the store ("loaded"), older messages may exist only in
+    the database, so reads that need more than the ring has go there.
+    """
+
+    def __init__(self, store, buffer_size=200, max_documents=1000, flush_interval=0.5,
+                 batch_size=500, max_pending=10000):
+        self.store = store
+        self.buffer_size = buffer_size
+        self.max_documents = max_documents  # rings kept, least recently used dropped first
+        self.flush_interval = flush_interval  # seconds a message may wait before it is written
+        self.batch_size = batch_size
+        self.max_pending = max_pending  # unwritten rows kept while the database is failing
+        self._rings = OrderedDict()  # {doc_id: _Ring}
+        self._lock = threading.Lock()
+        self._pending = []  # rows not yet written
+        self._cond = threading.Condition()  # guards _pending and the counters below
+        self._flushing = False
+        # --- Counters ---
+        self.recorded = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.rejected = 0
+        threading.Thread(target=self._run, name="chat-writer", daemon=True).start()
+
+    # --- Recording ---
+    def record(self, doc_id, user, text, persist=True):
+        """Adds a message to doc_id's ring (and, if persist, to the next batch). Returns it."""
+        message = {"user": user, "text": text, "ts": time.time()}
+        self.remember(doc_id, message, persist)
+        return message
+
+    def remember(self, doc_id, message, persist=False):
+        """Adds an already timestamped message, e.g. one relayed from another server process."""
+        with self._lock:
+            self._ring(doc_id).messages.append(message)
+        if not persist:
+            return
+        with self._cond:
+            self.recorded += 1
+            self._pending.append((doc_id, message["user"], message["text"], message["ts"]))
+            if len(self._pending) > self.max_pending:
+                overflow = len(self._pending) - self.max_pending
+                del self._pending[:overflow]
+                self.dropped += overflow
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _ring(self, doc_id):
+        ring = self._rings.get(doc_id)
+        if ring is None:
+            ring = self._rings[doc_id] = _Ring(self.buffer_size)
+            while len(self._rings) > self.max_documents:
+                self._rings.popitem(last=False)
+        else:
+            self._rings.move_to_end(doc_id)
+        return ring
+
+    # --- Reading ---
+    def recent(self, doc_id, limit):
+        """The newest `limit` messages of doc_id, oldest first."""
+        return self.page(doc_id, None, limit)
+
+    def page(self, doc_id, before, limit):
+        """Up to `limit` messages older than `before` (None: the newest), oldest first."""
+        with self._lock:
+            ring = self._ring(doc_id)
+            buffered = [m for m in ring.messages if before is None or m["ts"] < before]
+            complete = ring.loaded and len(ring.messages) < self.buffer_size
+            oldest = ring.messages[0]["ts"] if ring.messages else None
+        if len(buffered) >= limit or complete:
+            return buffered[-limit:] if limit > 0 else []
+
+        # The rest is older than the ring: fetch it (after writing what is still queued).
+        self.flush()
+        cutoff = before if oldest is None or (before is not None and before < oldest) else oldest
+        older = self.store.before(doc_id, cutoff if cutoff is not None else float("inf"), limit - len(buffered))
+        if before is None:
+            self._top_up(doc_id, older)
+        return older + buffered
+
+    def _top_up(self, doc_id, older):
+        """Puts messages read from the store in front of a ring that has room for them."""
+        with self._lock:
+            ring = self._ring(doc_id)
+            oldest = ring.messages[0]["ts"] if ring.messages else float("inf")
+            merged = [m for m in older if m["ts"] < oldest] + list(ring.messages)
+            ring.messages = deque(merged[-self.buffer_size:], maxlen=self.buffer_size)
+            ring.loaded = True
+
+    # --- Writer thread ---
+    def flush(self):
+        """Writes every queued message now; returns once they are in the database (or failed)."""
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+            rows, self._pending = self._pending, []
+            self._flushing = True
+        try:
+            self._write(rows)
+        finally:
+            with self._cond:
+                self._flushing = False
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) >= self.batch_size, self.flush_interval)
+                if not self._pending:
+                    continue
+            self.flush()
+
+    def _write(self, rows):
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            if self.store.insert(batch):
+                with self._cond:
+                    self.written += len(batch)
+                    self.batches += 1
+                continue
+            if self._write_one_by_one(batch):
+                continue
+            # Nothing was written: keep the rest for the next round; the database may be back by then.
+            log.warning("Chat batch of %d messages not written; retrying later.", len(batch))
+            with self._cond:
+                self.failures += 1
+                self._pending[:0] = rows[start:]
+            return
+
+    def _write_one_by_one(self, batch):
+        """
+        Writes a failed batch a row at a time, so one row the database refuses cannot
+        hold up the others. If any row is written the database is up, and the rows it
+        refused are dropped (counted as rejected). Returns whether any row was written.
+        """
+        refused = [row for row in batch if not self.store.insert([row])]
+        written = len(batch) - len(refused)
+        with self._cond:
+            self.written += written
+            self.batches += written
+            if written:
+                self.rejected += len(refused)
+        if written and refused:
+            log.error("Dropped %d chat messages the database refused, e.g. %r.", len(refused), refused[0])
+        return written > 0
+
+    def stats(self):
+        with self._cond:
+            stats = {"recorded": self.recorded, "written": self.written, "batches": self.batches,
+                     "pending": len(self._pending), "failures": self.failures, "dropped": self.dropped,
+                     "rejected": self.rejected}
+        with self._lock:
+            stats["buffered_documents"] = len(self._rings)
+        return stats
+
+
+class _Ring:
+    __slots__ = ("messages", "loaded")
+
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)
+        self.loaded = False  # topped up from the store: it holds all there is, up to its size
+
+
+# --- Optional Local Test Block ---
+if __name__ == "__main__":
+    class MemoryStore:
+        def __init__(self):
+            self.rows = []
+
+        def insert(self, rows):
+            self.rows.extend(rows)
+            return True
+
+        def before(self, doc_id, ts, limit):
+            found = [{"user": u, "text": t, "ts": s} for d, u, t, s in self.rows if d == doc_id and s < ts]
+            return found[-limit:]
+
+    store = MemoryStore()
+    history = ChatHistory(store, buffer_size=5, flush_interval=0.05)
+    for i in range(12):
+        history.record("doc", "alice", f"message {i}")
+    print("Recent From Ring:", [m["text"] for m in history.recent("doc", 3)])
+    time.sleep(0.2)
+    print("Written In Batches:", len(store.rows) == 12, history.stats())
+
+    oldest = history.recent("doc", 5)[0]["ts"]
+    print("Page From Store:", [m["text"] for m in history.page("doc", oldest, 4)])
+
+    restarted = ChatHistory(store, buffer_size=5)
+    print("Cold Ring Loaded From Store:", [m["text"] for m in restarted.recent("doc", 5)])
+    restarted.record("doc", "bob", "after restart")
+    print("Ring After Load:", [m["text"] for m in restarted.recent("doc", 3)])
+
+    class PickyStore(MemoryStore):
+        def insert(self, rows):
+            if any(not isinstance(text, str) for _, _, text, _ in rows):
+                return False  # Like a driver that cannot bind the value
+            return super().insert(rows)
+
+    picky = PickyStore()
+    checked = ChatHistory(picky, flush_interval=60)
+    checked.record("doc", "alice", "before")
+    checked.record("doc", "mallory", {"not": "text"})
+    checked.record("doc", "alice", "after")
+    checked.flush()
+    print("Refused Row Dropped:", [t for _, _, t, _ in picky.rows] == ["before", "after"], checked.stats())
+
+    class DownStore(MemoryStore):
+        def insert(self, rows):
+            return False
+
+    waiting = ChatHistory(DownStore(), flush_interval=60)
+    waiting.record("doc", "alice", "while the database is down")
+    waiting.flush()
+    print("Kept While Down:", waiting.stats()["pending"] == 1 and waiting.stats()["rejected"] == 0)
@@ -0,0 +1,379 @@
+# utils/cluster.py
+# Documents shared by several server processes over a backplane (utils/backplane.py).
+#
+# Every document has one owner process, the first to claim it. The owner holds
+# the MergeEngine, the write-ahead log and the .txt file, and orders every edit.
+# Other processes keep a RemoteDocument: its local subscribers, plus a short
+# buffer of recent broadcasts. Edits from their clients are forwarded to the
+# owner; the owner publishes each accepted edit on the document's channel and
+# every process delivers it to its own subscribers.
+#
+# Channels: "doc:<id>"  broadcasts of a document, in revision order
+#           "node:<id>" requests to a process and replies from owners
+#           "all"       server-wide notifications
+# Processes must share the documents directory (same host or shared storage).
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from utils.backplane import RELEASED_CHANNEL
+from utils.documents import DocumentManager, catch_up_messages
+from utils.log import get_logger
+from utils.protocol_helpers import Frame
+
+GLOBAL_CHANNEL = "all"
+CATCH_UP_BUFFER = 1000  # broadcasts a RemoteDocument keeps for clients waiting for their state
+REVISION_TYPES = ("EDIT_OP", "EDIT_UPDATE")
+REQUEST_TIMEOUT = 10.0  # seconds to wait for an owner's answer to a history request
+
+log = get_logger("cluster")
+
+
+def doc_channel(doc_id):
+    return f"doc:{doc_id}"
+
+
+def node_channel(node_id):
+    return f"node:{node_id}"
+
+
+class RemoteDocument:
+    """
+    A document owned by another process, as seen by this one. Quacks like a
+    Document where the server's routes need it to (doc_id, lock, subscribers,
+    broadcast, save, history); edits go through forward_edit / forward_replace instead.
+
+    Each subscriber has the last revision delivered to it, or None while its
+    state is being fetched from the owner. Broadcasts arriving meanwhile are kept
+    in `_recent` and replayed once the state arrives, so nothing is lost or
+    delivered twice whatever order the two channels deliver in.
+    """
+    remote = True
+
+    def __init__(self, doc_id, manager):
+        self.doc_id = doc_id
+        self.manager = manager
+        self.lock = threading.Lock()
+        self.subscribers = set()  # modified under `lock`
+        self._delivered = {}  # {conn: last revision sent, or None while waiting for state}
+        self._recent = deque(maxlen=CATCH_UP_BUFFER)  # [(revision, message_dict, origin)]
+
+    # --- Subscribers (server threads) ---
+    def add_subscriber(self, conn, since=None):
+        with self.lock:
+            self.subscribers.add(conn)
+            self._delivered[conn] = None
+        conn.document = self
+        self.manager.request_state(self, conn, since)
+
+    def remove_subscriber(self, conn):
+        with self.lock:
+            self.subscribers.discard(conn)
+            self._delivered.pop(conn, None)
+        conn.document = None
+
+    # --- Requests to the owner ---
+    def forward_edit(self, conn, message):
+        self.manager.send_to_owner(self.doc_id, {"kind": "edit", "version": message.get("version"),
+                                                 "ops": message.get("ops", []), "origin": conn.session_id,
+                                                 "user": conn.user_id})
+
+    def forward_replace(self, conn, content):
+        self.manager.send_to_owner(self.doc_id, {"kind": "replace", "content": content, "origin": conn.session_id})
+
+    def save(self, timeout=None):
+        """Asks the owner to save. Returns False on timeout, like Document.save."""
+        try:
+            return self.manager.request(self.doc_id, {"kind": "save", "timeout": timeout}).result(timeout)
+        except FutureTimeout:
+            return False
+
+    def history_page(self, before=None, limit=50):
+        """Asks the owner, like Document.history_page. Returns None on timeout."""
+        return self._ask({"kind": "history", "before": before, "limit": limit})
+
+    def read_revision(self, revision=None, at=None):
+        """Asks the owner, like Document.read_revision. Returns None on timeout."""
+        return self._ask({"kind": "revision", "revision": revision, "at": at})
+
+    def _ask(self, request):
+        try:
+            return self.manager.request(self.doc_id, request).result(REQUEST_TIMEOUT)
+        except FutureTimeout:
+            return None
+
+    def broadcast(self, message_dict, exclude=None, replicate=True):
+        """Chat and notifications: to local subscribers, and to the other processes."""
+        frame = Frame(message_dict)
+        for conn in list(self.subscribers):
+            if conn is not exclude:
+                conn.send(frame)
+        if replicate:
+            self.manager.backplane.publish(doc_channel(self.doc_id), {"message": message_dict, "origin": None})
+
+    # --- From the backplane (dispatch thread) ---
+    def deliver(self, message_dict, origin):
+        """Fans a broadcast from the owner (or a peer, for chat) out to local subscribers."""
+        revision = message_dict.get("version") if message_dict.get("type") in REVISION_TYPES else None
+        sends = []
+        with self.lock:
+            if revision is not None:
+                self._recent.append((revision, message_dict, origin))
+            for conn in self.subscribers:
+                delivered = self._delivered.get(conn)
+                if revision is None:
+                    sends.append((conn, message_dict))
+                elif delivered is not None and revision > delivered:
+                    self._delivered[conn] = revision
+                    sends.append((conn, self._for_subscriber(conn, message_dict, origin)))
+        frame = Frame(message_dict)
+        for conn, message in sends:
+            if message is not None:
+                conn.send(frame if message is message_dict else message)
+
+    def catch_up(self, conn, state, entries):
+        """
+        Brings one subscriber to the owner's state: DOC_STATE (or the entries it
+        missed, when resuming), then whatever was broadcast after that state.
+        Returns False if broadcasts it needs were already dropped from `_recent`.
+        """
+        revision = state["version"]
+        with self.lock:
+            if conn not in self.subscribers:
+                return True
+            later = [entry for entry in self._recent if entry[0] > revision]
+            if later and later[0][0] != revision + 1:
+                return False
+            if entries is None:
+                messages = [state]
+            else:
+                messages = catch_up_messages(self.doc_id, entries, conn.session_id)
+            for entry_revision, message_dict, origin in later:
+                messages.append(self._for_subscriber(conn, message_dict, origin))
+                revision = entry_revision
+            self._delivered[conn] = revision
+        for message in messages:
+            if message is not None:
+                conn.send(message)
+        return True
+
+    def _for_subscriber(self, conn, message_dict, origin):
+        """What a subscriber gets for a broadcast: its own edits come back as EDIT_ACK only."""
+        if origin is None or origin != conn.session_id:
+            return message_dict
+        if message_dict.get("type") == "EDIT_OP":
+            return {"type": "EDIT_ACK", "doc_id": self.doc_id, "version": message_dict["version"]}
+        return None  # Its own EDIT_UPDATE
+
+    def connections(self):
+        with self.lock:
+            return list(self.subscribers)
+
+
+class ClusterDocumentManager(DocumentManager):
+    """
+    DocumentManager for one process of a cluster. get() and subscribe() return a
+    local Document for documents this process owns (claiming unowned ones) and a
+    RemoteDocument for the rest.
+
+    `on_global(message_dict)` delivers server-wide notifications from other
+    processes to this process's connections; `on_chat(doc_id, message_dict)` sees
+    every CHAT_MESSAGE another process relays for a document open here.
+    """
+
+    def __init__(self, directory, backplane, on_global=None, on_chat=None, **kwargs):
+        super().__init__(directory, **kwargs)
+        self.backplane = backplane
+        self.node_id = backplane.node_id
+        self.on_global = on_global
+        self.on_chat = on_chat
+        self._owners = {}  # {doc_id: owning node ID}, as claimed
+        self._proxies = {}  # {doc_id: RemoteDocument}
+        self._pending = {}  # {request id: Future or (RemoteDocument, conn)}
+        self._ids = itertools.count(1)
+        backplane.subscribe(node_channel(self.node_id), self._on_node_message)
+        backplane.subscribe(GLOBAL_CHANNEL, self._on_global_message)
+        backplane.subscribe(RELEASED_CHANNEL, self._on_released)
+
+    # --- Ownership ---
+    def owner_of(self, doc_id):
+        owner = self._owners.get(doc_id)
+        if owner is None:
+            owner = self._owners[doc_id] = self.backplane.claim(doc_id)
+            if owner == self.node_id:
+                log.info("This process now owns '%s'.", doc_id)
+        return owner
+
+    def get(self, doc_id):
+        """Returns the Document (owned here) or RemoteDocument for doc_id. Raises KeyError/ValueError."""
+        self.path_for(doc_id)  # Validates the ID
+        if not self.exists(doc_id):
+            raise KeyError(doc_id)
+        if self.owner_of(doc_id) == self.node_id:
+            return super().get(doc_id)
+        with self._lock:
+            proxy = self._proxies.get(doc_id)
+            if proxy is None:
+                proxy = self._proxies[doc_id] = RemoteDocument(doc_id, self)
+                self.backplane.subscribe(doc_channel(doc_id), self._on_doc_message)
+        return proxy
+
+    def create(self, doc_id, text=""):
+        self.path_for(doc_id)
+        if self.exists(doc_id) or self.owner_of(doc_id) != self.node_id:
+            raise FileExistsError(doc_id)  # Another process is creating it
+        return super().create(doc_id, text)
+
+    def _add(self, doc):
+        doc = super()._add(doc)
+        if doc.replicate is None:
+            channel = doc_channel(doc.doc_id)
+            doc.replicate = lambda message_dict, origin: self.backplane.publish(
+                channel, {"message": message_dict, "origin": origin})
+            self.backplane.subscribe(channel, self._on_doc_message)
+        return doc
+
+    # --- Subscriptions ---
+    def subscribe(self, conn, doc_id, since=None):
+        doc = self.get(doc_id)
+        if not doc.remote:
+            return super().subscribe(conn, doc_id, since)
+        self.unsubscribe(conn)
+        doc.add_subscriber(conn, since)
+        return doc
+
+    def unsubscribe(self, conn):
+        doc = conn.document
+        if doc is not None and doc.remote:
+            doc.remove_subscriber(conn)
+        else:
+            super().unsubscribe(conn)
+
+    def publish_global(self, message_dict):
+        self.backplane.publish(GLOBAL_CHANNEL, message_dict)
+
+    # --- Requests to owners ---
+    def send_to_owner(self, doc_id, request):
+        request = dict(request, doc_id=doc_id, reply_to=self.node_id)
+        self.backplane.publish(node_channel(self.owner_of(doc_id)), request)
+
+    def request(self, doc_id, request):
+        """Sends a request that gets a {"kind": "reply"} back. Returns a Future of its result."""
+        request_id = next(self._ids)
+        future = self._pending[request_id] = Future()
+        self.send_to_owner(doc_id, dict(request, request_id=request_id))
+        return future
+
+    def request_state(self, proxy, conn, since=None):
+        request_id = next(self._ids)
+        self._pending[request_id] = (proxy, conn)
+        self.send_to_owner(proxy.doc_id, {"kind": "state", "since": since, "request_id": request_id})
+
+    # --- Backplane handlers (dispatch thread) ---
+    def _on_doc_message(self, channel, payload):
+        doc_id = channel[len("doc:"):]
+        with self._lock:
+            proxy = self._proxies.get(doc_id)
+            doc = self._docs.get(doc_id)
+        message_dict = payload["message"]
+        if message_dict.get("type") == "CHAT_MESSAGE" and self.on_chat:
+            self.on_chat(doc_id, message_dict)
+        if proxy is not None:
+            proxy.deliver(message_dict, payload.get("origin"))
+        elif doc is not None:
+            doc.broadcast(message_dict, replicate=False)  # Chat from another process
+
+    def _on_global_message(self, channel, message_dict):
+        if self.on_global:
+            self.on_global(message_dict)
+
+    def _on_node_message(self, channel, message):
+        kind = message.get("kind")
+        if kind == "state_reply":
+            proxy, conn = self._pending.pop(message["request_id"], (None, None))
+            if proxy is not None and not proxy.catch_up(conn, message["state"], message.get("entries")):
+                self.request_state(proxy, conn)  # Fell behind while waiting: fetch a fresh state
+        elif kind == "reply":
+            future = self._pending.pop(message["request_id"], None)
+            if future is not None:
+                future.set_result(message["result"])
+        elif kind == "resync":
+            proxy = self._proxies.get(message["doc_id"])
+            for conn in proxy.connections() if proxy is not None else ():
+                if conn.session_id == message["origin"] and not proxy.catch_up(conn, message["state"], None):
+                    self.request_state(proxy, conn)
+        else:
+            self._serve_request(message)
+
+    def _serve_request(self, message):
+        """Handles a request for a document this process owns."""
+        doc_id, kind = message["doc_id"], message["kind"]
+        if self.owner_of(doc_id) != self.node_id:
+            log.warning("Dropped %s for '%s': owned by %s.", kind, doc_id, self._owners.get(doc_id))
+            return
+        doc = super().get(doc_id)
+        reply_channel = node_channel(message["reply_to"])
+
+        if kind == "edit":
+            with doc.lock:
+                try:
+                    revision, merged_ops = doc.submit(message.get("version"), message["ops"], origin=message["origin"])
+                    doc.queue_broadcast({"type": "EDIT_OP", "doc_id": doc_id, "ops": merged_ops,
+                                         "version": revision, "user": message.get("user")}, origin=message["origin"])
+                except ValueError as e:
+                    log.warning("Rejected forwarded EDIT_OP from %s: %s", message.get("user"), e)
+                    self.backplane.publish(reply_channel, {"kind": "resync", "doc_id": doc_id,
+                                                           "origin": message["origin"], "state": doc.state_message()})
+            doc.flush_outbox()
+
+        elif kind == "replace":
+            with doc.lock:
+                revision = doc.replace(message["content"], origin=message["origin"])
+                doc.queue_broadcast({"type": "EDIT_UPDATE", "doc_id": doc_id, "content": str(doc.engine.text),
+                                     "version": revision}, origin=message["origin"])
+            doc.flush_outbox()
+
+        elif kind == "state":
+            # Broadcasts up to this revision may reach the proxy before or after the
+            # reply (different channels); it skips whatever the state already covers.
+            with doc.lock:
+                since = message.get("since")
+                entries = doc.engine.entries_since(since) if since is not None else None
+                self.backplane.publish(reply_channel, {"kind": "state_reply", "request_id": message["request_id"],
+                                                       "state": doc.state_message(), "entries": entries})
+
+        elif kind in ("save", "history", "revision"):
+            # Waits for the disk, so off the dispatch thread.
+            def serve():
+                if kind == "save":
+                    result = doc.save(message.get("timeout"))
+                elif kind == "history":
+                    result = doc.history_page(message.get("before"), message["limit"])
+                else:
+                    result = doc.read_revision(message.get("revision"), message.get("at"))
+                self.backplane.publish(reply_channel, {"kind": "reply", "request_id": message["request_id"],
+                                                       "result": result})
+            threading.Thread(target=serve, daemon=True).start()
+
+    def _on_released(self, channel, message):
+        """An owner left: claim its documents we have subscribers for, or follow the new owner."""
+        for doc_id in message["keys"]:
+            self._owners.pop(doc_id, None)
+            with self._lock:
+                proxy = self._proxies.get(doc_id)
+            if proxy is not None:
+                threading.Thread(target=self._take_over, args=(proxy,), daemon=True).start()
+
+    def _take_over(self, proxy):
+        owner = self.owner_of(proxy.doc_id)
+        conns = proxy.connections()
+        if owner != self.node_id:
+            for conn in conns:
+                self.request_state(proxy, conn)
+            return
+        with self._lock:
+            self._proxies.pop(proxy.doc_id, None)
+        for conn in conns:
+            proxy.remove_subscriber(conn)
+            super().subscribe(conn, proxy.doc_id)
@@ -1,8 +1,27 @@
 # utils/database.py
-import psycopg2
-from psycopg2 import pool
-from psycopg2 import errors
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import psycopg2  # Only needed for the PostgreSQL backend
+    from psycopg2.extras import execute_batch
+except ImportError:
+    psycopg2 = None
 from utils.encryption import hash_password
+from utils.log import get_logger
+from utils.metrics import registry
+
+log = get_logger("database")
+FIND_SECONDS = registry.histogram("db_query_seconds", statement="find_user")
+INSERT_SECONDS = registry.histogram("db_query_seconds", statement="insert_user")
+CHAT_INSERT_SECONDS = registry.histogram("db_query_seconds", statement="insert_chat")
+CHAT_PAGE_SECONDS = registry.histogram("db_query_seconds", statement="chat_before")
+
+DB_ERRORS = (sqlite3.Error, psycopg2.Error) if psycopg2 else (sqlite3.Error,)
 
 # --- PostgreSQL Connection Configuration (UPDATE THIS!) ---
 DB_CONFIG = {
@@ -13,77 +32,444 @@ DB_CONFIG = {
     'database': 'notepad_db' # Ensure this database exists
 }
 
+# --- Backend Selection ---
+# "postgres" (default when psycopg2 is installed) or "sqlite" for a single local
+# file that needs no database server. Override with NOTEPAD_DB_BACKEND.
+DB_BACKEND = os.environ.get("NOTEPAD_DB_BACKEND", "postgres" if psycopg2 else "sqlite")
+SQLITE_PATH = os.environ.get("NOTEPAD_SQLITE_PATH", "notepad.db")
+
+# --- Pool Configuration ---
+DB_POOL_MIN = 1
+DB_POOL_MAX = 20
+DB_CHECKOUT_TIMEOUT = 5.0  # seconds to wait for a free connection before PoolTimeout
+
 db_pool = None
 
+
+# --- Backends ---
+# Each backend knows how to connect, create the schema and run the hot queries
+# (user lookup and insert, chat batches and pages) as prepared statements.
+# Chat timestamps are Unix times (time.time()), so pages can resume from any message's "ts".
+class PostgresBackend:
+    name = "postgres"
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            password_hash BYTEA NOT NULL,
+            is_admin BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id BIGSERIAL PRIMARY KEY,
+            doc_id VARCHAR(100) NOT NULL,
+            username VARCHAR(50) NOT NULL,
+            text TEXT NOT NULL,
+            sent_at DOUBLE PRECISION NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS chat_messages_doc_time ON chat_messages (doc_id, sent_at);",
+    )
+    # Prepared once per connection with PREPARE, then run with EXECUTE.
+    STATEMENTS = {
+        "find_user": ("(text)", "SELECT id, username, password_hash, is_admin FROM users WHERE username = $1"),
+        "insert_user": ("(text, bytea, boolean)",
+                        "INSERT INTO users (username, password_hash, is_admin) VALUES ($1, $2, $3) RETURNING id"),
+        "insert_chat": ("(text, text, text, double precision)",
+                        "INSERT INTO chat_messages (doc_id, username, text, sent_at) VALUES ($1, $2, $3, $4)"),
+        "chat_before": ("(text, double precision, integer)",
+                        "SELECT username, text, sent_at FROM chat_messages WHERE doc_id = $1 AND sent_at < $2 "
+                        "ORDER BY sent_at DESC LIMIT $3"),
+    }
+
+    def __init__(self, config):
+        if psycopg2 is None:
+            raise RuntimeError("the postgres backend needs psycopg2 (pip install psycopg2-binary)")
+        self.config = config
+        self.Error = psycopg2.Error
+        self.IntegrityError = psycopg2.IntegrityError
+
+    def connect(self):
+        return psycopg2.connect(**self.config)
+
+    def execute(self, pooled, name, params):
+        cursor = pooled.raw.cursor()
+        if name not in pooled.prepared:
+            types, sql = self.STATEMENTS[name]
+            cursor.execute(f"PREPARE {name} {types} AS {sql}")
+            pooled.prepared.add(name)
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        return cursor
+
+    def execute_many(self, pooled, name, rows):
+        cursor = self.execute(pooled, name, rows[0])
+        execute_batch(cursor, f"EXECUTE {name} ({', '.join(['%s'] * len(rows[0]))})", rows[1:])
+        return cursor
+
+    def inserted_id(self, cursor):
+        return cursor.fetchone()[0]
+
+
+class SqliteBackend:
+    name = "sqlite"
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash BLOB NOT NULL,
+            is_admin INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            doc_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            text TEXT NOT NULL,
+            sent_at REAL NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS chat_messages_doc_time ON chat_messages (doc_id, sent_at);",
+    )
+    # sqlite3 keeps compiled statements in a per-connection cache keyed by the SQL text.
+    STATEMENTS = {
+        "find_user": "SELECT id, username, password_hash, is_admin FROM users WHERE username = ?",
+        "insert_user": "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
+        "insert_chat": "INSERT INTO chat_messages (doc_id, username, text, sent_at) VALUES (?, ?, ?, ?)",
+        "chat_before": ("SELECT username, text, sent_at FROM chat_messages WHERE doc_id = ? AND sent_at < ? "
+                        "ORDER BY sent_at DESC LIMIT ?"),
+    }
+    Error = sqlite3.Error
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        # Pooled connections move between threads, but only one uses a connection at a time.
+        conn = sqlite3.connect(self.path, timeout=DB_CHECKOUT_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer
+        return conn
+
+    def execute(self, pooled, name, params):
+        return pooled.raw.execute(self.STATEMENTS[name], params)
+
+    def execute_many(self, pooled, name, rows):
+        return pooled.raw.executemany(self.STATEMENTS[name], rows)
+
+    def inserted_id(self, cursor):
+        return cursor.lastrowid
+
+
+def make_backend(name=None):
+    name = name or DB_BACKEND
+    if name == "sqlite":
+        return SqliteBackend(SQLITE_PATH)
+    if name == "postgres":
+        return PostgresBackend(DB_CONFIG)
+    raise ValueError(f"unknown database backend {name!r}")
+
+
+# --- Connection Pool ---
+class PoolTimeout(Exception):
+    """Raised when no database connection became free within the checkout timeout."""
+
+
+class PooledConnection:
+    __slots__ = ("raw", "prepared")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.prepared = set()  # names of statements prepared on this connection
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of up to `max_size` connections. A checkout waits at most
+    `timeout` seconds for a free connection, then raises PoolTimeout. Keeps
+    metrics: checkouts, connections in use, time spent waiting, how often the
+    pool was exhausted (a checkout had to wait) and how often waiting timed out.
+    """
+
+    def __init__(self, backend, min_size=1, max_size=20, timeout=5.0):
+        self.backend = backend
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []  # [PooledConnection]
+        self._size = 0  # open connections, idle or in use
+        self._cond = threading.Condition()
+        # --- Metrics ---
+        self.checkouts = 0
+        self.in_use = 0
+        self.exhausted = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        for _ in range(min_size):
+            self._idle.append(PooledConnection(backend.connect()))
+            self._size += 1
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for a `with` block; it is rolled back if the block raises."""
+        pooled = self._checkout()
+        healthy = True
+        try:
+            yield pooled
+        except BaseException:
+            try:
+                pooled.raw.rollback()
+            except Exception:
+                healthy = False  # Broken connection: close it instead of reusing it
+            raise
+        finally:
+            self._checkin(pooled, healthy)
+
+    def _checkout(self):
+        started = time.monotonic()
+        with self._cond:
+            if not self._idle and self._size >= self.max_size:
+                self.exhausted += 1
+                while not self._idle and self._size >= self.max_size:
+                    remaining = started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"no database connection free after {self.timeout}s")
+                    self._cond.wait(remaining)
+            pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                self._size += 1  # Reserve the slot; connect outside the lock
+            self.in_use += 1
+            waited = time.monotonic() - started
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        if pooled is None:
+            try:
+                pooled = PooledConnection(self.backend.connect())
+            except BaseException:
+                with self._cond:
+                    self._size -= 1
+                    self.in_use -= 1
+                    self._cond.notify()
+                raise
+        return pooled
+
+    def _checkin(self, pooled, healthy):
+        with self._cond:
+            self.in_use -= 1
+            if healthy:
+                self._idle.append(pooled)
+            else:
+                self._size -= 1
+            self._cond.notify()
+        if not healthy:
+            try:
+                pooled.raw.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {"size": self._size, "in_use": self.in_use, "checkouts": self.checkouts,
+                    "exhausted": self.exhausted, "timeouts": self.timeouts,
+                    "avg_wait_ms": self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                    "max_wait_ms": self.wait_max * 1000}
+
+# --- User Cache Configuration ---
+# Set USER_CACHE_ENABLED = False to query the database on every lookup.
+USER_CACHE_ENABLED = True
+USER_CACHE_SIZE = 10000  # user records kept, least recently used evicted first
+USER_CACHE_TTL = 300.0  # seconds a found user is served from the cache
+USER_CACHE_NEGATIVE_TTL = 5.0  # seconds an unknown username is remembered as missing
+
+
+class UserCache:
+    """
+    Thread-safe LRU cache of user records with a TTL. A lookup that found nothing
+    is cached too (as None) for the shorter negative_ttl, so repeated attempts with
+    an unknown name do not each cost a query.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0, negative_ttl=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # {username: (expires_at, record or None)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        """Returns (True, record or None) on a hit, (False, None) on a miss."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(username)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[username]  # Expired
+            self.misses += 1
+            return False, None
+
+    def put(self, username, record):
+        ttl = self.ttl if record is not None else self.negative_ttl
+        with self._lock:
+            self._entries[username] = (time.monotonic() + ttl, record)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_NEGATIVE_TTL) if USER_CACHE_ENABLED else None
+if user_cache:
+    registry.add_collector("user_cache", user_cache.stats)
+
+
 def initialize_db():
-    """Initializes the PostgreSQL connection pool and creates the users table."""
+    """Initializes the connection pool for DB_BACKEND and creates the tables."""
     global db_pool
     try:
-        db_pool = pool.SimpleConnectionPool(1, 20, **DB_CONFIG)
-        print("Database connection pool established successfully.")
-        
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(50) UNIQUE NOT NULL,
-                password_hash BYTEA NOT NULL,
-                is_admin BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        conn.commit()
-        cursor.close()
-        db_pool.putconn(conn)
-        print("Users table checked/created.")
+        backend = make_backend()
+        db_pool = ConnectionPool(backend, DB_POOL_MIN, DB_POOL_MAX, DB_CHECKOUT_TIMEOUT)
+        registry.add_collector("db_pool", db_pool.stats)
+        log.info("Database connection pool established (%s).", backend.name)
+
+        with db_pool.connection() as pooled:
+            cursor = pooled.raw.cursor()
+            for statement in backend.SCHEMA:
+                cursor.execute(statement)
+            pooled.raw.commit()
+            cursor.close()
+        log.info("Users and chat tables checked/created.")
 
-    except psycopg2.Error as e:
-        print(f"Database Initialization Error: {e}")
-        # If the server cannot connect to PostgreSQL, the application will fail here.
+    except (RuntimeError, *DB_ERRORS) as e:
+        log.error("Database initialization failed: %s", e)
+        # If the server cannot connect to the database, the application will fail here.
 
-def create_user(username, password, is_admin=False):
-    """Inserts a new user (SIGNUP) into the database."""
-    conn = db_pool.getconn()
-    cursor = conn.cursor()
+def create_user(username, password, is_admin=False, password_hash=None):
+    """Inserts a new user (SIGNUP) into the database. Pass password_hash if it was already hashed (auth pool)."""
+    backend = db_pool.backend
+    hashed_password = password_hash or hash_password(password)
     try:
-        hashed_password = hash_password(password)
-        cursor.execute(
-            "INSERT INTO users (username, password_hash, is_admin) VALUES (%s, %s, %s) RETURNING id;",
-            (username, hashed_password, is_admin)
-        )
-        conn.commit()
-        user_id = cursor.fetchone()[0]
-        return user_id
-    except errors.UniqueViolation:
-        conn.rollback()
+        with INSERT_SECONDS.time(), db_pool.connection() as pooled:
+            cursor = backend.execute(pooled, "insert_user", (username, hashed_password, is_admin))
+            user_id = backend.inserted_id(cursor)
+            pooled.raw.commit()
+            cursor.close()
+    except backend.IntegrityError:
+        return None  # Username already exists
+    except (backend.Error, PoolTimeout) as e:
+        log.error("Error creating user: %s", e)
         return None
-    except psycopg2.Error as e:
-        print(f"Error creating user: {e}")
-        conn.rollback()
-        return None
-    finally:
-        cursor.close()
-        db_pool.putconn(conn)
+    if user_cache:
+        user_cache.invalidate(username)  # Drops a cached "unknown user" entry
+    return user_id
 
 def find_user_by_username(username):
-    """Retrieves user data and the hashed password for login."""
-    conn = db_pool.getconn()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "SELECT id, username, password_hash, is_admin FROM users WHERE username = %s;",
-            (username,)
-        )
+    """Retrieves user data and the hashed password for login (cached, see UserCache)."""
+    if user_cache is None:
+        return _query_user(username)
+    hit, record = user_cache.get(username)
+    if not hit:
+        record = _query_user(username)
+        user_cache.put(username, record)
+    return dict(record) if record is not None else None
+
+def _query_user(username):
+    with FIND_SECONDS.time(), db_pool.connection() as pooled:
+        cursor = db_pool.backend.execute(pooled, "find_user", (username,))
         user_data = cursor.fetchone()
-        if user_data:
-            return {
-                'id': user_data[0],
-                'username': user_data[1],
-                'password_hash': user_data[2],
-                'is_admin': user_data[3]
-            }
-        return None
-    finally:
         cursor.close()
-        db_pool.putconn(conn)
\ No newline at end of file
+        pooled.raw.commit()  # End the read transaction (psycopg2 opens one implicitly)
+    if user_data:
+        return {
+            'id': user_data[0],
+            'username': user_data[1],
+            'password_hash': user_data[2],
+            'is_admin': bool(user_data[3])
+        }
+    return None
+
+
+# --- Chat Storage ---
+class ChatStore:
+    """The database side of utils.chat.ChatHistory: batched inserts and paged reads."""
+
+    def insert(self, rows):
+        """Writes (doc_id, user, text, ts) rows in one transaction. Returns False on failure."""
+        if not rows:
+            return True
+        if db_pool is None:
+            return False
+        backend = db_pool.backend
+        try:
+            with CHAT_INSERT_SECONDS.time(), db_pool.connection() as pooled:
+                backend.execute_many(pooled, "insert_chat", rows).close()
+                pooled.raw.commit()
+        except (backend.Error, PoolTimeout) as e:
+            log.error("Error writing chat messages: %s", e)
+            return False
+        return True
+
+    def before(self, doc_id, ts, limit):
+        """Up to `limit` messages of doc_id sent before ts, oldest first (empty on failure)."""
+        if db_pool is None or limit <= 0:
+            return []
+        backend = db_pool.backend
+        try:
+            with CHAT_PAGE_SECONDS.time(), db_pool.connection() as pooled:
+                cursor = backend.execute(pooled, "chat_before", (doc_id, ts, limit))
+                rows = cursor.fetchall()
+                cursor.close()
+                pooled.raw.commit()
+        except (backend.Error, PoolTimeout) as e:
+            log.error("Error reading chat history: %s", e)
+            return []
+        return [{"user": user, "text": text, "ts": sent_at} for user, text, sent_at in reversed(rows)]
+
+
+# --- Optional Local Test Block ---
+if __name__ == "__main__":
+    cache = UserCache(max_entries=2, ttl=0.2, negative_ttl=0.1)
+    cache.put("alice", {"id": 1})
+    cache.put("ghost", None)
+    print("Hit:", cache.get("alice") == (True, {"id": 1}))
+    print("Negative Hit:", cache.get("ghost") == (True, None))
+    cache.put("bob", {"id": 2})
+    print("LRU Evicted:", cache.get("alice") == (False, None))  # ghost was used more recently
+    time.sleep(0.25)
+    print("TTL Expired:", cache.get("bob") == (False, None))
+    print("Cache Stats:", cache.stats())
+
+    # Same answers as the uncached query, against DB_BACKEND
+    initialize_db()
+    if db_pool:
+        user_cache.clear()
+        for name in ("admin", "no_such_user_for_cache_test"):
+            print(f"Matches Query ({name}):", find_user_by_username(name) == _query_user(name),
+                  find_user_by_username(name) == _query_user(name))
+        new_name = f"cache_test_{int(time.time())}"
+        print("Unknown Before Signup:", find_user_by_username(new_name) is None)
+        create_user(new_name, "secret")
+        print("Found After Signup:", find_user_by_username(new_name) is not None)
+        print("User Cache Stats:", user_cache.stats())
+
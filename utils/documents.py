@@ -0,0 +1,381 @@
+# utils/documents.py
+# Documents addressed by ID, each with its own lock and subscriber set.
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+
+from utils.autosave import AutosaveScheduler
+from utils.history import RevisionStore
+from utils.merge_engine import MergeEngine
+from utils.metrics import SIZE_BUCKETS, TimedLock, registry
+from utils.oplog import DocumentLog, GroupCommitter
+from utils.protocol_helpers import Frame
+from utils.rope import Rope
+
+DOC_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')  # also keeps IDs safe as file names
+WAL_DIR_NAME = '.wal'  # <documents>/.wal/<doc_id>/ holds each document's log and snapshot
+HISTORY_DIR_NAME = '.history'  # <documents>/.history/<doc_id>/ holds every revision (utils/history.py)
+SNAPSHOT_EVERY = 1000  # logged edits between automatic snapshots (bounds recovery time)
+STATE_CHUNK_CHARS = 64 * 1024  # larger DOC_STATEs are streamed in chunks to clients that accept them
+CREATE_TIMEOUT = 10.0  # seconds create() waits for a new document's first snapshot to reach disk
+EVICT_TIMEOUT = 5.0  # seconds eviction waits for a document's save and log; it stays loaded if they take longer
+
+LOCK_WAIT_SECONDS = registry.histogram("doc_lock_wait_seconds")
+LOCK_HOLD_SECONDS = registry.histogram("doc_lock_hold_seconds")
+FANOUT_SECONDS = registry.histogram("fanout_seconds", scope="document")
+FANOUT_RECIPIENTS = registry.histogram("fanout_recipients", SIZE_BUCKETS, scope="document")
+
+
+def catch_up_messages(doc_id, entries, session_id):
+    """
+    Replays merge history entries for a resuming client: its own edits (origin is
+    its session) as EDIT_ACK, everyone else's as EDIT_OP.
+    """
+    messages = []
+    for revision, ops, origin in entries:
+        if origin is not None and origin == session_id:
+            messages.append({"type": "EDIT_ACK", "doc_id": doc_id, "version": revision})
+        else:
+            messages.append({"type": "EDIT_OP", "doc_id": doc_id, "ops": ops, "version": revision})
+    return messages
+
+
+def state_frames(doc_id, text, revision, chunk_chars=STATE_CHUNK_CHARS):
+    """
+    DOC_STATE as a stream of Frames: a DOC_STATE carrying the first chunk, the total
+    length and "more", then DOC_CHUNKs with the rest, the last one with "more": false.
+    `text` is a Rope snapshot; each chunk is only read from it when its frame is sent.
+    """
+    length = len(text)
+    yield Frame({"type": "DOC_STATE", "doc_id": doc_id, "version": revision, "length": length,
+                 "content": text.substring(0, chunk_chars), "more": length > chunk_chars})
+    for start in range(chunk_chars, length, chunk_chars):
+        yield Frame({"type": "DOC_CHUNK", "doc_id": doc_id, "version": revision,
+                     "content": text.substring(start, start + chunk_chars),
+                     "more": start + chunk_chars < length})
+
+
+class Document:
+    """
+    One loaded document: its merge engine, its lock, its write-ahead log, its
+    revision history and the connections viewing it. Every accepted edit is
+    appended to the log and the history and schedules a write-behind save of the
+    .txt file.
+
+    Messages that must follow revision order (DOC_STATE, EDIT_ACK, EDIT_OP...) are
+    queued with queue_send / queue_broadcast while `lock` is held and delivered by
+    flush_outbox() after it is released, so fan-out never runs under the lock.
+    The text is a Rope: edits cost O(log n) and the state can be sent, saved and
+    snapshotted from a reference taken under the lock, without copying it.
+
+    In cluster mode (utils/cluster.py) `replicate` is set on documents this
+    process owns: broadcasts are then also published, in the same order, to the
+    other server processes.
+    """
+    remote = False  # see utils.cluster.RemoteDocument
+
+    def __init__(self, doc_id, path, text, log, history, autosave, revision=0, saved_revision=-1, max_length=None):
+        self.doc_id = doc_id
+        self.path = path
+        self.engine = MergeEngine(text, revision, max_length=max_length)
+        self.log = log
+        self.history = history
+        self.autosave = autosave
+        self.saved_revision = saved_revision  # revision the .txt file holds (-1: unknown/none)
+        self.edits_since_snapshot = 0
+        self.lock = TimedLock(LOCK_WAIT_SECONDS, LOCK_HOLD_SECONDS)
+        self.subscribers = set()  # modified under `lock`
+        self._outbox = deque()  # [(message_dict or frame iterator, recipients, replicated, origin)]
+        self._outbox_lock = threading.Lock()
+        self.replicate = None  # cluster mode: callable(message_dict, origin)
+
+    # --- Edits (call with `lock` held) ---
+    def submit(self, base_revision, ops, origin=None):
+        revision, merged_ops = self.engine.submit(base_revision, ops, origin)
+        self.log.append(revision, ops=merged_ops)
+        self.history.append(revision, self.engine.text, merged_ops)
+        self._after_edit()
+        return revision, merged_ops
+
+    def replace(self, text, origin=None):
+        revision = self.engine.replace(text, origin)
+        self.log.append(revision, text=text)
+        self.history.append(revision, self.engine.text)
+        self._after_edit()
+        return revision
+
+    @property
+    def dirty(self):
+        return self.saved_revision != self.engine.revision
+
+    def _after_edit(self):
+        self.autosave.schedule(self)
+        self.edits_since_snapshot += 1
+        if self.edits_since_snapshot >= SNAPSHOT_EVERY:
+            self.log.request_snapshot(self.engine.text, self.engine.revision)
+            self.edits_since_snapshot = 0
+
+    def state_message(self):
+        return {"type": "DOC_STATE", "doc_id": self.doc_id,
+                "content": str(self.engine.text), "version": self.engine.revision}
+
+    def queue_state(self, conn):
+        """
+        Queues DOC_STATE for conn, with `lock` held. Large documents are streamed in
+        chunks to connections that negotiated it (conn.chunked_state).
+        """
+        if conn.chunked_state and len(self.engine.text) > STATE_CHUNK_CHARS:
+            stream = state_frames(self.doc_id, self.engine.text, self.engine.revision)
+            self._outbox.append((stream, (conn,), False, None))
+        else:
+            self.queue_send(conn, self.state_message())
+
+    # --- History (any thread, without `lock`) ---
+    def history_page(self, before=None, limit=50):
+        """Up to `limit` revisions older than `before`, oldest first: [{"revision", "ts"}]."""
+        return self.history.page(before, limit)
+
+    def read_revision(self, revision=None, at=None):
+        """{"revision", "ts", "content"} of a past revision (or the one current at time `at`), or None."""
+        found = self.history.read(revision, at)
+        if found is not None:
+            found["content"] = str(found["content"])
+        return found
+
+    # --- Fan-out ---
+    def queue_send(self, conn, message_dict):
+        """Queues a revision-ordered reply. Call with `lock` held, then flush_outbox()."""
+        self._outbox.append((message_dict, (conn,), False, None))
+
+    def queue_broadcast(self, message_dict, exclude=None, origin=None):
+        """
+        Queues a revision-ordered message for the current subscribers. Call with
+        `lock` held. `origin` is the session whose edit this is (other processes
+        acknowledge it instead of echoing it).
+        """
+        recipients = [c for c in self.subscribers if c is not exclude]
+        self._outbox.append((message_dict, recipients, True, origin))
+
+    def flush_outbox(self):
+        """
+        Delivers queued messages in order, after `lock` is released. Whichever
+        thread gets here first delivers everything queued so far.
+        """
+        with self._outbox_lock:
+            while self._outbox:
+                message_dict, recipients, replicated, origin = self._outbox.popleft()
+                if not isinstance(message_dict, dict):
+                    recipients[0].send_stream(message_dict)
+                    continue
+                self._fan_out(Frame(message_dict), recipients)
+                if replicated and self.replicate:
+                    self.replicate(message_dict, origin)
+
+    def broadcast(self, message_dict, exclude=None, replicate=True):
+        """Sends a message that needs no revision ordering (chat, notifications) to subscribers."""
+        self._fan_out(Frame(message_dict), [c for c in list(self.subscribers) if c is not exclude])
+        if replicate and self.replicate:
+            self.replicate(message_dict, None)
+
+    def _fan_out(self, frame, recipients):
+        started = time.perf_counter()
+        for conn in recipients:
+            conn.send(frame)
+        FANOUT_SECONDS.observe(time.perf_counter() - started)
+        FANOUT_RECIPIENTS.observe(len(recipients))
+
+    # --- Persistence ---
+    def save(self, timeout=None):
+        """
+        Returns once the current state is durably written to the .txt file, or
+        False on timeout. The write happens on the autosave worker, outside `lock`.
+        """
+        return self.autosave.save_now(self, timeout)
+
+
+class DocumentManager:
+    """
+    Loads documents from `directory` on demand and keeps at most `max_loaded` of
+    them in memory. Documents nobody has open are evicted least recently used
+    first, after unsaved changes are written to disk. Edits may not make a
+    document longer than `max_length` chars (None: no limit).
+    """
+
+    def __init__(self, directory, max_loaded=1000, autosave_delay=2.0, max_length=None):
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self.max_length = max_length
+        self._docs = OrderedDict()  # {doc_id: Document}, least recently used first
+        self._lock = threading.Lock()  # guards _docs and _creating only
+        self._creating = set()  # IDs create() has claimed but not added yet
+        self.wal_directory = os.path.join(directory, WAL_DIR_NAME)
+        self.history_directory = os.path.join(directory, HISTORY_DIR_NAME)
+        self.committer = GroupCommitter()
+        # History has a writer of its own: compressing a keyframe must not hold up WAL fsyncs.
+        self.history_committer = GroupCommitter(name="history-writer")
+        self.autosave = AutosaveScheduler(autosave_delay)
+
+    def path_for(self, doc_id):
+        if not isinstance(doc_id, str) or not DOC_ID_PATTERN.match(doc_id):
+            raise ValueError(f"invalid document id: {doc_id!r}")
+        return os.path.join(self.directory, f"{doc_id}.txt")
+
+    def _open_log(self, doc_id):
+        return DocumentLog(os.path.join(self.wal_directory, doc_id), self.committer)
+
+    def _open_history(self, doc_id):
+        return RevisionStore(os.path.join(self.history_directory, doc_id), self.history_committer)
+
+    def exists(self, doc_id):
+        return doc_id in self._docs or os.path.exists(self.path_for(doc_id))
+
+    def list_ids(self):
+        on_disk = {name[:-4] for name in os.listdir(self.directory) if name.endswith('.txt')}
+        with self._lock:
+            on_disk.update(self._docs)
+        return sorted(on_disk)
+
+    def get(self, doc_id):
+        """Returns the loaded document, reading it from disk if needed. Raises KeyError."""
+        path = self.path_for(doc_id)
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            if doc is not None:
+                self._docs.move_to_end(doc_id)
+                return doc
+        if not os.path.exists(path):
+            raise KeyError(doc_id)
+        return self._add(self._load(doc_id, path))
+
+    def _load(self, doc_id, path):
+        """
+        Rebuilds a document from its latest snapshot plus the log tail. The history
+        gets any revision of the tail it is missing (it may lag after a crash).
+        """
+        log = self._open_log(doc_id)
+        history = self._open_history(doc_id)
+        recovered = log.recover(on_record=history.append)
+        if recovered is not None:
+            text, revision = recovered
+            history.append(revision, text)  # No-op unless the history lost more than the tail
+            doc = Document(doc_id, path, text, log, history, self.autosave, revision, max_length=self.max_length)
+            self.autosave.schedule(doc)  # The .txt file may predate the log tail
+            return doc
+
+        # First load since the log was introduced: the text file becomes revision 0.
+        # It is mapped, not read: blocks are decoded as they are first needed.
+        doc = Document(doc_id, path, Rope.from_file(path), log, history, self.autosave, saved_revision=0,
+                       max_length=self.max_length)
+        log.request_snapshot(doc.engine.text, 0)
+        history.append(0, doc.engine.text)
+        return doc
+
+    def create(self, doc_id, text=""):
+        """
+        Creates and saves a new document. Raises FileExistsError if the ID is taken,
+        OSError if its first snapshot cannot be written within CREATE_TIMEOUT seconds.
+        """
+        path = self.path_for(doc_id)
+        with self._lock:
+            # Claimed under the lock: two CREATEs of one ID cannot both pass the check.
+            if doc_id in self._docs or doc_id in self._creating or os.path.exists(path):
+                raise FileExistsError(doc_id)
+            self._creating.add(doc_id)
+        try:
+            shutil.rmtree(os.path.join(self.wal_directory, doc_id), ignore_errors=True)  # stale log
+            shutil.rmtree(os.path.join(self.history_directory, doc_id), ignore_errors=True)
+            doc = Document(doc_id, path, text, self._open_log(doc_id), self._open_history(doc_id), self.autosave,
+                           max_length=self.max_length)
+            if not doc.log.wait_durable(doc.log.request_snapshot(text, 0), CREATE_TIMEOUT):
+                doc.log.discard()
+                raise OSError(f"could not write {doc_id!r} to disk: {doc.log.error or 'timed out'}")
+            doc.history.append(0, doc.engine.text)
+            doc.save()
+            return self._add(doc)
+        finally:
+            with self._lock:
+                self._creating.discard(doc_id)
+
+    def _add(self, doc):
+        with self._lock:
+            # Another thread may have loaded the same document meanwhile; keep that one.
+            doc = self._docs.setdefault(doc.doc_id, doc)
+            self._docs.move_to_end(doc.doc_id)
+        self._evict_idle()
+        return doc
+
+    def _evict_idle(self):
+        for _ in range(len(self._docs)):
+            with self._lock:
+                if len(self._docs) <= self.max_loaded:
+                    return
+                victim = next((d for d in self._docs.values() if not d.subscribers), None)
+                if victim is None:
+                    return
+                self._docs.move_to_end(victim.doc_id)
+            # Bounded waits: a slow disk keeps the document loaded instead of blocking
+            # the OPEN that triggered eviction. Its log and history are written out
+            # first, so closing them after removal has nothing left to write.
+            if victim.dirty and not victim.save(EVICT_TIMEOUT):
+                return
+            if not victim.log.sync(EVICT_TIMEOUT):
+                return
+            victim.history.flush()
+            with self._lock:
+                if victim.subscribers or victim.dirty or self._docs.get(victim.doc_id) is not victim:
+                    continue  # Opened (or edited) again meanwhile: it stays loaded, files open
+                del self._docs[victim.doc_id]
+            victim.log.close(EVICT_TIMEOUT)
+            victim.history.close()
+
+    def subscribe(self, conn, doc_id, since=None):
+        """
+        Moves conn to the document (it stops receiving updates for its previous
+        one) and sends it DOC_STATE. Returns the Document. Raises KeyError/ValueError.
+
+        With `since` (a revision the client already has, when resuming), only the
+        edits after it are replayed if they are all still in the merge history:
+        the client's own edits as EDIT_ACK, everyone else's as EDIT_OP.
+        """
+        doc = self.get(doc_id)
+        self.unsubscribe(conn)
+        while True:
+            with self._lock:
+                # Subscribing under the table lock keeps eviction from racing with us.
+                if self._docs.get(doc_id) is doc:
+                    with doc.lock:
+                        doc.subscribers.add(conn)
+                        conn.document = doc
+                        self._queue_catch_up(conn, doc, since)
+                    break
+            doc = self.get(doc_id)  # evicted in the meantime: load it again
+        doc.flush_outbox()
+        return doc
+
+    def _queue_catch_up(self, conn, doc, since):
+        entries = doc.engine.entries_since(since) if since is not None else None
+        if entries is None:
+            doc.queue_state(conn)
+            return
+        for message in catch_up_messages(doc.doc_id, entries, conn.session_id):
+            doc.queue_send(conn, message)
+
+    def unsubscribe(self, conn):
+        doc = conn.document
+        if doc is None:
+            return
+        with doc.lock:
+            doc.subscribers.discard(conn)
+        conn.document = None
+
+    def save_all(self):
+        """Writes every loaded document with unsaved changes, and its history, to disk (e.g. at shutdown)."""
+        with self._lock:
+            docs = list(self._docs.values())
+        for doc in docs:
+            if doc.dirty:
+                doc.save()
+            doc.history.flush()
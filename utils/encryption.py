@@ -1,9 +1,28 @@
 # utils/encryption.py (FINAL FIXED VERSION for PostgreSQL compatibility)
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
 import bcrypt
 
-def hash_password(password):
+from utils.log import get_logger
+from utils.metrics import registry
+
+log = get_logger("auth")
+HASH_SECONDS = registry.histogram("bcrypt_seconds", op="hash")
+CHECK_SECONDS = registry.histogram("bcrypt_seconds", op="check")
+QUEUE_WAIT_SECONDS = registry.histogram("auth_queue_wait_seconds")
+
+# bcrypt cost factor for new hashes (each +1 doubles the work). Existing hashes keep
+# the cost they were created with. Override with NOTEPAD_BCRYPT_ROUNDS.
+BCRYPT_ROUNDS = int(os.environ.get("NOTEPAD_BCRYPT_ROUNDS", "12"))
+
+def hash_password(password, rounds=None):
     """Hashes a plaintext password using bcrypt."""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    with HASH_SECONDS.time():
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds or BCRYPT_ROUNDS))
 
 
 def check_password(password, stored_hashed_password):
@@ -24,13 +43,74 @@ def check_password(password, stored_hashed_password):
             stored_hashed_password = bytes(stored_hashed_password)
 
         # 3️⃣ Verify password using bcrypt
-        return bcrypt.checkpw(password_bytes, stored_hashed_password)
+        with CHECK_SECONDS.time():
+            return bcrypt.checkpw(password_bytes, stored_hashed_password)
 
     except Exception as e:
-        print(f"[Encryption Error] Password verification failed: {e}")
+        log.error("Password verification failed: %s", e)
         return False
 
 
+# --- Auth Worker Pool ---
+class ServerBusy(Exception):
+    """Raised by AuthPool.submit when its queue is full."""
+
+
+class AuthPool:
+    """
+    Runs bcrypt work (password checks, user creation) on a fixed set of worker
+    threads, one per CPU core by default, so a login burst cannot take the CPU
+    away from editing. At most `max_queue` jobs wait; beyond that submit()
+    raises ServerBusy right away instead of queueing. With `nice` set (Linux
+    schedules each thread separately), the workers run at that lower priority, so
+    editing threads get the CPU first when every core is busy.
+    """
+
+    def __init__(self, workers=None, max_queue=64, nice=0):
+        self.workers = workers or os.cpu_count() or 1
+        self.nice = nice
+        self._jobs = queue.Queue(maxsize=max_queue)
+        self.completed = 0
+        self.rejected = 0
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"auth-{i}", daemon=True).start()
+
+    def submit(self, fn, *args):
+        """Queues fn(*args). Returns a Future. Raises ServerBusy if the queue is full."""
+        future = Future()
+        try:
+            self._jobs.put_nowait((fn, args, future, time.perf_counter()))
+        except queue.Full:
+            self.rejected += 1
+            raise ServerBusy(f"{self._jobs.qsize()} authentication requests already queued")
+        return future
+
+    def run(self, fn, *args):
+        """Runs fn(*args) on the pool and waits for the result. Raises ServerBusy."""
+        return self.submit(fn, *args).result()
+
+    def stats(self):
+        return {"workers": self.workers, "queued": self._jobs.qsize(),
+                "completed": self.completed, "rejected": self.rejected}
+
+    def _run(self):
+        if self.nice:
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+            except (AttributeError, OSError) as e:
+                log.warning("Could not lower auth worker priority: %s", e)
+        while True:
+            fn, args, future, submitted_at = self._jobs.get()
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - submitted_at)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            self.completed += 1
+
+
 # --- Optional Local Test Block ---
 if __name__ == "__main__":
     pwd = "test123"
@@ -38,3 +118,14 @@ if __name__ == "__main__":
     print("Generated Hash:", hashed)
     print("Check Correct:", check_password("test123", hashed))
     print("Check Wrong:", check_password("wrongpass", hashed))
+
+    auth_pool = AuthPool(workers=2, max_queue=2)
+    print("Pool Check Correct:", auth_pool.run(check_password, "test123", hashed))
+    futures = []
+    try:
+        for _ in range(10):
+            futures.append(auth_pool.submit(hash_password, pwd, 10))
+    except ServerBusy as e:
+        print(f"Pool Busy after {len(futures)} jobs: {e}")
+    print("Pool Results Valid:", all(check_password(pwd, f.result()) for f in futures))
+    print("Pool Stats:", auth_pool.stats())
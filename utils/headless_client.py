@@ -0,0 +1,335 @@
+# utils/headless_client.py
+# A scriptable notepad client without Tk, for load generation and tests.
+import socket
+import threading
+import time
+from collections import deque
+
+from utils.protocol_helpers import (
+    JSON_CODEC, CODECS, FrameReader, ProtocolError, encode_frame, send_buffers, supported_codecs
+)
+from utils.operations import apply_ops, transform
+
+REPLY_TYPES = ("AUTH_SUCCESS", "AUTH_FAIL", "DOC_LIST", "RESUMED", "STATS", "NOTIFICATION", "CHAT_HISTORY",
+               "HISTORY", "REVISION", "THROTTLED")
+REPLY_BACKLOG = 100  # unclaimed replies kept for wait_for; older ones are dropped
+CONNECT_TIMEOUT = 5.0
+REPLY_TIMEOUT = 30.0
+
+
+class HeadlessClient:
+    """
+    Speaks the same protocol as client.py and keeps the same editing state: one
+    EDIT_OP in flight (outstanding_ops), later edits buffered until its EDIT_ACK,
+    remote EDIT_OPs transformed past both. Edits are applied to `text` at once.
+
+    A listener thread reads from the socket; any thread may call the edit, chat
+    and save methods. For latency measurements it records when each of its own
+    revisions was sent (sent_at) and when each remote revision arrived
+    (received_at), both as time.perf_counter() values.
+    """
+
+    def __init__(self, host, port, on_message=None, chunked_state=True):
+        self.host = host
+        self.port = port
+        self.on_message = on_message  # called from the listener thread with every message
+        self.chunked_state = chunked_state  # accept large DOC_STATEs in DOC_CHUNK pieces
+        self.sock = None
+        self.codec, self.compress = JSON_CODEC, False
+        self.session_id = None
+        self.user = None
+        self.connected = False
+        self.chat_backlog = []  # the CHAT_HISTORY sent after login: recent chat, oldest first
+        self.presence = {}  # {presence ID: {"id", "user", "cursor", "selection"}} of the open document
+        self.presence_id = None  # ours, from the first PRESENCE reply
+
+        self._lock = threading.Lock()  # guards the editing state below and the socket writes
+        self.doc_id = None
+        self.text = ""
+        self.version = 0
+        self.outstanding_ops = None
+        self.buffered_ops = []
+        self._outstanding_sent_at = None
+        self._edits_held = False  # after THROTTLED, until retry_after has passed
+        self._doc_ready = threading.Event()
+        self._loading = None  # (DOC_STATE, [chunks]) while a streamed state arrives
+        self._replies = deque(maxlen=REPLY_BACKLOG)
+        self._replies_cond = threading.Condition()
+
+        # --- Measurements ---
+        self.sent_at = {}  # {revision: when the EDIT_OP that produced it was sent}
+        self.received_at = {}  # {revision: when its EDIT_OP reached us}
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.bytes_sent = 0
+        self.resyncs = 0  # DOC_STATEs received after the first one (rejected edits, OPEN)
+        self.throttled = 0  # THROTTLED notices received
+
+    # --- Connection ---
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """Connects, sends HELLO and waits for the first DOC_STATE."""
+        self.sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        self.sock.settimeout(None)
+        self.connected = True
+        threading.Thread(target=self._listen, name="headless-listener", daemon=True).start()
+        self.send({"type": "HELLO", "codecs": supported_codecs(), "compression": ["zlib"],
+                   "chunked_state": self.chunked_state})
+        if not self._doc_ready.wait(timeout):
+            raise TimeoutError("no DOC_STATE after HELLO")
+
+    def close(self):
+        self.connected = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def send(self, message_dict):
+        buffers = encode_frame(message_dict, self.codec, self.compress)
+        with self._lock:
+            self._send_locked(buffers)
+
+    def _send_locked(self, buffers):
+        send_buffers(self.sock, buffers)
+        self.messages_sent += 1
+        self.bytes_sent += len(buffers[0]) + len(buffers[1])
+
+    def wait_for(self, types=REPLY_TYPES, timeout=REPLY_TIMEOUT):
+        """
+        Returns the next reply whose type is in `types`, skipping others, or None if
+        the connection closed. Raises TimeoutError.
+        """
+        deadline = time.monotonic() + timeout
+        with self._replies_cond:
+            while True:
+                while self._replies:
+                    message = self._replies.popleft()
+                    if message.get("type") in types:
+                        return message
+                if not self.connected:
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"no reply of type {types}")
+                self._replies_cond.wait(remaining)
+
+    def request(self, message_dict, types):
+        """
+        Sends a message and returns its reply (see wait_for), or the THROTTLED notice
+        if the server refused it. Unclaimed older replies are discarded.
+        """
+        with self._replies_cond:
+            self._replies.clear()
+        self.send(message_dict)
+        while True:
+            reply = self.wait_for(tuple(types) + ("THROTTLED",))
+            if reply is None or reply["type"] != "THROTTLED" or reply.get("message_type") == message_dict["type"]:
+                return reply
+
+    # --- Requests ---
+    def signup(self, user, password):
+        return self.request({"type": "SIGNUP", "user": user, "password": password}, ("AUTH_SUCCESS", "AUTH_FAIL"))
+
+    def login(self, user, password):
+        """
+        Logs in; returns the reply. Sets session_id and user on success, and
+        chat_backlog from the CHAT_HISTORY the server sends right after it.
+        """
+        reply = self.request({"type": "LOGIN", "user": user, "password": password}, ("AUTH_SUCCESS", "AUTH_FAIL"))
+        if reply and reply.get("type") == "AUTH_SUCCESS":
+            self.session_id = reply["session_id"]
+            self.user = reply.get("user", user)
+            if self.doc_id is not None:
+                backlog = self.wait_for(("CHAT_HISTORY",))
+                self.chat_backlog = backlog.get("messages", []) if backlog else []
+        return reply
+
+    def logout(self):
+        self.send({"type": "LOGOUT", "session_id": self.session_id})
+        self.session_id = None
+
+    def chat(self, text):
+        self.send({"type": "CHAT", "text": text, "session_id": self.session_id})
+
+    def save(self):
+        self.send({"type": "SAVE", "session_id": self.session_id})
+
+    def send_presence(self, cursor, selection=None):
+        """Sends our caret (and selection) in the current text."""
+        self.send({"type": "PRESENCE", "doc_id": self.doc_id, "cursor": cursor, "selection": selection,
+                   "version": self.version, "session_id": self.session_id})
+
+    def chat_history(self, before=None, limit=None):
+        """Returns the CHAT_HISTORY reply: messages of the open document sent before `before`."""
+        message = {"type": "CHAT_HISTORY", "before": before, "session_id": self.session_id}
+        if limit is not None:
+            message["limit"] = limit
+        return self.request(message, ("CHAT_HISTORY", "NOTIFICATION"))
+
+    def history(self, before=None, limit=None):
+        """Returns the HISTORY reply: revisions of the open document older than `before`."""
+        message = {"type": "HISTORY", "before": before, "session_id": self.session_id}
+        if limit is not None:
+            message["limit"] = limit
+        return self.request(message, ("HISTORY", "NOTIFICATION"))
+
+    def get_revision(self, revision=None, at=None):
+        """Returns the REVISION reply for a revision number or a time, or the NOTIFICATION refusing it."""
+        return self.request({"type": "GET_REVISION", "revision": revision, "at": at, "session_id": self.session_id},
+                            ("REVISION", "NOTIFICATION"))
+
+    def stats(self):
+        """Returns the server's metrics snapshot (administrators only), or None if refused."""
+        reply = self.request({"type": "STATS", "session_id": self.session_id}, ("STATS", "NOTIFICATION"))
+        return reply.get("metrics") if reply and reply.get("type") == "STATS" else None
+
+    def open(self, doc_id, timeout=REPLY_TIMEOUT):
+        """Switches to doc_id and waits for its DOC_STATE."""
+        return self._switch({"type": "OPEN", "doc_id": doc_id, "session_id": self.session_id}, timeout)
+
+    def create(self, doc_id, timeout=REPLY_TIMEOUT):
+        """Creates doc_id and waits for its DOC_STATE; returns False if the server refused."""
+        return self._switch({"type": "CREATE", "doc_id": doc_id, "session_id": self.session_id}, timeout)
+
+    def _switch(self, message_dict, timeout):
+        doc_id = message_dict["doc_id"]
+        with self._replies_cond:
+            self._replies.clear()
+        self._doc_ready.clear()
+        self.send(message_dict)
+        deadline = time.monotonic() + timeout
+        while self.connected:
+            if self._doc_ready.wait(0.05):
+                with self._lock:  # DOC_STATE sets doc_id and _doc_ready together under it
+                    if self.doc_id == doc_id:
+                        return True
+                    self._doc_ready.clear()  # State of the document we are leaving
+            with self._replies_cond:
+                if any(reply.get("type") == "NOTIFICATION" for reply in self._replies):
+                    return False
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"no DOC_STATE for {doc_id}")
+        return False
+
+    # --- Editing ---
+    def insert(self, pos, text):
+        self.edit([{"op": "insert", "pos": pos, "text": text}])
+
+    def delete(self, pos, length):
+        self.edit([{"op": "delete", "pos": pos, "length": length}])
+
+    def edit(self, ops):
+        """Applies ops to the local text and sends them, or buffers them behind the EDIT_OP in flight."""
+        with self._lock:
+            self.text = apply_ops(self.text, ops)
+            self.buffered_ops.extend(ops)
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self.outstanding_ops is not None or not self.buffered_ops or not self.session_id or self._edits_held:
+            return
+        self.outstanding_ops, self.buffered_ops = self.buffered_ops, []
+        self._outstanding_sent_at = time.perf_counter()
+        self._send_locked(encode_frame({"type": "EDIT_OP", "doc_id": self.doc_id, "ops": self.outstanding_ops,
+                                        "version": self.version, "session_id": self.session_id},
+                                       self.codec, self.compress))
+
+    def _retry_edits(self):
+        with self._lock:
+            self._edits_held = False
+            if self.connected:
+                self._flush_locked()
+
+    # --- Listener thread ---
+    def _listen(self):
+        reader = FrameReader(self.sock)
+        while self.connected:
+            try:
+                message = reader.read_message()
+            except (ProtocolError, OSError):
+                message = None
+            if message is None:
+                break
+            self.messages_received += 1
+            self._handle(message)
+            if self.on_message:
+                self.on_message(message)
+        self.connected = False
+        with self._replies_cond:
+            self._replies_cond.notify_all()
+        self._doc_ready.set()
+
+    def _handle(self, message):
+        msg_type = message.get("type")
+        if msg_type == "HELLO_ACK":
+            self.codec = CODECS.get(message.get("codec"), JSON_CODEC)
+            self.compress = message.get("compression") == "zlib"
+        elif msg_type == "THROTTLED" and message.get("message_type") == "EDIT_OP":
+            # Our EDIT_OP was dropped: send it again once the server takes edits.
+            self.throttled += 1
+            with self._lock:
+                if self.outstanding_ops is not None:
+                    self.buffered_ops = self.outstanding_ops + self.buffered_ops
+                    self.outstanding_ops = None
+                self._edits_held = True
+            threading.Timer(message.get("retry_after", 0), self._retry_edits).start()
+        elif msg_type in REPLY_TYPES:
+            self.throttled += msg_type == "THROTTLED"
+            with self._replies_cond:
+                self._replies.append(message)
+                self._replies_cond.notify_all()
+        elif message.get("doc_id", self.doc_id) != self.doc_id and msg_type not in ("DOC_STATE", "DOC_CHUNK"):
+            return  # Sent for a document we already left
+        elif msg_type == "DOC_STATE" and message.get("more"):
+            self._loading = (message, [message.get("content", "")])  # The rest follows in DOC_CHUNKs
+        elif msg_type == "DOC_CHUNK":
+            if self._loading is None or message.get("doc_id") != self._loading[0].get("doc_id"):
+                return
+            state, chunks = self._loading
+            chunks.append(message.get("content", ""))
+            if not message.get("more"):
+                self._loading = None
+                self._handle(dict(state, content="".join(chunks), more=False))
+        elif msg_type == "PRESENCE":
+            if "you" in message:
+                self.presence_id = message["you"]
+                self.presence = {}
+            for entry in message.get("users", []):
+                self.presence[entry["id"]] = entry
+            for presence_id in message.get("left", []):
+                self.presence.pop(presence_id, None)
+        elif msg_type in ("DOC_STATE", "EDIT_UPDATE"):
+            with self._lock:
+                if msg_type == "DOC_STATE" and message.get("doc_id") != self.doc_id:
+                    self.presence = {}
+                if self._doc_ready.is_set():
+                    self.resyncs += 1
+                self.doc_id = message.get("doc_id", self.doc_id)
+                self.text = message.get("content", "")
+                self.version = message.get("version", self.version)
+                self.outstanding_ops = None
+                self.buffered_ops = []
+                self._doc_ready.set()
+        elif msg_type == "EDIT_OP":
+            arrived = time.perf_counter()
+            with self._lock:
+                ops = message.get("ops", [])
+                if self.outstanding_ops is not None:
+                    self.outstanding_ops, ops = transform(self.outstanding_ops, ops)
+                if self.buffered_ops:
+                    self.buffered_ops, ops = transform(self.buffered_ops, ops)
+                self.text = apply_ops(self.text, ops)
+                # The server may coalesce several EDIT_OPs into one; each revision arrived now.
+                for revision in range(self.version + 1, message.get("version", self.version) + 1):
+                    self.received_at[revision] = arrived
+                self.version = message.get("version", self.version)
+        elif msg_type == "EDIT_ACK":
+            with self._lock:
+                self.version = message.get("version", self.version)
+                if self._outstanding_sent_at is not None:
+                    self.sent_at[self.version] = self._outstanding_sent_at
+                    self._outstanding_sent_at = None
+                self.outstanding_ops = None
+                self._flush_locked()
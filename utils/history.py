@@ -0,0 +1,283 @@
+# utils/history.py
+# Revision history of a document: compressed keyframes and deltas, and an index to find any revision.
+#
+# Layout of a document's history directory:
+#   revisions.dat    groups, one zlib stream each: the text of a keyframe revision,
+#                    then the ops of every later revision up to the next keyframe.
+#                    Each record is prefixed with its length ("<I").
+#   revisions.idx    one fixed-size entry per revision, in order: revision, time,
+#                    entry number of its keyframe, and the .dat offset up to which
+#                    the stream covers it (a sync flush point)
+# Reading revision r decompresses its group up to r and replays at most one
+# group's deltas, so the cost is bounded by the keyframe spacing, not by r.
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from utils.log import get_logger
+from utils.metrics import registry
+from utils.rope import Rope
+
+DATA_FILE = "revisions.dat"
+INDEX_FILE = "revisions.idx"
+ENTRY = struct.Struct("<QdIQ")  # revision, time.time(), keyframe entry, end offset
+RECORD_LENGTH = struct.Struct("<I")
+COMPRESSION_LEVEL = 6
+# A new keyframe starts once the deltas since the last one add up to its size,
+# or after KEYFRAME_INTERVAL deltas (more for large documents: one per
+# KEYFRAME_BYTES_PER_DELTA bytes of text), whichever comes first.
+KEYFRAME_INTERVAL = 500
+KEYFRAME_BYTES_PER_DELTA = 4096
+
+logger = get_logger("history")
+READ_SECONDS = registry.histogram("history_read_seconds")
+
+
+class RevisionStore:
+    """
+    Every revision of one document, on disk.
+
+    append() only queues the revision (cheap enough to call with the document lock
+    held; the text is an immutable Rope, so no copy is made); the committer's
+    thread compresses and writes it, a keyframe a rope chunk at a time. Give the
+    store a committer of its own, not the write-ahead log's: a large keyframe takes
+    a while to compress. Reads write out what is queued first.
+
+    Files are opened per write or read, so a loaded document holds no descriptors.
+    They are only fsynced by close(): after a crash the history may lose its
+    newest revisions, never the document, and a torn tail is cut off when the
+    store is opened again.
+    """
+
+    def __init__(self, directory, committer):
+        self.directory = directory
+        self.committer = committer
+        self.data_path = os.path.join(directory, DATA_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self._lock = threading.Lock()  # guards _pending and _latest
+        self._pending = []  # [(revision, ts, text, ops)]; ops None for a keyframe
+        self._io_lock = threading.Lock()  # guards the files and the group state below
+        os.makedirs(directory, exist_ok=True)
+        self._count = self._repair()
+        with open(self.index_path, 'rb') as index:
+            last = _entry(index, self._count - 1) if self._count else None
+        self._latest = last[0] if last else -1  # newest revision, queued or written
+        self._written = self._latest  # newest revision on disk
+        self._data_size = last[3] if last else 0
+        # The open group; None after opening, so the next revision is a keyframe.
+        self._compressor = None
+        self._keyframe = 0  # entry number of the group's keyframe
+        self._keyframe_bytes = 0
+        self._deltas = 0
+        self._delta_bytes = 0
+
+    def _repair(self):
+        """Drops index entries (and data) a crash left incomplete. Returns the entry count."""
+        with open(self.data_path, 'ab+') as data, open(self.index_path, 'ab+') as index:
+            index_size = os.fstat(index.fileno()).st_size
+            data_size = os.fstat(data.fileno()).st_size
+            count = index_size // ENTRY.size
+            while count and _entry(index, count - 1)[3] > data_size:
+                count -= 1
+            if count * ENTRY.size != index_size:
+                logger.warning("Cut a torn tail off the revision history in %s.", self.directory)
+                index.truncate(count * ENTRY.size)
+            data.truncate(_entry(index, count - 1)[3] if count else 0)
+        return count
+
+    @property
+    def latest(self):
+        """The newest revision stored (or queued), -1 if none."""
+        with self._lock:
+            return self._latest
+
+    # --- Queueing (any thread, cheap) ---
+    def append(self, revision, text, ops=None):
+        """
+        Queues `revision`, whose full text is `text` (a str or Rope) and which `ops`
+        produced from the previous revision (None for a full replace). Revisions
+        not newer than the latest are ignored, so replaying a log is harmless.
+        """
+        with self._lock:
+            if revision <= self._latest:
+                return
+            self._latest = revision
+            self._pending.append((revision, time.time(), text, ops))
+        self.committer.schedule(self)
+
+    def close(self):
+        """Writes out what is queued and fsyncs both files."""
+        with self._io_lock:
+            self._flush_locked()
+            for path in (self.data_path, self.index_path):
+                with open(path, 'rb') as f:
+                    os.fsync(f.fileno())
+
+    # --- File I/O (committer thread, or a reader) ---
+    def flush(self):
+        with self._io_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        with self._lock:
+            entries, self._pending = self._pending, []
+        if not entries:
+            return
+        unflushed = []  # (revision, ts, keyframe entry) waiting for the next sync flush point
+        with open(self.data_path, 'ab') as data:
+            for revision, ts, text, ops in entries:
+                keyframe = (ops is None or self._compressor is None or revision != self._written + 1
+                            or self._deltas >= max(KEYFRAME_INTERVAL, self._keyframe_bytes // KEYFRAME_BYTES_PER_DELTA)
+                            or self._delta_bytes >= self._keyframe_bytes)
+                if keyframe:
+                    if unflushed:
+                        self._sync(data, unflushed)
+                    self._compressor = zlib.compressobj(COMPRESSION_LEVEL)
+                    self._keyframe = self._count
+                    self._keyframe_bytes = self._write_keyframe(data, text)
+                    self._deltas = self._delta_bytes = 0
+                else:
+                    record = json.dumps(ops, separators=(',', ':')).encode('utf-8')
+                    self._deltas += 1
+                    self._delta_bytes += len(record)
+                    self._write(data, RECORD_LENGTH.pack(len(record)) + record)
+                unflushed.append((revision, ts, self._keyframe))
+                self._written = revision
+            self._sync(data, unflushed)
+
+    def _write_keyframe(self, data, text):
+        """
+        Compresses the text of a keyframe into the group piece by piece, so a large
+        (mapped) document is never encoded as one string. Returns its size in bytes.
+        """
+        rope = text if isinstance(text, Rope) else Rope(text)
+        size = rope.encoded_length()
+        self._write(data, RECORD_LENGTH.pack(size))
+        for chunk in rope.encoded_chunks():
+            self._write(data, chunk)
+        return size
+
+    def _write(self, data, raw):
+        compressed = self._compressor.compress(raw)
+        if compressed:
+            data.write(compressed)
+            self._data_size += len(compressed)
+
+    def _sync(self, data, unflushed):
+        """Ends the pending records at a sync flush point, then writes their index entries."""
+        tail = self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        data.write(tail)
+        data.flush()  # The index must never point past the data
+        self._data_size += len(tail)
+        with open(self.index_path, 'ab') as f:
+            f.write(b"".join(ENTRY.pack(revision, ts, keyframe, self._data_size)
+                             for revision, ts, keyframe in unflushed))
+        self._count += len(unflushed)
+        unflushed.clear()
+
+    # --- Reading ---
+    def _find(self, index, revision):
+        """Entry number of `revision`, or None. Revisions are usually consecutive, so try that first."""
+        if not self._count:
+            return None
+        guess = revision - _entry(index, 0)[0]
+        if 0 <= guess < self._count and _entry(index, guess)[0] == revision:
+            return guess
+        number = self._search(index, lambda entry: entry[0] < revision)
+        return number if number < self._count and _entry(index, number)[0] == revision else None
+
+    def _search(self, index, is_before):
+        """Number of leading entries for which is_before(entry) holds (binary search)."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if is_before(_entry(index, middle)):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def page(self, before=None, limit=50):
+        """Up to `limit` revisions older than `before` (None: the newest), oldest first, as {"revision", "ts"}."""
+        with self._io_lock:
+            self._flush_locked()
+            with open(self.index_path, 'rb') as index:
+                end = self._count if before is None else self._search(index, lambda entry: entry[0] < before)
+                start = max(0, end - limit)
+                data = os.pread(index.fileno(), (end - start) * ENTRY.size, start * ENTRY.size)
+        return [{"revision": revision, "ts": ts} for revision, ts, _, _ in ENTRY.iter_unpack(data)]
+
+    def read(self, revision=None, at=None):
+        """
+        Rebuilds a revision: the given one, or the last made at or before time `at`.
+        Returns {"revision", "ts", "content": Rope}, or None if the history does not have it.
+        """
+        started = time.perf_counter()
+        with self._io_lock:
+            self._flush_locked()
+            with open(self.index_path, 'rb') as index:
+                if at is None:
+                    number = self._find(index, revision)
+                else:
+                    number = self._search(index, lambda entry: entry[1] <= at) - 1
+                if number is None or number < 0:
+                    return None
+                found, ts, keyframe, end = _entry(index, number)
+                start = _entry(index, keyframe - 1)[3] if keyframe else 0
+            with open(self.data_path, 'rb') as f:
+                data = os.pread(f.fileno(), end - start, start)
+
+        stream = zlib.decompressobj().decompress(data)
+        position = 0
+        text = None
+        for _ in range(number - keyframe + 1):
+            (length,) = RECORD_LENGTH.unpack_from(stream, position)
+            record = stream[position + RECORD_LENGTH.size:position + RECORD_LENGTH.size + length]
+            position += RECORD_LENGTH.size + length
+            text = Rope(record.decode('utf-8')) if text is None else text.apply(json.loads(record))
+        READ_SECONDS.observe(time.perf_counter() - started)
+        return {"revision": found, "ts": ts, "content": text}
+
+    def sizes(self):
+        """(data bytes, index bytes) on disk."""
+        with self._io_lock:
+            self._flush_locked()
+            return self._data_size, self._count * ENTRY.size
+
+
+def _entry(index, number):
+    return ENTRY.unpack(os.pread(index.fileno(), ENTRY.size, number * ENTRY.size))
+
+
+# --- Optional Local Test Block ---
+if __name__ == "__main__":
+    import tempfile
+
+    from utils.oplog import GroupCommitter
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = RevisionStore(directory, GroupCommitter())
+        texts = [Rope("Hello")]
+        store.append(0, texts[0])
+        for revision in range(1, 1200):
+            ops = [{"op": "insert", "pos": len(texts[-1]), "text": f" {revision}"}]
+            texts.append(texts[-1].apply(ops))
+            store.append(revision, texts[-1], ops)
+        store.append(1200, "Replaced")
+        texts.append(Rope("Replaced"))
+        print("Every Revision Rebuilt:", all(str(store.read(r)["content"]) == str(texts[r]) for r in range(0, 1201, 7)))
+        print("Page:", [entry["revision"] for entry in store.page(before=10, limit=3)])
+        print("At Time:", store.read(at=time.time())["revision"] == 1200)
+        data_bytes, index_bytes = store.sizes()
+        full_copies = sum(len(str(t)) for t in texts)
+        print(f"Stored {data_bytes + index_bytes} bytes for {full_copies} bytes of full copies")
+        store.close()
+
+        with open(os.path.join(directory, INDEX_FILE), 'ab') as f:
+            f.write(b"torn")
+        reopened = RevisionStore(directory, GroupCommitter())
+        reopened.append(1201, "After reopening", None)
+        print("Reopened:", reopened.latest == 1201, str(reopened.read(1199)["content"]) == str(texts[1199]))
@@ -0,0 +1,67 @@
+# utils/log.py
+# Leveled, rate-limited logging for the server.
+import logging
+import os
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("NOTEPAD_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+# Each message template may be logged LOG_BURST times per LOG_PERIOD seconds;
+# the rest are dropped and counted, and the count is reported with the next one let through.
+LOG_BURST = 20
+LOG_PERIOD = 10.0
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits how often each message template (record.msg, before formatting) is
+    emitted, so a flood of identical events (connects, rejected edits) cannot turn
+    logging into the bottleneck. Log calls must pass values as arguments
+    (log.info("x %s", value)), not pre-formatted strings, for this to group them.
+    """
+
+    def __init__(self, burst=LOG_BURST, period=LOG_PERIOD):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self._windows = {}  # {(logger name, template): [window start, emitted, suppressed]}
+        self._lock = threading.Lock()
+        self.suppressed_total = 0
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                self.suppressed_total += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+rate_limit = RateLimitFilter()
+
+
+def configure_logging(level=LOG_LEVEL):
+    """Sends notepad.* records at `level` and above to stderr through the rate limiter."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(rate_limit)
+    root = logging.getLogger("notepad")
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    root.propagate = False
+
+
+def get_logger(name):
+    return logging.getLogger(f"notepad.{name}")
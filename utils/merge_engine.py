@@ -0,0 +1,84 @@
+# utils/merge_engine.py
+# Server-side merge engine: orders concurrent EDIT_OPs into a single revision history.
+from collections import deque
+from itertools import islice
+
+from utils.operations import transform, validate_ops
+from utils.rope import Rope
+
+
+class DocumentTooLarge(ValueError):
+    """Raised for edits that would make the document longer than its max_length."""
+
+
+class MergeEngine:
+    """
+    Holds one document (a Rope; pass a str or a Rope) and its revision counter.
+
+    Clients send ops based on the last revision they saw. Ops that were accepted
+    since then are kept in a bounded history, and incoming ops are transformed
+    against them before being applied, so concurrent edits are merged instead of
+    overwriting each other.
+
+    With max_length set, edits that would make the text longer are refused (a
+    document already over it may still shrink).
+    """
+
+    def __init__(self, text="", revision=0, history_limit=1000, max_length=None):
+        self.text = Rope(text)
+        self.revision = revision
+        self.history = deque(maxlen=history_limit)  # (revision, ops or None for a replace, origin)
+        self.max_length = max_length
+
+    def submit(self, base_revision, ops, origin=None):
+        """
+        Merges ops based on `base_revision` into the document.
+        Returns (new_revision, transformed_ops). Raises ValueError if the ops are
+        malformed or the base revision is unknown / no longer in history, and
+        DocumentTooLarge if they would take the text over max_length.
+        """
+        validate_ops(ops)
+        if not isinstance(base_revision, int) or base_revision > self.revision:
+            raise ValueError(f"unknown base revision {base_revision!r} (current {self.revision})")
+        missing = self.revision - base_revision
+        if missing > len(self.history):
+            raise ValueError(f"base revision {base_revision} is older than the merge history")
+
+        for _, applied_ops, _ in islice(self.history, len(self.history) - missing, None):
+            if applied_ops is None:
+                raise ValueError("document was replaced after the base revision")
+            ops, _ = transform(ops, applied_ops, a_wins_ties=False)
+
+        if self.max_length is not None:
+            growth = sum(len(op["text"]) if op["op"] == "insert" else -op["length"] for op in ops)
+            if growth > 0 and len(self.text) + growth > self.max_length:
+                raise DocumentTooLarge(f"edit would make the document longer than {self.max_length} chars")
+        self.text = self.text.apply(ops)
+        self.revision += 1
+        self.history.append((self.revision, ops, origin))
+        return self.revision, ops
+
+    def entries_since(self, revision):
+        """
+        Returns the (revision, ops, origin) entries accepted after `revision`, or
+        None if some are no longer in history or the document was replaced since.
+        """
+        if not isinstance(revision, int) or revision > self.revision:
+            return None
+        missing = self.revision - revision
+        if missing > len(self.history):
+            return None
+        entries = list(islice(self.history, len(self.history) - missing, None))
+        if any(ops is None for _, ops, _ in entries):
+            return None
+        return entries
+
+    def replace(self, text, origin=None):
+        """
+        Replaces the whole document (EDIT fallback, NEW_FILE). Returns the new revision.
+        Ops based on an earlier revision are rejected afterwards, so their senders resync.
+        """
+        self.text = Rope(text)
+        self.revision += 1
+        self.history.append((self.revision, None, origin))
+        return self.revision
@@ -0,0 +1,225 @@
+# utils/metrics.py
+# In-process counters and histograms, exported as a dict (STATS) or as plaintext over HTTP.
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds, in seconds, of the latency histogram buckets (plus one overflow bucket).
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds for histograms of sizes and counts (bytes, recipients).
+SIZE_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+METRIC_PREFIX = "notepad_"
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. observe() is a bisect and a few additions under a
+    lock of its own, cheap enough for every message. Quantiles are estimated by
+    interpolating inside the bucket that holds them.
+    """
+    __slots__ = ("bounds", "counts", "count", "sum", "max", "_lock")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def time(self):
+        """Context manager that observes the duration of its block."""
+        return _Timer(self)
+
+    def quantile(self, q, counts=None, count=None):
+        counts = self.counts if counts is None else counts
+        count = self.count if count is None else count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            counts, count, total, peak = list(self.counts), self.count, self.sum, self.max
+        return {"count": count, "sum": total, "max": peak,
+                "avg": total / count if count else 0.0,
+                "p50": self.quantile(0.5, counts, count), "p90": self.quantile(0.9, counts, count),
+                "p99": self.quantile(0.99, counts, count)}
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class TimedLock:
+    """
+    A threading.Lock that records how long callers waited for it and how long
+    they held it. Only usable as a context manager (with lock: ...).
+    """
+    __slots__ = ("_lock", "_wait", "_hold", "_acquired_at")
+
+    def __init__(self, wait_histogram, hold_histogram):
+        self._lock = threading.Lock()
+        self._wait = wait_histogram
+        self._hold = hold_histogram
+        self._acquired_at = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = acquired = time.perf_counter()
+        self._wait.observe(acquired - started)
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        self._hold.observe(held)
+
+    def locked(self):
+        return self._lock.locked()
+
+
+class MetricsRegistry:
+    """
+    Named, optionally labelled counters and histograms, created on first use.
+    Collectors are callables returning {name: number} (e.g. a pool's stats());
+    they are read when a snapshot is taken, so they cost nothing in between.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # {(name, labels): Counter or Histogram}
+        self._collectors = {}  # {prefix: callable}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _get(self, kind, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, kind(*args))
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, bounds)
+
+    def add_collector(self, prefix, collect):
+        self._collectors[prefix] = collect
+
+    def snapshot(self):
+        """Returns every metric as {"name{label=value}": value or histogram summary}."""
+        result = {"uptime_seconds": time.time() - self.started_at}
+        for (name, labels), metric in sorted(self._metrics.items()):
+            key = name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+            result[key] = metric.value if isinstance(metric, Counter) else metric.snapshot()
+        for prefix, collect in self._collectors.items():
+            for name, value in collect().items():
+                result[f"{prefix}_{name}"] = value
+        return result
+
+    def render_text(self):
+        """Prometheus-style plaintext exposition of every metric."""
+        lines = [f"{METRIC_PREFIX}uptime_seconds {time.time() - self.started_at:.3f}"]
+        typed = set()
+        for (name, labels), metric in sorted(self._metrics.items()):
+            full_name = METRIC_PREFIX + name
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f"# TYPE {full_name} {'counter' if isinstance(metric, Counter) else 'histogram'}")
+            if isinstance(metric, Counter):
+                lines.append(f"{full_name}{_labels(labels)} {metric.value}")
+                continue
+            with metric._lock:
+                counts, count, total = list(metric.counts), metric.count, metric.sum
+            cumulative = 0
+            for bound, bucket_count in zip(metric.bounds + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{full_name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{full_name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{full_name}_count{_labels(labels)} {count}")
+        for prefix, collect in self._collectors.items():
+            for name, value in collect().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"{METRIC_PREFIX}{prefix}_{name} {float(value):g}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+# The process-wide registry the server and its utilities record into.
+registry = MetricsRegistry()
+
+
+# --- Plaintext endpoint ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+
+def start_metrics_server(host, port, metrics=registry):
+    """Serves GET /metrics on host:port from a daemon thread. Returns the HTTP server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = metrics
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,157 @@
+# utils/operations.py
+# Positional edit operations exchanged in EDIT_OP messages.
+#
+# An operation list is applied in order, each entry against the text produced
+# by the previous one:
+#   {"op": "insert", "pos": 12, "text": "abc"}
+#   {"op": "delete", "pos": 4, "length": 2}
+
+
+def insert_op(pos, text):
+    return {"op": "insert", "pos": pos, "text": text}
+
+
+def delete_op(pos, length):
+    return {"op": "delete", "pos": pos, "length": length}
+
+
+def _common_prefix_length(a, b):
+    """Length of the shared prefix, using slice comparisons instead of a per-char loop."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_length(a, b, limit):
+    """Length of the shared suffix, never overlapping the first `limit` chars."""
+    lo, hi = 0, min(len(a), len(b)) - limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def compute_ops(old_text, new_text):
+    """Returns the ops that turn old_text into new_text (at most one delete and one insert)."""
+    if old_text == new_text:
+        return []
+    prefix = _common_prefix_length(old_text, new_text)
+    suffix = _common_suffix_length(old_text, new_text, prefix)
+    removed = len(old_text) - prefix - suffix
+    inserted = new_text[prefix:len(new_text) - suffix]
+
+    ops = []
+    if removed:
+        ops.append(delete_op(prefix, removed))
+    if inserted:
+        ops.append(insert_op(prefix, inserted))
+    return ops
+
+
+def validate_ops(ops):
+    """Checks the shape of an op list received from the network. Raises ValueError."""
+    if not isinstance(ops, list):
+        raise ValueError("ops must be a list")
+    for op in ops:
+        if not isinstance(op, dict) or not isinstance(op.get("pos"), int) or op["pos"] < 0:
+            raise ValueError(f"malformed op: {op!r}")
+        if op.get("op") == "insert":
+            if not isinstance(op.get("text"), str):
+                raise ValueError(f"insert without text: {op!r}")
+        elif op.get("op") == "delete":
+            if not isinstance(op.get("length"), int) or op["length"] < 0:
+                raise ValueError(f"delete without length: {op!r}")
+        else:
+            raise ValueError(f"unknown op: {op!r}")
+
+
+def apply_ops(text, ops):
+    """Applies an op list to a string and returns the new string. Raises ValueError on bad positions."""
+    for op in ops:
+        pos = op["pos"]
+        if op["op"] == "insert":
+            if pos > len(text):
+                raise ValueError(f"insert at {pos} beyond end of document ({len(text)})")
+            text = text[:pos] + op["text"] + text[pos:]
+        else:
+            end = pos + op["length"]
+            if end > len(text):
+                raise ValueError(f"delete {pos}:{end} beyond end of document ({len(text)})")
+            text = text[:pos] + text[end:]
+    return text
+
+
+# --- Operational Transformation ---
+def _transform_pair(a, b, a_wins_ties):
+    """Rewrites op `a` so it applies after op `b` (both based on the same text). Returns a list."""
+    if a["op"] == "insert":
+        if b["op"] == "insert":
+            if a["pos"] < b["pos"] or (a["pos"] == b["pos"] and a_wins_ties):
+                return [a]
+            return [insert_op(a["pos"] + len(b["text"]), a["text"])]
+        b_end = b["pos"] + b["length"]
+        if a["pos"] <= b["pos"]:
+            return [a]
+        if a["pos"] >= b_end:
+            return [insert_op(a["pos"] - b["length"], a["text"])]
+        return [insert_op(b["pos"], a["text"])]  # inside the deleted range
+
+    a_end = a["pos"] + a["length"]
+    if b["op"] == "insert":
+        if b["pos"] <= a["pos"]:
+            return [delete_op(a["pos"] + len(b["text"]), a["length"])]
+        if b["pos"] >= a_end:
+            return [a]
+        # The insert landed inside our range: delete around it, keeping the new text.
+        head = b["pos"] - a["pos"]
+        return [delete_op(a["pos"], head), delete_op(a["pos"] + len(b["text"]), a["length"] - head)]
+
+    b_end = b["pos"] + b["length"]
+    if a_end <= b["pos"]:
+        return [a]
+    if a["pos"] >= b_end:
+        return [delete_op(a["pos"] - b["length"], a["length"])]
+    overlap = min(a_end, b_end) - max(a["pos"], b["pos"])
+    remaining = a["length"] - overlap
+    if not remaining:
+        return []
+    return [delete_op(min(a["pos"], b["pos"]), remaining)]
+
+
+def transform(ops_a, ops_b, a_wins_ties=False):
+    """
+    Transforms two concurrent op lists based on the same text.
+    Returns (a', b') such that apply(apply(t, a), b') == apply(apply(t, b), a').
+    Concurrent inserts at the same position are ordered by `a_wins_ties`.
+    """
+    if not ops_a or not ops_b:
+        return list(ops_a), list(ops_b)
+    if len(ops_a) == 1 and len(ops_b) == 1:
+        return (_transform_pair(ops_a[0], ops_b[0], a_wins_ties),
+                _transform_pair(ops_b[0], ops_a[0], not a_wins_ties))
+    if len(ops_a) > 1:
+        head_a, ops_b = transform(ops_a[:1], ops_b, a_wins_ties)
+        tail_a, ops_b = transform(ops_a[1:], ops_b, a_wins_ties)
+        return head_a + tail_a, ops_b
+    ops_a, head_b = transform(ops_a, ops_b[:1], a_wins_ties)
+    ops_a, tail_b = transform(ops_a, ops_b[1:], a_wins_ties)
+    return ops_a, head_b + tail_b
+
+
+def transform_position(pos, ops):
+    """Where a caret at `pos` ends up once ops are applied (text inserted at the caret goes before it)."""
+    for op in ops:
+        if op["op"] == "insert":
+            if op["pos"] <= pos:
+                pos += len(op["text"])
+        elif op["pos"] < pos:
+            pos -= min(op["length"], pos - op["pos"])
+    return pos
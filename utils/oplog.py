@@ -0,0 +1,278 @@
+# utils/oplog.py
+# Per-document write-ahead log of accepted edits, with group commit and snapshots.
+#
+# Layout of a document's log directory:
+#   snapshot.txt              {"revision": 120} line, then the raw UTF-8 text (atomically replaced)
+#   000000000001.log ...      JSON records, one per line; segments sort in write order
+# Records are {"r": revision, "ops": [...]} or {"r": revision, "text": "..."} (full replace).
+# Logs written before snapshot.txt have a snapshot.json: {"revision": 120, "content": "..."}.
+import itertools
+import json
+import os
+import threading
+import time
+
+from utils.log import get_logger
+from utils.rope import Rope
+
+logger = get_logger("oplog")  # `log` names a DocumentLog throughout this module
+
+SNAPSHOT_FILE = "snapshot.txt"
+LEGACY_SNAPSHOT_FILE = "snapshot.json"
+SEGMENT_SUFFIX = ".log"
+RETRY_DELAY = 1.0  # seconds before a log whose write failed is flushed again
+
+
+def fsync_directory(path):
+    """Makes a rename inside `path` durable. Not supported (or needed) on Windows."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data):
+    """
+    Writes bytes (or an iterable of bytes chunks) to `path` via a temp file + fsync
+    + rename, so readers never see a torn file. Returns the number of bytes written.
+    """
+    tmp_path = f"{path}.tmp"
+    written = 0
+    with open(tmp_path, 'wb') as f:
+        for chunk in (data,) if isinstance(data, bytes) else data:
+            written += f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(os.path.dirname(path) or '.')
+    return written
+
+
+class GroupCommitter:
+    """
+    One background thread that writes and fsyncs every log with pending records.
+    After the first record arrives it waits `interval` seconds to collect more, so
+    a burst of edits costs one fsync per document instead of one per edit. A log
+    whose flush raised OSError is tried again after RETRY_DELAY seconds.
+    """
+
+    def __init__(self, interval=0.005, name="group-commit"):
+        self.interval = interval
+        self.name = name
+        self._pending_logs = set()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def schedule(self, log):
+        with self._cond:
+            self._pending_logs.add(log)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending_logs:
+                    self._cond.wait()
+            time.sleep(self.interval)
+            with self._cond:
+                logs, self._pending_logs = self._pending_logs, set()
+            for log in logs:
+                try:
+                    log.flush()
+                except OSError as e:
+                    logger.error("%s: flush failed for %s: %s", self.name, log.directory, e)
+                    retry = threading.Timer(RETRY_DELAY, self.schedule, (log,))
+                    retry.daemon = True
+                    retry.start()
+
+
+class DocumentLog:
+    """
+    Write-ahead log and snapshots of one document.
+
+    append() and request_snapshot() only queue work (cheap enough to call with
+    the document lock held); the GroupCommitter thread does all file I/O, in
+    order, so records and snapshots never race.
+    """
+
+    def __init__(self, directory, committer):
+        self.directory = directory
+        self.committer = committer
+        self._lock = threading.Condition()
+        self._pending = []  # [("record", bytes) | ("snapshot", text, revision) | ("close",)]
+        self._appended = 0  # sequence number of the last queued entry
+        self._durable = 0   # sequence number of the last entry on disk
+        self.error = None   # OSError of the last failed flush; None once a flush succeeds
+        self._failures = 0  # failed flushes so far
+        self._segment = None
+        os.makedirs(directory, exist_ok=True)
+
+    # --- Recovery ---
+    def recover(self, on_record=None):
+        """
+        Rebuilds (text, revision) from the snapshot and the log tail, or returns
+        None if this document has no snapshot yet. The text is a Rope that maps
+        the snapshot file rather than reading it. on_record(revision, text, ops)
+        is called after each record replayed (ops None for a full replace).
+        """
+        snapshot = self._read_snapshot()
+        if snapshot is None:
+            return None
+        text, revision = snapshot
+
+        for segment in self._segments():
+            with open(segment, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn tail from a crash mid-write; nothing valid follows it
+                    if record["r"] <= revision:
+                        continue
+                    if "text" in record:
+                        text = Rope(record["text"])
+                    else:
+                        text = text.apply(record["ops"])
+                    revision = record["r"]
+                    if on_record:
+                        on_record(revision, text, record.get("ops"))
+        return text, revision
+
+    def _read_snapshot(self):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                header = f.readline()
+            return Rope.from_file(path, offset=len(header)), json.loads(header)["revision"]
+        legacy_path = os.path.join(self.directory, LEGACY_SNAPSHOT_FILE)
+        if os.path.exists(legacy_path):
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            return Rope(snapshot["content"]), snapshot["revision"]
+        return None
+
+    def _segments(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, n) for n in names]
+
+    # --- Queueing (any thread, cheap) ---
+    def _queue(self, entry):
+        with self._lock:
+            self._pending.append(entry)
+            self._appended += 1
+            sequence = self._appended
+        self.committer.schedule(self)
+        return sequence
+
+    def append(self, revision, ops=None, text=None):
+        """Queues one accepted edit. Returns a sequence number for wait_durable()."""
+        record = {"r": revision, "text": text} if ops is None else {"r": revision, "ops": ops}
+        return self._queue(("record", (json.dumps(record) + "\n").encode('utf-8')))
+
+    def request_snapshot(self, text, revision):
+        """Queues a snapshot of `text` (a str or Rope) at `revision`; older log segments are dropped after it."""
+        return self._queue(("snapshot", text, revision))
+
+    def close(self, timeout=10.0):
+        """Flushes everything queued and closes the log file."""
+        return self.wait_durable(self._queue(("close",)), timeout)
+
+    def sync(self, timeout=None):
+        """Waits until everything queued so far is on disk. Returns False like wait_durable()."""
+        with self._lock:
+            sequence = self._appended
+        return self.wait_durable(sequence, timeout)
+
+    def discard(self):
+        """Drops whatever is still queued (a document that could not be created)."""
+        with self._lock:
+            self._pending = []
+
+    def wait_durable(self, sequence, timeout=None):
+        """
+        Blocks until entry `sequence` has been fsynced. Returns False on timeout, or
+        as soon as a flush fails meanwhile (the entry stays queued and is retried; see `error`).
+        """
+        with self._lock:
+            failures = self._failures
+            self._lock.wait_for(lambda: self._durable >= sequence or self._failures > failures, timeout)
+            return self._durable >= sequence
+
+    # --- File I/O (GroupCommitter thread only) ---
+    def flush(self):
+        with self._lock:
+            entries, self._pending = self._pending, []
+            sequence = self._appended
+        if not entries:
+            return
+
+        try:
+            for entry in entries:
+                if entry[0] == "record":
+                    if self._segment is None:
+                        self._segment = open(self._new_segment_path(), 'ab')
+                    self._segment.write(entry[1])
+                elif entry[0] == "snapshot":
+                    self._write_snapshot(entry[1], entry[2])
+                else:  # close
+                    self._close_segment()
+            if self._segment is not None:
+                self._segment.flush()
+                os.fsync(self._segment.fileno())
+        except OSError as e:
+            # Queue the entries again for the retry. It starts a new segment, so a torn
+            # line here only ends this segment's replay; records written twice are
+            # skipped on recovery (same revision).
+            self._abandon_segment()
+            with self._lock:
+                self._pending[:0] = entries
+                self.error = e
+                self._failures += 1
+                self._lock.notify_all()
+            raise
+
+        with self._lock:
+            self._durable = sequence
+            self.error = None
+            self._lock.notify_all()
+
+    def _new_segment_path(self):
+        # Named after a counter so segments sort in write order.
+        existing = self._segments()
+        last = int(os.path.basename(existing[-1])[:-len(SEGMENT_SUFFIX)]) if existing else 0
+        return os.path.join(self.directory, f"{last + 1:012d}{SEGMENT_SUFFIX}")
+
+    def _abandon_segment(self):
+        if self._segment is not None:
+            try:
+                self._segment.close()
+            except OSError:
+                pass
+            self._segment = None
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._segment.close()
+            self._segment = None
+
+    def _write_snapshot(self, text, revision):
+        # Records queued before this snapshot are all covered by it: seal the current
+        # segment, write the snapshot atomically, then drop every segment.
+        # The text is streamed to disk, never built as one string.
+        self._close_segment()
+        header = (json.dumps({"revision": revision}) + "\n").encode('utf-8')
+        chunks = Rope(text).encoded_chunks()
+        atomic_write(os.path.join(self.directory, SNAPSHOT_FILE), itertools.chain((header,), chunks))
+        for segment in self._segments():
+            os.remove(segment)
+        legacy_path = os.path.join(self.directory, LEGACY_SNAPSHOT_FILE)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
@@ -0,0 +1,211 @@
+# utils/outbound.py
+# Bounded per-connection send queue. Producers (broadcasts, replies) only enqueue;
+# each connection drains its own queue, so one slow socket cannot stall the others.
+import threading
+import time
+from collections import deque
+
+from utils.metrics import registry
+from utils.protocol_helpers import Frame, JSON_CODEC
+
+# Message types that carry the full document; a newer one makes older ones obsolete.
+FULL_STATE_TYPES = ("DOC_STATE", "EDIT_UPDATE")
+
+
+def _size(buffers):
+    return len(buffers[0]) + len(buffers[1])
+
+
+_counters = {}  # {message type: (messages_out, bytes_out, coalesced) counters}
+
+
+def _counters_for(msg_type):
+    counters = _counters.get(msg_type)
+    if counters is None:
+        counters = _counters[msg_type] = (registry.counter("messages_out", type=msg_type),
+                                          registry.counter("bytes_out", type=msg_type),
+                                          registry.counter("coalesced_out", type=msg_type))
+    return counters
+
+
+class OutboundQueue:
+    """
+    Thread-safe FIFO of pre-encoded Frames with a message, byte and lag budget.
+    The same Frame object can sit in many queues at once (encode-once broadcast);
+    each frame is encoded with the queue's codec at the time it is enqueued.
+
+    While a client lags, consecutive document updates are coalesced in the queue:
+    a full state replaces a queued full state (still as a DOC_STATE if either was
+    one, since only DOC_STATE switches the client's document), and EDIT_OPs of the
+    same document are merged into one message carrying all ops and the latest version.
+
+    put_stream() queues an iterator of Frames (a large DOC_STATE in chunks) as one
+    entry. Its frames are only produced and encoded when the writer reaches them,
+    one at a time, so the document is never held in the queue as a whole, and the
+    lag budget counts from the last chunk taken rather than from when it was queued.
+    """
+
+    def __init__(self, max_messages=1000, max_bytes=8 * 1024 * 1024, max_lag=10.0):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_lag = max_lag
+        self._items = deque()  # [frame, (header, body), enqueued_at] or [frame iterator, None, last progress]
+        self._bytes = 0
+        self.codec = JSON_CODEC
+        self.compress = False
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def _coalesce(self, frame):
+        """Folds frame into the queue tail if possible. Returns True if it did."""
+        if not self._items or self._items[-1][1] is None:
+            return False
+        tail = self._items[-1]
+        tail_message, message = tail[0].message, frame.message
+        tail_type, msg_type = tail_message.get("type"), message.get("type")
+
+        if tail_type in FULL_STATE_TYPES and msg_type in FULL_STATE_TYPES:
+            if msg_type == "DOC_STATE" or tail_type == "EDIT_UPDATE":
+                merged = frame
+            elif tail_message.get("doc_id") == message.get("doc_id"):
+                # The queued DOC_STATE may switch the client's document; keep that meaning.
+                merged = Frame(dict(message, type="DOC_STATE"))
+            else:
+                return False
+        elif tail_type == "EDIT_OP" and msg_type == "EDIT_OP" and tail_message.get("doc_id") == message.get("doc_id"):
+            # Only lagging clients pay for this re-encode; shared frames are not modified.
+            merged = Frame(dict(message, ops=tail_message["ops"] + message["ops"]))
+        else:
+            return False
+
+        buffers = merged.buffers(self.codec, self.compress)
+        growth = _size(buffers) - _size(tail[1])
+        self._bytes += growth
+        tail[0], tail[1] = merged, buffers
+        _, bytes_out, coalesced = _counters_for(msg_type)
+        bytes_out.inc(max(growth, 0))  # A newer full state can be smaller than the one it replaces
+        coalesced.inc()
+        return True
+
+    def set_encoding(self, codec, compress):
+        """Switches the wire format for frames enqueued from now on (after HELLO)."""
+        with self._cond:
+            self.codec, self.compress = codec, compress
+
+    def put(self, frame):
+        """Enqueues a Frame. Returns False if the queue is closed or over budget."""
+        with self._cond:
+            if self.closed:
+                return False
+            if not self._coalesce(frame):
+                buffers = frame.buffers(self.codec, self.compress)
+                self._items.append([frame, buffers, time.monotonic()])
+                self._bytes += _size(buffers)
+                self._count(frame, buffers)
+            if self._over_budget():
+                return False
+            self._cond.notify()
+            return True
+
+    def put_stream(self, frames):
+        """Enqueues an iterator of Frames, sent in order as one entry. Returns False like put()."""
+        with self._cond:
+            if self.closed:
+                return False
+            self._items.append([iter(frames), None, time.monotonic()])
+            if self._over_budget():
+                return False
+            self._cond.notify()
+            return True
+
+    def _over_budget(self):
+        return (len(self._items) > self.max_messages or self._bytes > self.max_bytes
+                or time.monotonic() - self._items[0][2] > self.max_lag)
+
+    def _count(self, frame, buffers):
+        messages_out, bytes_out, _ = _counters_for(frame.message.get("type"))
+        messages_out.inc()
+        bytes_out.inc(_size(buffers))
+
+    def _pop(self):
+        """Removes the next frame's buffers (call with _cond held). None if the queue is empty."""
+        while self._items:
+            head = self._items[0]
+            if head[1] is not None:
+                self._items.popleft()
+                self._bytes -= _size(head[1])
+                return head[1]
+            frame = next(head[0], None)
+            if frame is None:
+                self._items.popleft()  # Stream finished
+                continue
+            head[2] = time.monotonic()
+            buffers = frame.buffers(self.codec, self.compress)
+            self._count(frame, buffers)
+            return buffers
+        return None
+
+    def get(self):
+        """Blocks until a frame is available and returns its (header, body) buffers.
+        Returns None once the queue is closed and empty."""
+        with self._cond:
+            while not self._items and not self.closed:
+                self._cond.wait()
+            return self._pop()
+
+    def drain(self):
+        """
+        Removes queued frames without blocking and returns their buffers, flattened.
+        Stops after one chunk of a stream; the rest of it stays queued (len() > 0).
+        """
+        with self._cond:
+            buffers = []
+            while self._items:
+                streaming = self._items[0][1] is None
+                frame_buffers = self._pop()
+                if frame_buffers is None:
+                    break
+                buffers.extend(frame_buffers)
+                if streaming:
+                    break
+            return buffers
+
+    def close(self, discard=True):
+        """Stops accepting messages. With discard=False, queued frames can still be drained."""
+        with self._cond:
+            self.closed = True
+            if discard:
+                self._items.clear()
+                self._bytes = 0
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._items)
+
+
+# --- Optional Local Test Block ---
+if __name__ == "__main__":
+    from utils.protocol_helpers import decode_body
+
+    def sent(queue):
+        buffers = queue.drain()
+        return [decode_body(body, False) for body in buffers[1::2]]
+
+    queue = OutboundQueue()
+    queue.put(Frame({"type": "EDIT_UPDATE", "doc_id": "A", "content": "a", "version": 1}))
+    queue.put(Frame({"type": "DOC_STATE", "doc_id": "B", "content": "b", "version": 1}))
+    queue.put(Frame({"type": "EDIT_UPDATE", "doc_id": "B", "content": "bb", "version": 2}))
+    print("DOC_STATE Then EDIT_UPDATE:", sent(queue) == [{"type": "DOC_STATE", "doc_id": "B", "content": "bb", "version": 2}])
+
+    queue.put(Frame({"type": "DOC_STATE", "doc_id": "B", "content": "b", "version": 1}))
+    queue.put(Frame({"type": "EDIT_UPDATE", "doc_id": "A", "content": "a", "version": 3}))
+    print("Other Document Not Merged:", [m["type"] for m in sent(queue)] == ["DOC_STATE", "EDIT_UPDATE"])
+
+    queue.put(Frame({"type": "EDIT_OP", "doc_id": "B", "ops": [{"op": "insert", "pos": 0, "text": "x"}], "version": 3}))
+    queue.put(Frame({"type": "EDIT_OP", "doc_id": "B", "ops": [{"op": "insert", "pos": 1, "text": "y"}], "version": 4}))
+    merged = sent(queue)
+    print("EDIT_OPs Merged:", len(merged) == 1 and len(merged[0]["ops"]) == 2 and merged[0]["version"] == 4)
+
+    queue.put(Frame({"type": "EDIT_OP", "doc_id": "A", "ops": [{"op": "insert", "pos": 0, "text": "x"}], "version": 7}))
+    queue.put(Frame({"type": "EDIT_OP", "doc_id": "B", "ops": [{"op": "insert", "pos": 0, "text": "y"}], "version": 5}))
+    print("EDIT_OPs Of Other Documents Not Merged:", [m["doc_id"] for m in sent(queue)] == ["A", "B"])
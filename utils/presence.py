@@ -0,0 +1,125 @@
+# utils/presence.py
+# Live cursors: each session's caret and selection, fanned out per document at a fixed tick.
+import threading
+import time
+
+from utils.log import get_logger
+from utils.metrics import registry
+from utils.operations import transform_position
+
+log = get_logger("presence")
+UPDATES = registry.counter("presence_updates")
+FRAMES = registry.counter("presence_frames")
+
+
+class PresenceHub:
+    """
+    Where everyone's caret is, per document.
+
+    update() only records a connection's newest caret and selection, so any
+    number of moves between two ticks cost one entry. A ticker thread sends each
+    document whose entries changed one PRESENCE frame, encoded once for all of
+    its subscribers, with the entries that changed and the IDs that left:
+        {"type": "PRESENCE", "doc_id", "users": [{"id", "user", "cursor", "selection"}], "left": [id]}
+    A connection's first update on a document gets it every entry, plus "you":
+    its own ID. IDs are conn.presence_id, never session IDs (those resume sessions).
+
+    Positions are chars into the sender's text at the revision it sent with; on
+    documents this process owns they are moved past edits accepted since then.
+    A connection leaves when it is no longer subscribed to the document.
+    """
+
+    def __init__(self, hz=10.0):
+        self.interval = 1.0 / hz
+        self._lock = threading.Lock()
+        self._docs = {}  # {doc: _DocPresence}
+        self._where = {}  # {conn: doc it last sent a position on}
+        threading.Thread(target=self._run, name="presence-tick", daemon=True).start()
+
+    def update(self, conn, doc, cursor, selection=None, version=None):
+        UPDATES.inc()
+        entry = {"id": conn.presence_id, "user": conn.user_id, "cursor": cursor, "selection": selection,
+                 "version": version, "conn": conn}
+        with self._lock:
+            previous = self._where.get(conn)
+            if previous is not None and previous is not doc:
+                self._docs[previous].remove(conn.presence_id)
+            self._where[conn] = doc
+            state = self._docs.get(doc)
+            if state is None:
+                state = self._docs[doc] = _DocPresence()
+            state.entries[conn.presence_id] = entry
+            state.changed.add(conn.presence_id)
+            state.left.discard(conn.presence_id)
+            snapshot = list(state.entries.values()) if previous is not doc else None
+        if snapshot is not None:
+            conn.send({"type": "PRESENCE", "doc_id": doc.doc_id, "you": conn.presence_id,
+                       "users": _positions(doc, snapshot), "left": []})
+
+    # --- Ticker thread ---
+    def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.interval
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+            try:
+                self.tick()
+            except Exception as e:
+                log.error("Presence tick failed: %s", e)
+
+    def tick(self):
+        """Sends every document with changes its PRESENCE frame."""
+        batches = []
+        with self._lock:
+            for doc, state in list(self._docs.items()):
+                for presence_id, entry in list(state.entries.items()):
+                    conn = entry["conn"]
+                    if conn.document is not doc:  # Switched documents or disconnected
+                        state.remove(presence_id)
+                        if self._where.get(conn) is doc:
+                            del self._where[conn]
+                if state.changed or state.left:
+                    batches.append((doc, [state.entries[i] for i in state.changed], list(state.left)))
+                    state.changed, state.left = set(), set()
+                if not state.entries:
+                    del self._docs[doc]
+        for doc, entries, left in batches:
+            FRAMES.inc()
+            doc.broadcast({"type": "PRESENCE", "doc_id": doc.doc_id, "users": _positions(doc, entries),
+                           "left": left})
+
+    def stats(self):
+        with self._lock:
+            return {"documents": len(self._docs), "connections": len(self._where)}
+
+
+class _DocPresence:
+    __slots__ = ("entries", "changed", "left")
+
+    def __init__(self):
+        self.entries = {}  # {presence_id: entry}
+        self.changed = set()  # IDs updated since the last tick
+        self.left = set()  # IDs gone since the last tick
+
+    def remove(self, presence_id):
+        if self.entries.pop(presence_id, None) is not None:
+            self.changed.discard(presence_id)
+            self.left.add(presence_id)
+
+
+def _positions(doc, entries):
+    """The public part of entries, with positions moved to the document's current revision if we can."""
+    missed = {}  # {version: history entries since}
+    versions = {entry["version"] for entry in entries if entry["version"] is not None}
+    if versions and not doc.remote:
+        with doc.lock:
+            missed = {version: doc.engine.entries_since(version) for version in versions}
+    users = []
+    for entry in entries:
+        cursor, selection = entry["cursor"], entry["selection"]
+        for _, ops, _ in missed.get(entry["version"]) or ():
+            cursor = transform_position(cursor, ops)
+            if selection:
+                selection = [transform_position(selection[0], ops), transform_position(selection[1], ops)]
+        users.append({"id": entry["id"], "user": entry["user"], "cursor": cursor, "selection": selection})
+    return users
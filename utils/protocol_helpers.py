@@ -1,34 +1,273 @@
+import asyncio
 import json
+import socket
 import struct
+import zlib
 
-def send_message(sock, message_dict):
-    """Encodes and sends a JSON dictionary with a 4-byte length prefix."""
+try:
+    import msgpack  # Optional compact binary codec
+except ImportError:
+    msgpack = None
+
+# Vectored I/O lets the header and the body go out in one syscall without
+# concatenating them first. Windows sockets have no sendmsg.
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Frame header: 4-byte big-endian length (>I). The top bit marks a zlib-compressed
+# body, so frames are limited to 2 GB and old peers (which never set it) still parse.
+HEADER = struct.Struct('>I')
+COMPRESSED_FLAG = 0x80000000
+LENGTH_MASK = 0x7FFFFFFF
+COMPRESS_THRESHOLD = 16 * 1024  # Only bodies at least this large are compressed
+COMPRESS_LEVEL = 1
+
+class ProtocolError(Exception):
+    """Raised for frames that cannot be decoded (as opposed to a closed connection)."""
+
+class FrameTooLarge(ProtocolError):
+    """Raised for a frame over the reader's size limit, from its header alone (or while inflating it)."""
+
+    def __init__(self, size, limit):
+        super().__init__(f"frame of {size} bytes is over the {limit} byte limit")
+        self.size = size
+        self.limit = limit
+
+# --- Codecs ---
+# Bodies are self-describing: a JSON object always starts with '{' and a msgpack map
+# never does, so receivers decode whatever they get. Negotiation during HELLO only
+# decides what each side sends.
+class JsonCodec:
+    name = "json"
+
+    def encode(self, message_dict):
+        return json.dumps(message_dict).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    def encode(self, message_dict):
+        return msgpack.packb(message_dict, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+JSON_CODEC = JsonCodec()
+CODECS = {JSON_CODEC.name: JSON_CODEC}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+def supported_codecs():
+    """Codec names in order of preference, for the HELLO message."""
+    return [name for name in ("msgpack", "json") if name in CODECS]
+
+def negotiate_codec(offered_codecs, offered_compression):
+    """Picks the first offered codec we support. Returns (codec, compress)."""
+    codec = next((CODECS[name] for name in offered_codecs or [] if name in CODECS), JSON_CODEC)
+    return codec, "zlib" in (offered_compression or [])
+
+def encode_frame(message_dict, codec=JSON_CODEC, compress=False):
+    """Encodes a message. Returns the (header, body) buffers."""
+    body = codec.encode(message_dict)
+    flags = 0
+    if compress and len(body) >= COMPRESS_THRESHOLD:
+        body = zlib.compress(body, COMPRESS_LEVEL)
+        flags = COMPRESSED_FLAG
+    if len(body) > LENGTH_MASK:
+        raise ValueError(f"message too large to frame ({len(body)} bytes)")
+    return HEADER.pack(len(body) | flags), body
+
+def decode_body(body, compressed, max_size=None):
+    """Decodes a frame body with whichever codec produced it. A compressed body may inflate to max_size bytes."""
+    if compressed and max_size is not None:
+        inflater = zlib.decompressobj()
+        try:
+            body = inflater.decompress(body, max_size + 1)
+        except zlib.error as e:
+            raise ProtocolError(f"undecodable frame: {e}") from e
+        if len(body) > max_size:
+            raise FrameTooLarge(len(body), max_size)
+        compressed = False
     try:
-        json_data = json.dumps(message_dict).encode('utf-8')
-        # Pack the length of the data into a 4-byte big-endian integer (>I)
-        length_prefix = struct.pack('>I', len(json_data)) 
-        sock.sendall(length_prefix + json_data)
+        if compressed:
+            body = zlib.decompress(body)
+        if body[:1] == b'{':
+            return JSON_CODEC.decode(bytes(body))
+        if "msgpack" in CODECS:
+            return CODECS["msgpack"].decode(body)
+    except Exception as e:
+        raise ProtocolError(f"undecodable frame: {e}") from e
+    raise ProtocolError("frame body is not JSON and msgpack is not installed")
+
+class Frame:
+    """
+    A message encoded once per wire format and shared by every recipient of a
+    broadcast. Encodings are created on first use and cached.
+    """
+    __slots__ = ("message", "_encoded")
+
+    def __init__(self, message_dict):
+        self.message = message_dict
+        self._encoded = {}
+
+    def buffers(self, codec=JSON_CODEC, compress=False):
+        key = (codec.name, compress)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            encoded = self._encoded[key] = encode_frame(self.message, codec, compress)
+        return encoded
+
+def send_buffers(sock, buffers):
+    """Sends a (header, body) pair. Raises OSError on socket errors."""
+    if not HAS_SENDMSG:
+        sock.sendall(b''.join(buffers))
+        return
+    buffers = [memoryview(buf) for buf in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # Partial write: drop fully sent buffers and slice into the next one.
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+def send_frame(sock, frame, codec=JSON_CODEC, compress=False):
+    """Sends a pre-encoded Frame. Raises OSError on socket errors."""
+    send_buffers(sock, frame.buffers(codec, compress))
+
+def send_message(sock, message_dict, codec=JSON_CODEC, compress=False):
+    """Encodes and sends a dictionary with a 4-byte length prefix."""
+    try:
+        send_buffers(sock, encode_frame(message_dict, codec, compress))
     except Exception:
         pass # Socket error, connection is likely closed
 
-def recv_message(sock):
-    """Receives a message using the 4-byte length prefix."""
+# --- Receiving ---
+class FrameReader:
+    """
+    Buffered frame reader for a blocking socket.
+
+    Data is received with recv_into into one preallocated bytearray, which is
+    compacted or grown as needed, so a large payload costs no repeated
+    concatenation and several small frames can arrive in a single recv.
+
+    A frame whose header announces more than max_frame_size bytes (None: no
+    limit) raises FrameTooLarge before any of its body is read or buffered.
+    """
+
+    def __init__(self, sock, initial_size=64 * 1024, max_frame_size=None):
+        self.sock = sock
+        self.initial_size = initial_size
+        self.max_frame_size = max_frame_size  # may be changed between frames
+        self._buf = bytearray(initial_size)
+        self._start = 0  # first unread byte
+        self._end = 0    # end of received data
+        self.last_frame_size = 0  # header + body bytes of the frame read last
+
+    def _fill(self, needed):
+        """Makes at least `needed` unread bytes available. Returns False on EOF."""
+        if self._end - self._start >= needed:
+            return True
+        if self._start + needed > len(self._buf):
+            unread = self._end - self._start
+            if needed > len(self._buf):
+                new_buf = bytearray(max(needed, 2 * len(self._buf)))
+                new_buf[:unread] = self._buf[self._start:self._end]
+                self._buf = new_buf
+            else:
+                self._buf[:unread] = self._buf[self._start:self._end]
+            self._start, self._end = 0, unread
+        view = memoryview(self._buf)
+        while self._end - self._start < needed:
+            received = self.sock.recv_into(view[self._end:])
+            if not received:
+                return False
+            self._end += received
+        return True
+
+    def read_frame(self):
+        """Returns (body, compressed) for the next frame, or None if the connection closed."""
+        if not self._fill(HEADER.size):
+            return None
+        (raw_length,) = HEADER.unpack_from(self._buf, self._start)
+        length = raw_length & LENGTH_MASK
+        if self.max_frame_size is not None and length > self.max_frame_size:
+            raise FrameTooLarge(length, self.max_frame_size)
+        if not self._fill(HEADER.size + length):
+            return None
+        body_start = self._start + HEADER.size
+        body = memoryview(self._buf)[body_start:body_start + length]
+        self._start = body_start + length
+        self.last_frame_size = HEADER.size + length
+        return body, bool(raw_length & COMPRESSED_FLAG)
+
+    def read_message(self):
+        """Returns the next decoded message, or None if the connection closed."""
+        try:
+            frame = self.read_frame()
+        except OSError:
+            return None # Socket error, connection is likely closed
+        if frame is None:
+            return None
+        body, compressed = frame
+        try:
+            return decode_body(body, compressed, self.max_frame_size)
+        finally:
+            body.release()
+            if self._start == self._end:
+                self._start = self._end = 0
+                if len(self._buf) > 4 * self.initial_size:
+                    self._buf = bytearray(self.initial_size)  # Don't keep a huge buffer around
+
+def recv_message(sock, max_size=None):
+    """
+    Receives a single message using the 4-byte length prefix. Returns None on
+    disconnect; raises FrameTooLarge for frames over max_size bytes.
+    """
+    # Stateless, so it never reads past the end of this frame.
     try:
-        # 1. Read the 4-byte length prefix
-        raw_length = sock.recv(4)
-        if not raw_length:
+        header = _recv_exactly(sock, HEADER.size)
+        if header is None:
             return None # Connection closed
+        (raw_length,) = HEADER.unpack(header)
+        _check_size(raw_length & LENGTH_MASK, max_size)
+        body = _recv_exactly(sock, raw_length & LENGTH_MASK)
+        if body is None:
+            return None
+    except OSError:
+        return None
+    return decode_body(body, bool(raw_length & COMPRESSED_FLAG), max_size)
 
-        msg_length = struct.unpack('>I', raw_length)[0]
+def _check_size(length, max_size):
+    if max_size is not None and length > max_size:
+        raise FrameTooLarge(length, max_size)
 
-        # 2. Read the entire message payload
-        data = b''
-        while len(data) < msg_length:
-            chunk = sock.recv(msg_length - len(data))
-            if not chunk:
-                return None 
-            data += chunk
+def _recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            return None
+        received += n
+    return buf
 
-        return json.loads(data.decode('utf-8'))
-    except Exception:
-        return None
\ No newline at end of file
+async def read_message_async(reader, max_size=None):
+    """asyncio counterpart of recv_message for an asyncio.StreamReader."""
+    message, _ = await read_sized_message_async(reader, max_size)
+    return message
+
+async def read_sized_message_async(reader, max_size=None):
+    """Like read_message_async, but returns (message, frame size in bytes); (None, 0) on disconnect."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+        (raw_length,) = HEADER.unpack(header)
+        _check_size(raw_length & LENGTH_MASK, max_size)
+        body = await reader.readexactly(raw_length & LENGTH_MASK)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None, 0 # Connection closed
+    return decode_body(body, bool(raw_length & COMPRESSED_FLAG), max_size), HEADER.size + len(body)
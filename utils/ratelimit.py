@@ -0,0 +1,101 @@
+# utils/ratelimit.py
+# Token buckets limiting how many messages (and bytes) one connection may send.
+import time
+
+
+class TokenBucket:
+    """
+    Earns `rate` tokens a second, up to `burst`. take() refills from the time since
+    the previous call instead of on a timer, so a check is a few float operations.
+    Not locked: a connection's buckets are only used by its reader.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, amount=1.0, now=None):
+        """Takes `amount` tokens (at most `burst`) if there are that many. Returns whether it did."""
+        if now is None:
+            now = time.monotonic()
+        # Comparisons rather than min(): this runs for every message.
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.updated = now
+        if amount > self.burst:
+            amount = self.burst  # A frame over the byte burst passes when the bucket is full
+        if tokens >= amount:
+            self.tokens = tokens - amount
+            return True
+        self.tokens = tokens
+        return False
+
+    def wait_time(self, amount=1.0):
+        """Seconds until take(amount) would succeed, as of the last call."""
+        return max(0.0, (min(amount, self.burst) - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    The limits of one connection: a bucket per message type in `per_type`
+    ({type: (messages per second, burst)}), plus `messages` and `byte_rate` buckets
+    shared by all types ((per second, burst) or None for no limit).
+
+    check() runs before a message is handled. A refused message still spends the
+    tokens of the buckets checked before the one that refused it.
+    """
+
+    def __init__(self, per_type, messages=None, byte_rate=None):
+        now = time.monotonic()
+        self._types = {msg_type: TokenBucket(rate, burst, now) for msg_type, (rate, burst) in per_type.items()}
+        self._messages = TokenBucket(*messages, now) if messages else None
+        self._bytes = TokenBucket(*byte_rate, now) if byte_rate else None
+        self._quiet_until = {}  # {(message type, limit): monotonic time before which it is not reported again}
+        self.refused_in_a_row = 0
+        self.refused = 0
+
+    def check(self, msg_type, size):
+        """
+        Returns None if the message may be handled. Otherwise returns (limit, retry_after,
+        notify): the limit it hit (the message type, "messages" or "bytes"), seconds until
+        it would pass, and whether to tell the client (once per message type and limit
+        until retry_after has passed, so a client that waits is always told again).
+        """
+        now = time.monotonic()
+        bucket = self._types.get(msg_type)
+        if bucket is not None and not bucket.take(1, now):
+            return self._refuse(msg_type, msg_type, bucket, 1, now)
+        if self._messages is not None and not self._messages.take(1, now):
+            return self._refuse(msg_type, "messages", self._messages, 1, now)
+        if self._bytes is not None and not self._bytes.take(size, now):
+            return self._refuse(msg_type, "bytes", self._bytes, size, now)
+        self.refused_in_a_row = 0
+        return None
+
+    def _refuse(self, msg_type, limit, bucket, amount, now):
+        self.refused += 1
+        self.refused_in_a_row += 1
+        retry_after = bucket.wait_time(amount)
+        notify = now >= self._quiet_until.get((msg_type, limit), 0.0)
+        if notify:
+            self._quiet_until[msg_type, limit] = now + retry_after
+        return limit, retry_after, notify
+
+
+# --- Optional Local Test Block ---
+if __name__ == "__main__":
+    limiter = RateLimiter({"CHAT": (5, 10)}, messages=(100, 200), byte_rate=(1024, 4096))
+    results = [limiter.check("CHAT", 50) for _ in range(15)]
+    print("Burst Of 10 Then Refused:", [r is None for r in results].count(True) == 10, results[10])
+    time.sleep(0.4)
+    print("Refilled After 0.4s:", limiter.check("CHAT", 50) is None, limiter.check("CHAT", 50) is None)
+    print("Byte Limit:", limiter.check("EDIT_OP", 5000), limiter.check("EDIT_OP", 10))
+
+    started = time.perf_counter()
+    for _ in range(100_000):
+        limiter.check("CHAT", 0)
+    print(f"check(): {(time.perf_counter() - started) * 10:.2f} us per call")
@@ -0,0 +1,367 @@
+# utils/rope.py
+# Immutable rope holding a server-side document: O(log n) edits, lazily mapped files.
+import mmap
+import random
+
+LEAF_SIZE = 4096  # chars per leaf when text is split up; small inserts grow a leaf up to this
+FILE_BLOCK_BYTES = 64 * 1024  # a mapped file is indexed in blocks of about this many bytes
+_UTF8_CONTINUATION = 0b10000000
+_UTF8_CONTINUATION_MASK = 0b11000000
+
+
+class _FileBlock:
+    """A run of a memory-mapped UTF-8 file, decoded only when it is read."""
+    __slots__ = ("data", "start", "end", "length")
+
+    def __init__(self, data, start, end, length):
+        self.data = data  # mmap
+        self.start = start
+        self.end = end
+        self.length = length  # in chars
+
+    def text(self):
+        return self.data[self.start:self.end].decode('utf-8')
+
+    def raw(self):
+        return self.data[self.start:self.end]
+
+
+def _piece_length(piece):
+    return len(piece) if isinstance(piece, str) else piece.length
+
+
+def _piece_text(piece, start=0, end=None):
+    text = piece if isinstance(piece, str) else piece.text()
+    return text if start == 0 and (end is None or end >= len(text)) else text[start:end]
+
+
+class _Node:
+    """
+    Treap node: one piece of text, a random priority (heap-ordered, which keeps
+    the tree balanced in expectation) and the length of its whole subtree.
+    Nodes are never modified once built; edits copy the O(log n) nodes on a path.
+    """
+    __slots__ = ("piece", "priority", "left", "right", "length")
+
+    def __init__(self, piece, priority, left, right):
+        self.piece = piece
+        self.priority = priority
+        self.left = left
+        self.right = right
+        self.length = _piece_length(piece) + (left.length if left else 0) + (right.length if right else 0)
+
+
+def _split(node, pos):
+    """Returns (first pos chars, the rest) as two trees."""
+    if node is None:
+        return None, None
+    if pos <= 0:
+        return None, node
+    if pos >= node.length:
+        return node, None
+    left_length = node.left.length if node.left else 0
+    if pos <= left_length:
+        left, right = _split(node.left, pos)
+        return left, _Node(node.piece, node.priority, right, node.right)
+    piece_end = left_length + _piece_length(node.piece)
+    if pos >= piece_end:
+        left, right = _split(node.right, pos - piece_end)
+        return _Node(node.piece, node.priority, node.left, left), right
+    # Inside this node's piece: both halves keep its priority, so both stay valid heaps.
+    text = _piece_text(node.piece)
+    offset = pos - left_length
+    return (_Node(text[:offset], node.priority, node.left, None),
+            _Node(text[offset:], node.priority, None, node.right))
+
+
+def _merge(left, right):
+    """Concatenates two trees."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        return _Node(left.piece, left.priority, left.left, _merge(left.right, right))
+    return _Node(right.piece, right.priority, _merge(left, right.left), right.right)
+
+
+def _last_piece(node):
+    while node.right is not None:
+        node = node.right
+    return node.piece
+
+
+def _first_piece(node):
+    while node.left is not None:
+        node = node.left
+    return node.piece
+
+
+def _replace_last(node, piece):
+    if node.right is None:
+        return _Node(piece, node.priority, node.left, None)
+    return _Node(node.piece, node.priority, node.left, _replace_last(node.right, piece))
+
+
+def _drop_first(node):
+    if node.left is None:
+        return node.right
+    return _Node(node.piece, node.priority, _drop_first(node.left), node.right)
+
+
+def _join(left, right):
+    """Concatenates two trees, folding two small text leaves that meet into one."""
+    if left is None or right is None:
+        return left or right
+    last, first = _last_piece(left), _first_piece(right)
+    if isinstance(last, str) and isinstance(first, str) and len(last) + len(first) <= LEAF_SIZE:
+        left, right = _replace_last(left, last + first), _drop_first(right)
+    return _merge(left, right)
+
+
+def _insert_in_leaf(node, pos, text):
+    """
+    Inserts into the text piece that holds pos by copying only the path to it, or
+    returns None if that piece is a file block or would outgrow LEAF_SIZE.
+    """
+    left_length = node.left.length if node.left else 0
+    if pos < left_length:
+        left = _insert_in_leaf(node.left, pos, text)
+        return left and _Node(node.piece, node.priority, left, node.right)
+    piece = node.piece
+    offset = pos - left_length
+    if offset > _piece_length(piece):
+        right = _insert_in_leaf(node.right, offset - _piece_length(piece), text)
+        return right and _Node(piece, node.priority, node.left, right)
+    if not isinstance(piece, str) or len(piece) + len(text) > LEAF_SIZE:
+        return None
+    return _Node(piece[:offset] + text + piece[offset:], node.priority, node.left, node.right)
+
+
+def _delete_in_leaf(node, pos, length):
+    """Deletes a range that lies inside one text piece (and does not empty it), or returns None."""
+    left_length = node.left.length if node.left else 0
+    if pos + length <= left_length:
+        left = _delete_in_leaf(node.left, pos, length)
+        return left and _Node(node.piece, node.priority, left, node.right)
+    piece = node.piece
+    offset = pos - left_length
+    if offset >= _piece_length(piece):
+        right = _delete_in_leaf(node.right, offset - _piece_length(piece), length)
+        return right and _Node(piece, node.priority, node.left, right)
+    if offset < 0 or not isinstance(piece, str) or offset + length >= len(piece):
+        return None
+    return _Node(piece[:offset] + piece[offset + length:], node.priority, node.left, node.right)
+
+
+def _build(pieces):
+    """Builds a treap from pieces in order, in linear time (Cartesian tree construction)."""
+    spine = []  # right spine as [piece, priority, left, right] lists; nodes are built afterwards
+    for piece in pieces:
+        entry = [piece, random.random(), None, None]
+        last = None
+        while spine and spine[-1][1] < entry[1]:
+            last = spine.pop()
+        entry[2] = last
+        if spine:
+            spine[-1][3] = entry
+        spine.append(entry)
+    return _freeze(spine[0]) if spine else None
+
+
+def _freeze(entry):
+    if entry is None:
+        return None
+    piece, priority, left, right = entry
+    return _Node(piece, priority, _freeze(left), _freeze(right))
+
+
+def _text_leaves(text):
+    return [text[i:i + LEAF_SIZE] for i in range(0, len(text), LEAF_SIZE)]
+
+
+def _iter_pieces(node, start, end):
+    """Yields (piece, start, end) for the part of each piece inside [start, end), in order."""
+    if node is None or start >= end:
+        return
+    left_length = node.left.length if node.left else 0
+    if start < left_length:
+        yield from _iter_pieces(node.left, start, min(end, left_length))
+    piece_length = _piece_length(node.piece)
+    piece_start, piece_end = max(start - left_length, 0), min(end - left_length, piece_length)
+    if piece_start < piece_end:
+        yield node.piece, piece_start, piece_end
+    right_start = left_length + piece_length
+    if end > right_start:
+        yield from _iter_pieces(node.right, max(start - right_start, 0), end - right_start)
+
+
+class Rope:
+    """
+    Immutable text with O(log n) insert and delete. Edits return a new Rope that
+    shares all untouched pieces with the old one, so a reference taken under the
+    document lock is a consistent snapshot that other threads can read or write
+    out at leisure.
+
+    Rope.from_file() maps a UTF-8 file instead of reading it: the text stays in
+    the page cache, and only blocks that are edited become Python strings. The
+    file must only ever be replaced (atomic_write), never rewritten in place,
+    while a rope refers to it.
+    """
+    __slots__ = ("_root",)
+
+    def __init__(self, text=""):
+        self._root = text._root if isinstance(text, Rope) else _build(_text_leaves(text))
+
+    @classmethod
+    def _from_root(cls, root):
+        rope = cls.__new__(cls)
+        rope._root = root
+        return rope
+
+    @classmethod
+    def from_file(cls, path, offset=0):
+        """
+        The UTF-8 text of `path` from byte `offset` on. One pass counts the chars of
+        each block (ASCII blocks are not even decoded); nothing is kept in memory.
+        Raises UnicodeDecodeError like reading the file would.
+        """
+        with open(path, 'rb') as f:
+            size = f.seek(0, 2)
+            if size <= offset:
+                return cls()
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        blocks = []
+        start = offset
+        while start < size:
+            end = min(start + FILE_BLOCK_BYTES, size)
+            while end < size and data[end] & _UTF8_CONTINUATION_MASK == _UTF8_CONTINUATION:
+                end -= 1  # Never cut a multi-byte character in two
+            raw = data[start:end]
+            length = len(raw) if raw.isascii() else len(raw.decode('utf-8'))
+            blocks.append(_FileBlock(data, start, end, length))
+            start = end
+        return cls._from_root(_build(blocks))
+
+    # --- Reading ---
+    def __len__(self):
+        return self._root.length if self._root else 0
+
+    def __str__(self):
+        return "".join(self.chunks())
+
+    def __repr__(self):
+        return f"Rope({len(self)} chars)"
+
+    def chunks(self, start=0, end=None):
+        """Yields the text from start to end (chars) as a sequence of strs."""
+        end = len(self) if end is None else min(end, len(self))
+        for piece, piece_start, piece_end in _iter_pieces(self._root, max(start, 0), end):
+            yield _piece_text(piece, piece_start, piece_end)
+
+    def substring(self, start, end):
+        return "".join(self.chunks(start, end))
+
+    def encoded_chunks(self):
+        """Yields the whole text as UTF-8 bytes; mapped blocks that were never edited are copied as is."""
+        for piece, piece_start, piece_end in _iter_pieces(self._root, 0, len(self)):
+            if isinstance(piece, str):
+                yield piece[piece_start:piece_end].encode('utf-8')
+            elif piece_start == 0 and piece_end == piece.length:
+                yield piece.raw()
+            else:
+                yield piece.text()[piece_start:piece_end].encode('utf-8')
+
+    def encoded_length(self):
+        """Length of the UTF-8 text in bytes, one piece at a time; mapped blocks that were never edited are not read."""
+        size = 0
+        for piece, piece_start, piece_end in _iter_pieces(self._root, 0, len(self)):
+            if isinstance(piece, str):
+                size += len(piece[piece_start:piece_end].encode('utf-8'))
+            elif piece_start == 0 and piece_end == piece.length:
+                size += piece.end - piece.start
+            else:
+                size += len(piece.text()[piece_start:piece_end].encode('utf-8'))
+        return size
+
+    # --- Editing ---
+    def insert(self, pos, text):
+        if not text:
+            return self
+        if self._root is not None and len(text) <= LEAF_SIZE and 0 <= pos <= len(self):
+            root = _insert_in_leaf(self._root, pos, text)  # The common case: typing
+            if root is not None:
+                return Rope._from_root(root)
+        left, right = _split(self._root, pos)
+        middle = _build(_text_leaves(text)) if len(text) > LEAF_SIZE else _Node(text, random.random(), None, None)
+        return Rope._from_root(_join(_join(left, middle), right))
+
+    def delete(self, pos, length):
+        if length <= 0:
+            return self
+        if self._root is not None and 0 <= pos and pos + length <= len(self):
+            root = _delete_in_leaf(self._root, pos, length)
+            if root is not None:
+                return Rope._from_root(root)
+        left, rest = _split(self._root, pos)
+        _, right = _split(rest, length)
+        return Rope._from_root(_join(left, right))
+
+    def apply(self, ops):
+        """Like operations.apply_ops, for a rope. Raises ValueError on bad positions."""
+        rope = self
+        for op in ops:
+            pos = op["pos"]
+            if op["op"] == "insert":
+                if pos > len(rope):
+                    raise ValueError(f"insert at {pos} beyond end of document ({len(rope)})")
+                rope = rope.insert(pos, op["text"])
+            else:
+                end = pos + op["length"]
+                if end > len(rope):
+                    raise ValueError(f"delete {pos}:{end} beyond end of document ({len(rope)})")
+                rope = rope.delete(pos, op["length"])
+        return rope
+
+
+# --- Optional Local Test Block ---
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    from utils.operations import apply_ops
+
+    rng = random.Random(7)
+    text = "".join(rng.choice("abcdé\n") for _ in range(20000))
+    rope = Rope(text)
+    for _ in range(3000):
+        pos = rng.randint(0, len(text))
+        if rng.random() < 0.6:
+            ops = [{"op": "insert", "pos": pos, "text": rng.choice(["x", "yz", "ü" * 5000])}]
+        else:
+            ops = [{"op": "delete", "pos": pos, "length": rng.randint(0, min(50, len(text) - pos))}]
+        text, rope = apply_ops(text, ops), rope.apply(ops)
+    print("Matches apply_ops:", str(rope) == text, len(rope) == len(text))
+    print("Substring:", rope.substring(100, 200) == text[100:200])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "big.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            for i in range(200000):
+                f.write(f"line {i} of a large log file, naïve café\n")
+        started = time.perf_counter()
+        mapped = Rope.from_file(path)
+        print(f"Mapped {os.path.getsize(path) / 1e6:.1f} MB in {(time.perf_counter() - started) * 1000:.0f} ms")
+        with open(path, encoding='utf-8') as f:
+            original = f.read()
+        edited = mapped.insert(12345, "EDIT").delete(500000, 10)
+        expected = original[:12345] + "EDIT" + original[12345:]
+        expected = expected[:500000] + expected[500010:]
+        print("Mapped Edits:", str(edited) == expected, str(mapped) == original)
+        print("Encoded:", b"".join(edited.encoded_chunks()) == expected.encode('utf-8'))
+
+    started = time.perf_counter()
+    for i in range(100000):
+        rope = rope.insert(rng.randint(0, len(rope)), "k")
+    print(f"Random single-char inserts: {(time.perf_counter() - started) / 100000 * 1e6:.1f} us each")
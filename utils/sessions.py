@@ -0,0 +1,173 @@
+# utils/sessions.py
+# Sessions and live connections, indexed in both directions, with timer-wheel expiry.
+import math
+import threading
+import time
+from secrets import token_hex
+
+
+class Session:
+    __slots__ = ("session_id", "user_id", "connections", "slot", "expires_at")
+
+    def __init__(self, session_id, user_id):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.connections = set()  # live connections using this session
+        self.slot = None  # timer wheel slot while detached
+        self.expires_at = None
+
+
+class SessionRegistry:
+    """
+    Every session and live connection, indexed session -> user, user -> sessions,
+    session -> connections and connection -> session. All operations are O(1)
+    (snapshots like connections() aside) under one lock that guards only the
+    registry, never a document.
+
+    A session outlives its last connection by `ttl` seconds so it can be resumed.
+    Detached sessions sit in a timer wheel of ttl/tick slots; a background thread
+    expires one slot per tick, so expiry never scans every session.
+
+    Connection objects get `user_id` and `session_id` set as they are bound.
+    """
+
+    def __init__(self, ttl=300.0, tick=1.0, on_expire=None):
+        self.ttl = ttl
+        self.tick = tick
+        self.on_expire = on_expire  # called as on_expire(session_id, user_id), outside the lock
+        self._lock = threading.Lock()
+        self._sessions = {}  # {session_id: Session}
+        self._by_user = {}  # {user_id: {session_id}}
+        self._connections = {}  # {connection: Session or None}
+        self._ticks = max(1, math.ceil(ttl / tick))
+        self._wheel = [set() for _ in range(self._ticks + 1)]  # slots of session IDs
+        self._cursor = 0
+        threading.Thread(target=self._run, name="session-expiry", daemon=True).start()
+
+    # --- Connections ---
+    def add_connection(self, conn):
+        with self._lock:
+            self._connections[conn] = None
+
+    def remove_connection(self, conn):
+        """Forgets conn. Its session starts expiring if no other connection uses it."""
+        with self._lock:
+            session = self._connections.pop(conn, None)
+            if session is not None:
+                self._unbind(conn, session)
+
+    def connections(self):
+        with self._lock:
+            return list(self._connections)
+
+    # --- Sessions ---
+    def create(self, conn, user_id):
+        """Starts a new session for user_id on conn. Returns the session ID."""
+        session = Session(token_hex(16), user_id)
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._by_user.setdefault(user_id, set()).add(session.session_id)
+            self._bind(conn, session)
+        return session.session_id
+
+    def validate(self, conn, session_id):
+        """Binds conn to an existing session. Returns its user ID, or None if unknown/expired."""
+        with self._lock:
+            session = self._connections.get(conn)
+            if session is None or session.session_id != session_id:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    return None
+                self._bind(conn, session)
+            return session.user_id
+
+    def resume(self, conn, session_id):
+        """
+        Moves a session onto a new connection. Returns (user_id, other_connections),
+        where other_connections still held the session (e.g. half-open sockets), or
+        None if the session is unknown or expired.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            others = [c for c in session.connections if c is not conn]
+            self._bind(conn, session)
+            return session.user_id, others
+
+    def end(self, session_id):
+        """Ends a session now (LOGOUT). Its connections stay registered, unauthenticated."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                for conn in session.connections:
+                    self._connections[conn] = None
+                session.connections.clear()
+                self._remove(session)
+
+    def sessions_of(self, user_id):
+        with self._lock:
+            return set(self._by_user.get(user_id, ()))
+
+    def stats(self):
+        with self._lock:
+            detached = sum(len(slot) for slot in self._wheel)
+            return {"sessions": len(self._sessions), "detached": detached,
+                    "users": len(self._by_user), "connections": len(self._connections)}
+
+    # --- Internals (call with _lock held) ---
+    def _bind(self, conn, session):
+        previous = self._connections.get(conn)
+        if previous is not None and previous is not session:
+            self._unbind(conn, previous)
+        self._connections[conn] = session
+        session.connections.add(conn)
+        self._unschedule(session)
+        conn.user_id = session.user_id
+        conn.session_id = session.session_id
+
+    def _unbind(self, conn, session):
+        session.connections.discard(conn)
+        if not session.connections and session.session_id in self._sessions:
+            self._schedule(session)
+
+    def _schedule(self, session):
+        session.slot = (self._cursor + self._ticks) % len(self._wheel)
+        session.expires_at = time.monotonic() + self.ttl
+        self._wheel[session.slot].add(session.session_id)
+
+    def _unschedule(self, session):
+        if session.slot is not None:
+            self._wheel[session.slot].discard(session.session_id)
+            session.slot = None
+
+    def _remove(self, session):
+        self._unschedule(session)
+        del self._sessions[session.session_id]
+        user_sessions = self._by_user[session.user_id]
+        user_sessions.discard(session.session_id)
+        if not user_sessions:
+            del self._by_user[session.user_id]
+
+    # --- Expiry thread ---
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            expired = []
+            with self._lock:
+                self._cursor = (self._cursor + 1) % len(self._wheel)
+                due, self._wheel[self._cursor] = self._wheel[self._cursor], set()
+                now = time.monotonic()
+                for session_id in due:
+                    session = self._sessions[session_id]
+                    if session.expires_at > now:
+                        # The thread ran ahead of the clock; look again next tick.
+                        session.slot = (self._cursor + 1) % len(self._wheel)
+                        self._wheel[session.slot].add(session_id)
+                        continue
+                    session.slot = None
+                    self._remove(session)
+                    expired.append((session_id, session.user_id))
+            if self.on_expire:
+                for session_id, user_id in expired:
+                    self.on_expire(session_id, user_id)